@@ -2,40 +2,193 @@
 """
 Define classes related to batch processing here.
 """
-from copy import deepcopy
-from random import shuffle
+import queue
+import threading
+
+import numpy as np
 
 __author__ = 'kensk8er'
 
 
+def flatten_samples(X):
+    """
+    Flatten samples of word IDs into a single token buffer and an offsets array.
+
+    :param X: list of samples (list of lists of word_ids)
+    :return: (tokens, offsets) where the i-th sample is tokens[offsets[i]: offsets[i + 1]]
+    """
+    lengths = np.fromiter((len(x) for x in X), dtype=np.int64, count=len(X))
+    offsets = np.zeros(len(X) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = np.fromiter((word_id for x in X for word_id in x), dtype=np.int32,
+                         count=int(offsets[-1]))
+    return tokens, offsets
+
+
+def select_samples(tokens, offsets, indices):
+    """
+    Gather the samples at the given indices into a new token buffer and offsets array.
+
+    :param tokens: flat buffer of word IDs
+    :param offsets: offsets of the samples in tokens
+    :param indices: indices of the samples to select
+    :return: (tokens, offsets) of the selected samples
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+
+    # position of every selected token in the original buffer
+    token_indices = (np.arange(new_offsets[-1], dtype=np.int64) -
+                     np.repeat(new_offsets[:-1] - starts, lengths))
+    return tokens[token_indices], new_offsets
+
+
+def find_known_samples(tokens, offsets):
+    """
+    Return a boolean array of the samples which have no unknown tokens (encoded into negative IDs,
+    e.g. unknown_id=-1 of CharEncoder).
+
+    :param tokens: flat buffer of word IDs
+    :param offsets: offsets of the samples in tokens
+    :return: boolean array of shape [len(offsets) - 1]
+    """
+    is_known = np.ones(len(offsets) - 1, dtype=bool)
+    is_known[np.searchsorted(offsets, np.flatnonzero(tokens < 0), side='right') - 1] = False
+    return is_known
+
+
+def pad_batch(tokens, offsets, indices, segment_id, padding_id=0):
+    """
+    Create padded X, Y and seq_lens arrays for the samples at the given indices.
+
+    X is a sample with the segment ID prepended (in order to learn the beginning of a sample) and Y
+    is the same sample with the segment ID appended, so both are one element longer than the
+    sample itself.
+
+    :param tokens: flat buffer of word IDs
+    :param offsets: offsets of the samples in tokens
+    :param indices: indices of the samples to put in the batch
+    :param segment_id: ID of the character that represents a border between samples
+    :param padding_id: ID used for padding
+    :return: X, Y (int32 arrays of shape [batch_size, max_seq_len]) and seq_lens
+    """
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    seq_lens = (lengths + 1).astype(np.int32)
+    max_len = int(lengths.max()) if len(lengths) else 0
+
+    positions = np.arange(max_len, dtype=np.int64)
+    mask = positions < lengths[:, np.newaxis]
+    gather_indices = np.where(mask, starts[:, np.newaxis] + positions, 0)
+    body = np.where(mask, tokens[gather_indices], padding_id)
+
+    X = np.full((len(indices), max_len + 1), padding_id, dtype=np.int32)
+    X[:, 0] = segment_id
+    X[:, 1:] = body
+
+    Y = np.full((len(indices), max_len + 1), padding_id, dtype=np.int32)
+    Y[:, :-1] = body
+    Y[np.arange(len(indices)), lengths] = segment_id
+    return X, Y, seq_lens
+
+
+def split_by_tokens(indices, seq_lens, max_tokens):
+    """
+    Greedily split samples into batches of at most max_tokens padded characters (a batch contains
+    at least 1 sample even if the sample alone exceeds max_tokens).
+
+    :param indices: array of sample indices, in the order they are batched
+    :param seq_lens: array of the sequence lengths of the samples (in the same order as indices)
+    :param max_tokens: the maximum number of padded characters per batch
+    :return: list of arrays of sample indices
+    """
+    batches = list()
+    start_index = 0
+    max_seq_len = 0
+    for index, seq_len in enumerate(seq_lens.tolist()):
+        max_seq_len = max(max_seq_len, seq_len)
+        if index > start_index and (index + 1 - start_index) * max_seq_len > max_tokens:
+            batches.append(indices[start_index: index])
+            start_index = index
+            max_seq_len = seq_len
+    batches.append(indices[start_index:])
+    return batches
+
+
 class BatchGenerator(object):
     """
     BatchGenerator class cretates a batch iterator on which you can iterate in order to get batches.
 
+    The samples are stored once as a flat token buffer and an offsets array, and only a
+    permutation of the sample indices is shuffled in every new epoch.
+
+    When `bucket_size` is given, the shuffled samples are split into mega-batches of
+    `bucket_size * batch_size` samples which are sorted by length before being cut into batches,
+    so that samples of similar length end up in the same batch (less padding). When `max_tokens`
+    is given, a batch holds as many samples as fit in `max_tokens` padded characters instead of a
+    fixed `batch_size` samples.
+
     Basic Usage:
-        batch_generator = BatchGenerator(X, y, batch_size=128)
+        batch_generator = BatchGenerator(X, batch_size=128, segment_id=segment_char_id)
 
-        for X_batch, y_batch in batch_generator:
-            # it keeps iterating on the batches unless you run it with `validation=True`
-            do_something_on_batch(X_batch, y_batch)
+        for X_batch, Y_batch, seq_lens in batch_generator:
+            # it keeps iterating on the batches forever
+            do_something_on_batch(X_batch, Y_batch, seq_lens)
     """
 
-    def __init__(self, X, batch_size, shuffle=True):
+    def __init__(self, X, batch_size, segment_id, padding_id=0, shuffle=True, random_state=None,
+                 bucket_size=None, max_tokens=None, indices=None):
         """
         Constructor
 
-        :param X: list of samples (list of lists of word_ids)
+        :param X: list of samples (list of lists of word_ids) or a tuple of (tokens, offsets),
+                  which can be memory-mapped arrays as they are only read batch by batch
         :param batch_size: the size of samples in a batch
+        :param segment_id: ID of the character that represents a border between samples
+        :param padding_id: ID used for padding
         :param shuffle: if True, shuffle the data in every new epoch
+        :param random_state: seed (or np.random.RandomState) used for shuffling
+        :param bucket_size: if given, sort samples by length within mega-batches of
+                            bucket_size * batch_size samples
+        :param max_tokens: if given, the maximum number of (padded) characters per batch, which is
+                           used instead of batch_size
+        :param indices: if given, only generate batches of the samples at these indices (e.g.
+                        training split) without copying them
         """
-        assert isinstance(X, list), 'Invalid argument type type(X) = {}'.format(type(X))
         assert batch_size > 0, 'batch_size <= 0'
+        assert bucket_size is None or bucket_size > 0, 'bucket_size <= 0'
+        assert max_tokens is None or max_tokens > 0, 'max_tokens <= 0'
+
+        if isinstance(X, tuple):
+            tokens, offsets = X
+        else:
+            assert isinstance(X, list), 'Invalid argument type type(X) = {}'.format(type(X))
+            tokens, offsets = flatten_samples(X)
+
+        self._tokens = tokens
+        self._offsets = offsets
+        self._permutation = (np.arange(len(offsets) - 1) if indices is None
+                             else np.array(indices, dtype=np.int64))
+        self._data_size = len(self._permutation)
+        assert self._data_size > 0, 'X is empty'
 
-        self._X = deepcopy(X)  # BatchGenerator shouldn't have a by-product
-        self._batch_id = 0
         self._batch_size = batch_size
+        self._segment_id = segment_id
+        self._padding_id = padding_id
         self._shuffle = shuffle
-        self._data_size = len(self._X)
+        self._random_state = (random_state if isinstance(random_state, np.random.RandomState)
+                              else np.random.RandomState(random_state))
+        self._position = 0
+        self._bucket_size = bucket_size
+        self._max_tokens = max_tokens
+        self._batches = list()  # remaining batches (arrays of indices) of the current epoch
+        self._epoch_state = None  # (permutation, random state) before planning the current epoch
+        self._epoch_batch_num = 0  # the number of batches planned for the current epoch
+        self._num_tokens = 0  # the number of actual characters generated so far
+        self._num_slots = 0  # the number of characters generated so far including paddings
 
     def __iter__(self):
         return self
@@ -44,25 +197,350 @@ class BatchGenerator(object):
         """
         This is called everytime you iterate on this object.
 
-        :return: a batch of X
+        :return: a batch of X, Y, and seq_lens
         """
-        X = self._gen_batch(self._X, self._batch_id, self._batch_size, self._data_size)
-        self._batch_id += 1
-        return X
+        if self._bucket_size or self._max_tokens:
+            indices = self._next_planned_indices()
+        else:
+            indices = self._next_indices()
+
+        X, Y, seq_lens = pad_batch(self._tokens, self._offsets, indices, self._segment_id,
+                                   self._padding_id)
+        self._num_tokens += int(seq_lens.sum())
+        self._num_slots += X.size
+        return X, Y, seq_lens
+
+    def _next_planned_indices(self):
+        """Return the sample indices of the next batch of the current epoch's batch plan."""
+        if not self._batches:
+            self._batches = self._plan_epoch()
+        return self._batches.pop()
+
+    def _plan_epoch(self):
+        """Split (shuffled, optionally length-sorted) samples into the batches of an epoch."""
+        self._epoch_state = (self._permutation, self._random_state.get_state())
+        if self._shuffle:
+            # shuffle a copy such that the permutation of a state is never modified
+            self._permutation = self._random_state.permutation(self._permutation)
+        permutation = self._permutation
+        lengths = np.diff(self._offsets)
+
+        if self._bucket_size:
+            mega_batch_size = self._bucket_size * self._batch_size
+            mega_batches = list()
+            for start_index in range(0, self._data_size, mega_batch_size):
+                mega_batch = permutation[start_index: start_index + mega_batch_size]
+                mega_batches.append(mega_batch[np.argsort(lengths[mega_batch], kind='mergesort')])
+            permutation = np.concatenate(mega_batches)
+
+        if self._max_tokens:
+            batches = split_by_tokens(permutation, lengths[permutation] + 1, self._max_tokens)
+        else:
+            batches = [permutation[start_index: start_index + self._batch_size]
+                       for start_index in range(0, self._data_size, self._batch_size)]
+
+        # shuffle the order of batches such that batch lengths don't correlate over iterations
+        if self._shuffle:
+            self._random_state.shuffle(batches)
+        batches.reverse()  # batches are popped from the end
+        self._epoch_batch_num = len(batches)
+        return batches
 
-    def _gen_batch(self, X, batch_id, batch_size, data_size):
-        """Generate batch for given X, batch_id, batch_size, and data_size."""
-        start_index = (batch_id * batch_size) % data_size
-        end_index = ((batch_id + 1) * batch_size) % data_size
+    def _next_indices(self):
+        """Return the sample indices of the next batch, reshuffling after going over the data."""
+        start_index = self._position
+        end_index = start_index + self._batch_size
 
-        if start_index < end_index:
-            return deepcopy(X[start_index: end_index])
-        else:  # executing here means you have gone over X and y already
-            X_first = deepcopy(X[start_index:])
+        if end_index < self._data_size:
+            self._position = end_index
+            return self._permutation[start_index: end_index]
 
-            # shuffle X and y after going over them if shuffle is True
+        # executing here means you have gone over the samples already
+        indices = [self._permutation[start_index:].copy()]
+        remaining = end_index - self._data_size
+        while True:
+            # shuffle the permutation after going over the samples if shuffle is True
             if self._shuffle:
-                shuffle(X)
+                self._permutation = self._random_state.permutation(self._permutation)
+            if remaining < self._data_size:
+                break
+            indices.append(self._permutation.copy())
+            remaining -= self._data_size
+        indices.append(self._permutation[:remaining])
+        self._position = remaining
+        return np.concatenate(indices)
+
+    @property
+    def state(self):
+        """
+        State of the generator after the last batch, from which set_state() resumes generating the
+        same batches (e.g. when resuming a training). It's cheap to get since the permutations of
+        states are never modified in place.
+        """
+        if self._bucket_size or self._max_tokens:
+            # the batches consumed in the current epoch are planned again from the epoch state
+            permutation, random_state = self._epoch_state or (self._permutation,
+                                                              self._random_state.get_state())
+            position = self._epoch_batch_num - len(self._batches)
+        else:
+            permutation, random_state = self._permutation, self._random_state.get_state()
+            position = self._position
+        return {'permutation': permutation, 'random_state': random_state, 'position': position,
+                'num_tokens': self._num_tokens, 'num_slots': self._num_slots}
+
+    def set_state(self, state):
+        """Restore a state of the generator (see state)."""
+        self._permutation = np.array(state['permutation'], dtype=np.int64)
+        assert len(self._permutation) == self._data_size, 'The state is of another data set'
+        self._random_state.set_state(state['random_state'])
+        self._num_tokens = state['num_tokens']
+        self._num_slots = state['num_slots']
+        if self._bucket_size or self._max_tokens:
+            self._batches = self._plan_epoch()
+            del self._batches[len(self._batches) - state['position']:]  # popped from the end
+        else:
+            self._position = state['position']
+
+    @property
+    def data_size(self):
+        """The number of samples."""
+        return self._data_size
+
+    @property
+    def padding_ratio(self):
+        """The proportion of paddings in the batches generated so far."""
+        if not self._num_slots:
+            return 0.
+        return 1. - self._num_tokens / self._num_slots
+
+
+class StreamBatchGenerator(object):
+    """
+    StreamBatchGenerator class creates a batch iterator for truncated back-propagation through time.
+
+    The samples are concatenated into one continuous stream of word IDs separated by the segment
+    ID, the stream is split into `batch_size` parallel streams, and fixed-length windows of
+    `num_steps` word IDs are generated from them in order. The RNN states at the end of a window
+    are meant to be used as the initial states of the next window, except when `reset_states` is
+    True (i.e. the window is the first one of a new epoch).
+
+    Basic Usage:
+        batch_generator = StreamBatchGenerator(X, 128, 100, segment_id=segment_char_id)
+
+        for X_batch, Y_batch, seq_lens in batch_generator:
+            if batch_generator.reset_states:
+                states = zero_states()
+            states = do_something_on_batch(X_batch, Y_batch, seq_lens, states)
+    """
+
+    def __init__(self, X, batch_size, num_steps, segment_id, shuffle=True, random_state=None):
+        """
+        Constructor
+
+        :param X: list of samples (list of lists of word_ids) or a tuple of (tokens, offsets)
+        :param batch_size: the number of parallel streams
+        :param num_steps: the number of time steps in a window
+        :param segment_id: ID of the character that represents a border between samples
+        :param shuffle: if True, shuffle the order of samples in every new epoch
+        :param random_state: seed (or np.random.RandomState) used for shuffling
+        """
+        assert batch_size > 0, 'batch_size <= 0'
+        assert num_steps > 0, 'num_steps <= 0'
+
+        if isinstance(X, tuple):
+            tokens, offsets = X
+        else:
+            assert isinstance(X, list), 'Invalid argument type type(X) = {}'.format(type(X))
+            tokens, offsets = flatten_samples(X)
+
+        self._tokens = tokens
+        self._offsets = offsets
+        self._data_size = len(offsets) - 1
+        self._batch_size = batch_size
+        self._num_steps = num_steps
+        self._segment_id = segment_id
+        self._shuffle = shuffle
+        self._random_state = (random_state if isinstance(random_state, np.random.RandomState)
+                              else np.random.RandomState(random_state))
+        self._stream = None
+        self._stream_random_state = None  # random state before building the current stream
+        self._window_id = 0
+        self._num_windows = 0
+        self._epoch = 0
+        self._reset_states = True
+        self._num_samples = 0
+
+        # each stream needs to have at least one window (+1 for the target of the last input)
+        assert len(tokens) + self._data_size + 1 >= batch_size * num_steps + 1, \
+            'The corpus is too small for batch_size * num_steps'
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        This is called everytime you iterate on this object.
+
+        :return: a batch of X, Y, and seq_lens (all the sequences are num_steps long)
+        """
+        self._reset_states = self._window_id == 0
+        if self._reset_states:
+            self._stream_random_state = self._random_state.get_state()
+            self._stream = self._build_stream()
+            self._epoch += 1
+
+        window = slice(self._window_id * self._num_steps, (self._window_id + 1) * self._num_steps)
+        X = self._stream[:, window]
+        Y = self._stream[:, window.start + 1: window.stop + 1]
+        self._window_id = (self._window_id + 1) % self._num_windows
+        self._num_samples = int(np.count_nonzero(Y == self._segment_id))
+
+        seq_lens = np.full(self._batch_size, self._num_steps, dtype=np.int32)
+        return X, Y, seq_lens
+
+    def _build_stream(self):
+        """Concatenate the (shuffled) samples into batch_size parallel streams."""
+        tokens, offsets = self._tokens, self._offsets
+        if self._shuffle and self._epoch > 0:
+            permutation = self._random_state.permutation(self._data_size)
+            tokens, offsets = select_samples(tokens, offsets, permutation)
+
+        # prepend the segment ID to every sample and append it to the end of the corpus
+        stream = np.insert(tokens, offsets[:-1], self._segment_id)
+        stream = np.append(stream, np.int32(self._segment_id)).astype(np.int32)
+
+        stream_len = (len(stream) - 1) // self._batch_size
+        self._num_windows = stream_len // self._num_steps
+        stream_len = self._num_windows * self._num_steps
+
+        # each row has one extra word ID at the end, which is the target of its last input
+        streams = np.empty((self._batch_size, stream_len + 1), dtype=np.int32)
+        for stream_id in range(self._batch_size):
+            start_index = stream_id * stream_len
+            streams[stream_id] = stream[start_index: start_index + stream_len + 1]
+        return streams
+
+    @property
+    def data_size(self):
+        """The number of samples."""
+        return self._data_size
+
+    @property
+    def state(self):
+        """
+        State of the generator after the last batch, from which set_state() resumes generating the
+        same batches (e.g. when resuming a training).
+        """
+        if self._window_id == 0:  # the next batch builds a new stream
+            return {'random_state': self._random_state.get_state(), 'epoch': self._epoch,
+                    'window_id': 0}
+        return {'random_state': self._stream_random_state, 'epoch': self._epoch,
+                'window_id': self._window_id}
+
+    def set_state(self, state):
+        """Restore a state of the generator (see state)."""
+        self._random_state.set_state(state['random_state'])
+        self._window_id = state['window_id']
+        if self._window_id:
+            # build the stream of the epoch again
+            self._epoch = state['epoch'] - 1
+            self._stream_random_state = state['random_state']
+            self._stream = self._build_stream()
+        self._epoch = state['epoch']
+
+    @property
+    def reset_states(self):
+        """True if the last window is the first one of an epoch (the states need to be reset)."""
+        return self._reset_states
+
+    @property
+    def num_samples(self):
+        """The number of samples that end in the last window."""
+        return self._num_samples
+
+    @property
+    def padding_ratio(self):
+        """The proportion of paddings in the batches generated so far (always 0)."""
+        return 0.
+
+
+class PrefetchIterator(object):
+    """
+    PrefetchIterator class wraps an iterator (e.g. BatchGenerator) and prepares its next `depth`
+    items in a background thread, such that preparing batches overlaps with training on them.
+
+    Attributes of the wrapped iterator listed in `attributes` are recorded along with every item,
+    and reading them from PrefetchIterator returns their values at the time the last consumed item
+    was produced (reading them from the wrapped iterator would return values of a later item).
+
+    Basic Usage:
+        batch_generator = PrefetchIterator(BatchGenerator(X, 128, segment_char_id), depth=2,
+                                           attributes=['padding_ratio'])
+
+        for X_batch, Y_batch, seq_lens in batch_generator:
+            do_something_on_batch(X_batch, Y_batch, seq_lens)
+            print(batch_generator.padding_ratio)
+        batch_generator.close()
+    """
+    _end = object()  # marks the end of the wrapped iterator
+    _put_timeout = 0.1  # seconds to wait before checking whether the iterator is closed
+
+    def __init__(self, iterator, depth=2, attributes=()):
+        """
+        :param iterator: iterator to prefetch items from
+        :param depth: the maximum number of items prepared in advance
+        :param attributes: names of the attributes of the iterator to record with every item
+        """
+        assert depth > 0, 'depth <= 0'
+        self._iterator = iterator
+        self._attributes = tuple(attributes)
+        self._values = {attribute: getattr(iterator, attribute) for attribute in attributes}
+        self._queue = queue.Queue(maxsize=depth)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._produce, name='PrefetchIterator', daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item, values, error = self._queue.get()
+        if error is not None:
+            raise error
+        if item is self._end:
+            raise StopIteration
+        self._values = values
+        return item
+
+    def __getattr__(self, name):
+        # only called when the attribute isn't found on PrefetchIterator itself
+        if name in self.__dict__.get('_attributes', ()):
+            return self._values[name]
+        raise AttributeError(name)
+
+    def _produce(self):
+        """Produce items into the queue until the iterator is exhausted or closed."""
+        try:
+            for item in self._iterator:
+                values = {attribute: getattr(self._iterator, attribute)
+                          for attribute in self._attributes}
+                if not self._put((item, values, None)):
+                    return
+            self._put((self._end, None, None))
+        except Exception as error:  # pass the error to the consumer
+            self._put((None, None, error))
+
+    def _put(self, element):
+        """Put an element into the queue, return False if the iterator gets closed meanwhile."""
+        while not self._closed.is_set():
+            try:
+                self._queue.put(element, timeout=self._put_timeout)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-            X_second = deepcopy(X[:end_index])
-            return X_first + X_second
+    def close(self):
+        """Stop the background thread."""
+        self._closed.set()
+        self._thread.join()
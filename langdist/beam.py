@@ -0,0 +1,117 @@
+# -*- coding: UTF-8 -*-
+"""
+Define beam search decoding over the states of a recurrent language model here.
+"""
+import numpy as np
+
+__author__ = 'kensk8er'
+
+
+def beam_search(step, probs, states, end_id, max_lens, beam_width=5, length_penalty=1.0,
+                n_best=1):
+    """
+    Find the most probable sequences for a batch of inputs by beam search.
+
+    Beams of all the inputs are kept in flat arrays (scores, histories and states), so every step
+    runs a single batched `step` call and reorders the states of the surviving beams by gathering
+    them. An input stops being decoded once it has n_best finished hypotheses which no active beam
+    can beat whatever it is extended by (early stopping, which never changes the result), or once
+    its beams reach max_lens.
+
+    The score of a finished hypothesis is its log probability (including the end of the sequence)
+    divided by its length (including the end) to the power of length_penalty.
+
+    :param step: function that receives IDs of shape [batch_size] and states of shape
+                 [num_layers, 2, batch_size, state_size], and returns probabilities over the IDs of
+                 shape [batch_size, vocab_size] and the next states
+    :param probs: probabilities of the first IDs, array of shape [input_num, vocab_size]
+    :param states: states of the inputs, array of shape [num_layers, 2, input_num, state_size]
+    :param end_id: ID that ends a sequence
+    :param max_lens: the maximum number of IDs to generate (int, or array of shape [input_num]),
+                     inputs whose max_lens is 0 or less get an empty hypothesis of score 0.
+    :param beam_width: the number of beams kept per input
+    :param length_penalty: exponent of the length normalisation (0. ranks by log probability)
+    :param n_best: the number of hypotheses returned per input
+    :return: list (per input) of lists of (IDs, score) sorted by score in descending order
+    """
+    input_num, vocab_size = probs.shape
+    assert vocab_size > 1, 'vocab_size <= 1'
+    assert 0 < n_best <= beam_width, 'n_best must be in [1, beam_width]'
+    candidate_num = min(2 * beam_width, beam_width * vocab_size)
+    max_lens = np.maximum(np.broadcast_to(np.asarray(max_lens, dtype=np.int64), (input_num,)), 0)
+    finished = [[([], 0.)] if max_len == 0 else list() for max_len in max_lens]
+
+    # only the first beam of each input is alive at the beginning
+    input_ids = np.flatnonzero(max_lens)  # inputs that are still decoded
+    scores = np.full((len(input_ids), beam_width), -np.inf)
+    scores[:, 0] = 0.
+    histories = np.zeros((len(input_ids), beam_width, 0), dtype=np.int64)
+    probs = np.repeat(probs[input_ids], beam_width, axis=0)
+    states = np.repeat(states[:, :, input_ids], beam_width, axis=2)
+
+    length = 0
+    while len(input_ids):
+        length += 1
+        row_num = len(input_ids)
+        rows = np.arange(row_num)[:, np.newaxis]
+
+        # scores of every (beam, ID) pair, keep the top candidates sorted by score
+        with np.errstate(divide='ignore'):
+            log_probs = np.log(probs).reshape(row_num, beam_width, vocab_size)
+        candidate_scores = (scores[:, :, np.newaxis] + log_probs).reshape(row_num, -1)
+        candidates = np.argpartition(-candidate_scores, candidate_num - 1, axis=1)
+        candidates = candidates[:, :candidate_num]
+        order = np.argsort(-candidate_scores[rows, candidates], axis=1, kind='stable')
+        candidates = candidates[rows, order]
+        candidate_scores = candidate_scores[rows, candidates]
+        origins, ids = np.divmod(candidates, vocab_size)
+
+        # hypotheses that end here, or that run out of the length
+        is_end = ids == end_id
+        out_of_len = length >= max_lens[input_ids]
+        is_finished = (is_end | out_of_len[:, np.newaxis]) & np.isfinite(candidate_scores)
+        normalizer = length ** length_penalty
+        for row_id, candidate_id in zip(*np.nonzero(is_finished)):
+            history = histories[row_id, origins[row_id, candidate_id]].tolist()
+            if not is_end[row_id, candidate_id]:
+                history.append(int(ids[row_id, candidate_id]))
+            finished[input_ids[row_id]].append(
+                (history, float(candidate_scores[row_id, candidate_id] / normalizer)))
+
+        # the best beam_width candidates that don't end (there are at least beam_width of them as
+        # each beam ends with a single ID only)
+        survivors = np.argsort(is_end, axis=1, kind='stable')[:, :beam_width]
+        scores = candidate_scores[rows, survivors]
+        origins = origins[rows, survivors]
+        histories = np.concatenate(
+            [histories[rows, origins], ids[rows, survivors][:, :, np.newaxis]], axis=2)
+        states = states[:, :, (rows * beam_width + origins).ravel()]
+
+        # stop decoding inputs whose n-th best hypothesis can't be beaten by any active beam: the
+        # log probability of a beam only decreases as it grows, so the best score it can reach is
+        # its log probability divided by the largest normalizer of the lengths it can end at
+        if length_penalty > 0:
+            bound_normalizers = max_lens[input_ids].astype(np.float64) ** length_penalty
+        else:
+            bound_normalizers = np.full(row_num, float(length + 1) ** length_penalty)
+        is_done = out_of_len.copy()
+        for row_id, input_id in enumerate(input_ids):
+            if is_done[row_id] or len(finished[input_id]) < n_best:
+                continue
+            nth_best_score = sorted(score for _, score in finished[input_id])[-n_best]
+            is_done[row_id] = scores[row_id, 0] / bound_normalizers[row_id] <= nth_best_score
+
+        if is_done.any():
+            keep_ids = np.nonzero(~is_done)[0]
+            input_ids = input_ids[keep_ids]
+            scores = scores[keep_ids]
+            histories = histories[keep_ids]
+            states = states[:, :, (keep_ids[:, np.newaxis] * beam_width +
+                                   np.arange(beam_width)).ravel()]
+            if not len(input_ids):
+                break
+
+        probs, states = step(histories[:, :, -1].ravel(), states)
+
+    return [sorted(hypotheses, key=lambda hypothesis: -hypothesis[1])[:n_best]
+            for hypotheses in finished]
@@ -0,0 +1,155 @@
+# -*- coding: UTF-8 -*-
+"""
+Content-addressed on-disk cache of encoded corpora and their train/validation splits, such that
+repeated trainings on the same corpus with the same encoder skip encoding and splitting.
+"""
+import hashlib
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from langdist.corpus import MmapCorpus, save_encoded_corpus
+from langdist.util import get_logger
+
+_LOGGER = get_logger(__name__)
+
+__author__ = 'kensk8er'
+
+_HASH_CHUNK_SIZE = 2 ** 20
+
+
+def hash_corpus(samples):
+    """
+    Return the hash of the content of a corpus.
+
+    :param samples: list of samples of characters or MmapCorpus
+    :return: hex digest
+    """
+    if isinstance(samples, MmapCorpus):
+        return hash_files([samples.corpus_path])
+
+    corpus_hash = hashlib.sha1()
+    for sample in samples:
+        corpus_hash.update(sample.encode('utf-8'))
+        corpus_hash.update(b'\0')  # separate samples such that ['ab'] != ['a', 'b']
+    return corpus_hash.hexdigest()
+
+
+def hash_files(paths):
+    """
+    Return the hash of the content of files (not their names), read in chunks.
+
+    :param paths: paths to the files, hashed in this order
+    :return: hex digest
+    """
+    files_hash = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as file_:
+            for chunk in iter(lambda: file_.read(_HASH_CHUNK_SIZE), b''):
+                files_hash.update(chunk)
+    return files_hash.hexdigest()
+
+
+class EncodedCorpusCache(object):
+    """
+    Cache of encoded corpora (flat character IDs and offsets) and their train/validation splits.
+
+    Each entry is a directory named after the hash of its key, holding the encoded corpus in the
+    binary corpus format (memory-mapped on loading) and the indices of the split. Entries are
+    evicted in least-recently-used order when the total size exceeds max_bytes.
+
+    Basic Usage:
+        cache = EncodedCorpusCache('~/.langdist/cache')
+        key = cache.make_key(hash_corpus(samples), encoder.fingerprint, valid_size, random_state)
+        entry = cache.get(key, encoder)
+        if entry is None:
+            entry = encode_and_split(samples)
+            cache.put(key, *entry, encoder)
+        char_ids, offsets, train_ids, valid_ids = entry
+    """
+    _corpus_file_name = 'corpus.ldc'
+    _split_file_name = 'split.npz'
+
+    def __init__(self, cache_dir, max_bytes):
+        """
+        :param cache_dir: path to the cache directory
+        :param max_bytes: the maximum total size of the cached entries in bytes
+        """
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def make_key(corpus_hash, encoder_fingerprint, valid_size, random_state):
+        """Return the cache key of a corpus encoded by an encoder and split in a specific way."""
+        key = '{}:{}:{!r}:{!r}'.format(corpus_hash, encoder_fingerprint, valid_size, random_state)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key, encoder):
+        """
+        Return the cached entry of the key, or None if it isn't cached.
+
+        :return: (char_ids, offsets, train_ids, valid_ids), char_ids and offsets are memory-mapped
+        """
+        entry_dir = os.path.join(self._cache_dir, key)
+        if not os.path.exists(entry_dir):
+            return None
+
+        corpus = MmapCorpus(os.path.join(entry_dir, self._corpus_file_name))
+        char_ids, offsets = corpus.encode(encoder)
+        with np.load(os.path.join(entry_dir, self._split_file_name)) as split:
+            train_ids, valid_ids = split['train_ids'], split['valid_ids']
+
+        os.utime(entry_dir)  # mark the entry as recently used
+        _LOGGER.info('Loaded the encoded corpus from the cache (key={}).'.format(key))
+        return char_ids, offsets, train_ids, valid_ids
+
+    def put(self, key, char_ids, offsets, train_ids, valid_ids, encoder):
+        """Cache an encoded corpus and its split, evicting old entries if necessary."""
+        entry_dir = os.path.join(self._cache_dir, key)
+        if os.path.exists(entry_dir):
+            return
+
+        # write into a temporary directory and rename it such that entries are never half-written
+        temp_dir = os.path.join(self._cache_dir, '.{}.{}'.format(key, uuid.uuid4().hex))
+        os.makedirs(temp_dir)
+        try:
+            save_encoded_corpus(
+                char_ids, offsets, os.path.join(temp_dir, self._corpus_file_name), encoder)
+            np.savez(os.path.join(temp_dir, self._split_file_name), train_ids=train_ids,
+                     valid_ids=valid_ids)
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            if not os.path.exists(entry_dir):  # it's fine if another process cached it already
+                raise
+
+        self._evict(keep_dir=entry_dir)
+
+    def _evict(self, keep_dir=None):
+        """
+        Remove least recently used entries until the total size is within max_bytes, except the
+        entry of keep_dir (e.g. the one just put, which can be older by mtime or larger than
+        max_bytes by itself).
+        """
+        entries = list()
+        for entry_name in os.listdir(self._cache_dir):
+            entry_dir = os.path.join(self._cache_dir, entry_name)
+            if entry_name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, file_name))
+                       for file_name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self._max_bytes:
+                break
+            if entry_dir == keep_dir:
+                continue
+            _LOGGER.info('Evict {} from the cache.'.format(entry_dir))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
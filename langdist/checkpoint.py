@@ -0,0 +1,166 @@
+# -*- coding: UTF-8 -*-
+"""
+Write checkpoints of a model in a background thread, such that saving a model doesn't block the
+training.
+
+Checkpoints are versioned directories in the checkpoints directory of a model:
+    <model_path>/checkpoints/ckpt-<step>/  (the files of a checkpoint, e.g. model.ckpt.* and
+                                            instance.pkl)
+    <model_path>/checkpoints/LATEST  (name of the latest checkpoint)
+    <model_path>/checkpoints/BEST  (name of the best checkpoint)
+
+A checkpoint is written into a temporary directory which is renamed once it's complete, and
+pointers are replaced atomically, so a crash never leaves a pointer to a partial checkpoint.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import time
+
+from langdist.util import get_logger
+
+_LOGGER = get_logger(__name__)
+
+__author__ = 'kensk8er'
+
+CHECKPOINTS_DIR = 'checkpoints'
+LATEST = 'LATEST'
+BEST = 'BEST'
+_CHECKPOINT_PREFIX = 'ckpt-'
+_TEMP_PREFIX = '.tmp-'
+
+
+class AsyncCheckpointer(object):
+    """
+    Write checkpoints in a background thread, keeping the last keep_num checkpoints (and the ones
+    pointed by LATEST and BEST).
+
+    Saving takes a snapshot in the calling thread (e.g. the values of the variables copied into
+    host memory) and returns while the snapshot is written. At most one snapshot is written at
+    once, so saving again while the previous write is running waits for it.
+
+    Basic Usage:
+        checkpointer = AsyncCheckpointer(model_path, write_checkpoint)
+        checkpointer.save(step, take_snapshot)  # write_checkpoint(path, take_snapshot()) runs later
+        checkpointer.close()  # wait for the last write
+    """
+
+    def __init__(self, model_path, write_checkpoint, keep_num=3):
+        """
+        :param model_path: path to the model directory
+        :param write_checkpoint: function that receives the path to a (new) directory and a
+                                 snapshot, and writes the checkpoint files into the directory
+        :param keep_num: the number of the latest checkpoints kept on the disk
+        """
+        assert keep_num > 0, 'keep_num must be positive'
+        self._checkpoints_path = os.path.join(model_path, CHECKPOINTS_DIR)
+        self._write_checkpoint = write_checkpoint
+        self._keep_num = keep_num
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = None
+        self.blocked_seconds = 0.
+        self.write_seconds = 0.
+        os.makedirs(self._checkpoints_path, exist_ok=True)
+
+    def save(self, step, take_snapshot, best=True):
+        """
+        Take a snapshot and write it as the checkpoint of the step in the background.
+
+        :param step: the training step of the checkpoint (e.g. the number of iterations)
+        :param take_snapshot: function that returns the snapshot to write
+        :param best: if True, point BEST to the checkpoint as well as LATEST
+        """
+        start_time = time.perf_counter()
+        self.wait()
+        snapshot = take_snapshot()
+        self._future = self._executor.submit(self._write, step, snapshot, best)
+        self.blocked_seconds += time.perf_counter() - start_time
+
+    def wait(self):
+        """Wait for the checkpoint being written (and raise its error if the write failed)."""
+        if self._future is not None:
+            future, self._future = self._future, None
+            future.result()
+
+    def close(self):
+        """Wait for the checkpoint being written and stop the background thread."""
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+        _LOGGER.info('Checkpointing blocked the training for {:.3f} sec in total, and wrote '
+                     'checkpoints for {:.3f} sec in the background.'
+                     .format(self.blocked_seconds, self.write_seconds))
+
+    def _write(self, step, snapshot, best):
+        """
+        Write a snapshot into a temporary directory, rename it and update the pointers. A
+        checkpoint of the same step (e.g. written before the training was resumed, which BEST may
+        point to) is only removed once the new one has replaced it.
+        """
+        start_time = time.perf_counter()
+        name = '{}{}'.format(_CHECKPOINT_PREFIX, step)
+        temp_path = os.path.join(self._checkpoints_path, '{}{}'.format(_TEMP_PREFIX, name))
+        old_path = '{}.old'.format(temp_path)
+        checkpoint_path = os.path.join(self._checkpoints_path, name)
+        for path in (temp_path, old_path):
+            if os.path.exists(path):  # left by an interrupted training
+                shutil.rmtree(path)
+
+        os.makedirs(temp_path)
+        self._write_checkpoint(temp_path, snapshot)
+        if os.path.exists(checkpoint_path):
+            os.rename(checkpoint_path, old_path)
+        os.rename(temp_path, checkpoint_path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        _write_pointer(self._checkpoints_path, LATEST, name)
+        if best:
+            _write_pointer(self._checkpoints_path, BEST, name)
+        self._evict()
+
+        seconds = time.perf_counter() - start_time
+        self.write_seconds += seconds
+        _LOGGER.info('Wrote the checkpoint {} in {:.3f} sec.'.format(checkpoint_path, seconds))
+
+    def _evict(self):
+        """Remove the checkpoints older than the last keep_num ones, except the pointed ones."""
+        pointed = {_read_pointer(self._checkpoints_path, pointer) for pointer in (LATEST, BEST)}
+        names = sorted((name for name in os.listdir(self._checkpoints_path)
+                        if name.startswith(_CHECKPOINT_PREFIX)),
+                       key=lambda name: int(name[len(_CHECKPOINT_PREFIX):]))
+        for name in names[:-self._keep_num]:
+            if name not in pointed:
+                shutil.rmtree(os.path.join(self._checkpoints_path, name))
+
+
+def get_checkpoint_path(model_path, pointer=BEST):
+    """
+    Return the path to the directory of the checkpoint a pointer points to, or model_path itself
+    for the models saved before checkpoints were versioned (whose files are in model_path).
+    """
+    checkpoints_path = os.path.join(model_path, CHECKPOINTS_DIR)
+    name = _read_pointer(checkpoints_path, pointer)
+    return os.path.join(checkpoints_path, name) if name else model_path
+
+
+def has_checkpoint(model_path, pointer=LATEST):
+    """Return True if the model directory has a checkpoint the pointer points to."""
+    return _read_pointer(os.path.join(model_path, CHECKPOINTS_DIR), pointer) is not None
+
+
+def _read_pointer(checkpoints_path, pointer):
+    """Return the name of the checkpoint a pointer points to (None if it doesn't exist)."""
+    try:
+        with open(os.path.join(checkpoints_path, pointer), 'r') as pointer_file:
+            return pointer_file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _write_pointer(checkpoints_path, pointer, name):
+    """Point a pointer to the checkpoint of the name atomically."""
+    temp_path = os.path.join(checkpoints_path, '{}{}'.format(_TEMP_PREFIX, pointer))
+    with open(temp_path, 'w') as pointer_file:
+        pointer_file.write(name)
+    os.replace(temp_path, os.path.join(checkpoints_path, pointer))
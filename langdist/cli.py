@@ -4,25 +4,40 @@ Command Line Interface (CLI) of langdist package.
 
 Usage:
     langdist download-bible <lang-code> <output-corpus-path> [options]
+    langdist preprocess <output-dir> <input-corpus-paths>... [--workers=<int>] [options]
     langdist transliterate <input-corpus-path> <lang-code> <output-corpus-path> [options]
-    langdist fit-encoder <encoder-path> <input-corpus-paths>... [options]
-    langdist train <input-corpus-path> <encoder-path> <model-path> [options]
-    langdist retrain <old-model-path> <input-corpus-path> <model-path> [options]
-    langdist generate <model-path> [--sample-num=<int>] [--prompts=<str>] [--top-k=<int>] [--max-len=<int>] [options]
+    langdist convert-corpus <input-corpus-path> <output-corpus-path> [--encoder=<str>] [options]
+    langdist fit-encoder <encoder-path> <input-corpus-paths>... [--base-encoder=<str>] [options]
+    langdist train <input-corpus-path> <encoder-path> <model-path> [--threads=<int>] [options]
+    langdist retrain <old-model-path> <input-corpus-path> <model-path> [--threads=<int>] [options]
+    langdist train-grid <grid-path> [--workers=<int>] [--threads=<int>] [options]
+    langdist generate <model-path> [--sample-num=<int>] [--prompts=<str>] [--top-k=<int>] [--top-p=<float>] [--temperature=<float>] [--seed=<int>] [--max-len=<int>] [--beam-width=<int>] [--n-best=<int>] [--length-penalty=<float>] [options]
+    langdist score <model-path> <input-corpus-paths>... [--output=<str>] [--batch-size=<int>] [options]
+    langdist distance-matrix <output-path> <input-corpus-paths>... --models=<str> [--cache-dir=<str>] [--workers=<int>] [--batch-size=<int>] [options]
+    langdist serve <model-path> [--host=<str>] [--port=<int>] [--max-batch-size=<int>] [--top-k=<int>] [--top-p=<float>] [--temperature=<float>] [--seed=<int>] [--timeout=<float>] [options]
     langdist -h | --help
     langdist -v | --version
 
 Commands:
     download-bible  Download a bible corpus from http://christos-c.com/bible/ and store it into a .pkl file after preprocessing
+    preprocess  Preprocess many bible XML corpora (or raw .txt corpora with a paragraph per line) in parallel and store each of them into a .pkl file in the output directory
     transliterate  Transliterate a corpus and store it into a .pkl file
+    convert-corpus  Convert a corpus (.pkl or .txt) into the binary corpus format (.ldc), which is memory-mapped when it's loaded
     fit-encoder  Fit an encoder on 1 or more corpora and save it to a .pkl file
     train  Train a language model from the scratch (monolingual model)
     retrain  Train a language model from another language model (bilingual model)
+    train-grid  Train a grid of models and models retrained on top of them (specified in a JSON file, see langdist.grid) in parallel, skipping finished models
     generate  Generate samples of characters using a trained model
+    score  Compute the perplexity of a trained model on 1 or more corpora (and the log probability of every text)
+    distance-matrix  Compute the perplexity of every model on every corpus in parallel and save the matrix into a .csv or .npy file
+    serve  Keep a trained model loaded and serve generation requests over HTTP (POST /generate, GET /metrics)
 
 Arguments:
-    input-corpus-path  path to the corpus file you want to process
-    output-corpus-path  path to where you save(d) the generated corpus 
+    input-corpus-path  path to the corpus file you want to process (.pkl, .txt with a sample per line, or .ldc)
+    output-corpus-path  path to where you save(d) the generated corpus (saved in the binary corpus format if it ends with .ldc)
+    grid-path  path to the JSON file which specifies the models to train (see langdist.grid for its format)
+    output-path  path to where you save the matrix of perplexities (.csv with the names of the models and corpora, or .npy)
+    output-dir  path to the directory where you save the preprocessed corpora
     encoder-path  path to where you save the fitted encoder
     lang-code  language code (2 characters) of the corpus you want to transliterate (e.g. ar, ja, zh)
     model-path  path to the model directory you where your model will be saved
@@ -35,6 +50,24 @@ Options:
     --log-path=<str>  If specified, log into the file at the path
     --verbose  Show debug messages
     
+    # runtime options for train/retrain/generate/score/serve commands
+    --intra-threads=<int>  The number of threads tensorflow uses to run an op in parallel (the number of CPUs in default, or the value saved with the model)
+    --inter-threads=<int>  The number of threads tensorflow uses to run independent ops in parallel (the number of CPUs in default, or the value saved with the model)
+    --xla  Compile the graph with XLA JIT
+    --autotune  Benchmark a few thread settings on a synthetic batch and use (and save with the model) the fastest one
+
+    # options for preprocess/distance-matrix/train-grid commands
+    --workers=<int>  The number of worker processes (the number of CPUs in default)
+
+    # options for train-grid command (and train/retrain commands with --data-parallel)
+    --threads=<int>  The number of threads used by each training or worker (CPUs divided by the number of workers in default)
+
+    # options for convert-corpus command
+    --encoder=<str>  If specified, store character IDs encoded by the encoder at the path instead of unicode codepoints
+
+    # options for fit-encoder command
+    --base-encoder=<str>  If specified, add the characters of the corpora to this encoder instead of fitting a new one
+
     # options for train command
     --embed-size=<int>  The number of dimensions of the character embedding layer [default: 128] 
     --rnn-size=<int>  The number of dimensions of the RNN layers [default: 256]
@@ -42,45 +75,97 @@ Options:
     --learning-rate=<float>  Initial learning rate of SGD (Adam Optimizer) [default: 0.001]
     --rnn-dropouts=<floats>  Keep probability of dropout in each RNN layer [default: 1.0,1.0]
     --final-dropout=<float>  Keep probability of dropout in the final fully connected layer [default: 1.0]
+    --softmax=<str>  Loss of the softmax layer minimised in training: full (exact softmax over the target vocabulary) or sampled (sampled softmax, for large vocabularies), evaluation always uses the exact softmax [default: full]
+    --num-sampled=<int>  The number of characters sampled per step by --softmax=sampled [default: 64]
+    --cell-type=<str>  Implementation of the LSTM cells: lstm, block (LSTMBlockCell) or fused (LSTMBlockFusedCell), whose checkpoints are interchangeable [default: lstm]
     
     # options for train/retrain commands
     --batch-size=<int>  The number of samples per batch [default: 128] 
     --patience=<int>  The number of iterations to keep training [default: 819200]
     --valid-size=<float>  The proportion of dataset to use for validation [default: 0.1] 
+    --valid-max-tokens=<int>  The maximum number of (padded) characters per validation batch, which bounds the memory used by validation [default: 65536]
+    --async-validation  Validate a snapshot of the model in a background thread while the training goes on
+    --resume  If the model directory has a checkpoint of an interrupted training, resume the training from it (with the same options) instead of starting over
+    --data-parallel=<int>  If specified, train with synchronous data-parallel SGD over this many worker processes, which split every batch of --batch-size samples between them (--stateful, --async-validation, --profile, --resume, --autotune, --intra-threads, --inter-threads and --xla aren't supported, and its checkpoints can't be resumed)
+    --lr-scaling=<str>  Scale the learning rate by the number of --data-parallel workers: linear, sqrt, or none (e.g. when --batch-size is increased with the workers) [default: none]
+    --keep-checkpoints=<int>  The number of the latest checkpoints kept in the model directory (the best one is always kept) [default: 3]
+    --bucket-size=<int>  If specified, batch samples of similar lengths together by sorting them within mega-batches of bucket-size * batch-size samples
+    --max-tokens=<int>  If specified, the maximum number of (padded) characters per batch (used instead of --batch-size)
+    --stateful  Train on --batch-size continuous streams of characters with truncated back-propagation through time, carrying the LSTM states between batches
+    --num-steps=<int>  The number of characters per stream in a batch when --stateful is set [default: 100]
     --profile  Profile the training (profile_train/valid.json will be created)
+    --prefetch=<int>  The number of batches prepared in a background thread during training (0 to disable) [default: 2]
+    --cache-dir=<str>  If specified, cache encoded corpora in the directory and reuse them in later trainings on the same corpus (distance-matrix caches the perplexities there as well)
+    --cache-size=<int>  The maximum size of the cache in MB (least recently used corpora are evicted) [default: 10240]
     
     # options for generate commands
     --sample-num=<int>  The number of texts to generate [default: 10]
     --prompts=<str>  The first characters which you generate texts from (if None start from empty texts)
     --top-k=<int>  Always sample from top k most probable characters. Set 0 to disable this behaviour. [default: 10]
+    --top-p=<float>  If specified, always sample from the smallest set of most probable characters whose cumulative probability is at least top-p (nucleus sampling)
+    --temperature=<float>  Sharpen (< 1.0) or flatten (> 1.0) the predicted distributions before sampling (0 always picks the most probable character) [default: 1.0]
+    --seed=<int>  If specified, the random seed used for sampling
     --max-len=<int>  The maximum length of characters to generate per text  [default: 300]
+    --beam-width=<int>  If specified, generate the most probable texts by beam search with this many beams instead of sampling
+    --n-best=<int>  The number of texts to output per prompt when --beam-width is set [default: 1]
+    --length-penalty=<float>  Exponent of the length normalisation of beam search scores (0 favours shorter texts) [default: 1.0]
+
+    # options for score command
+    --output=<str>  If specified, write the corpus path, the index, the log probability (nats) and the bits per character of every text into the file at the path (tab separated)
+
+    # options for distance-matrix command
+    --models=<str>  Comma-separated paths to the model directories
+
+    # options for serve command
+    --host=<str>  Host name to listen on [default: 127.0.0.1]
+    --port=<int>  Port number to listen on [default: 8000]
+    --max-batch-size=<int>  The maximum number of requests generated in a batch at once [default: 64]
+    --timeout=<float>  If specified, the maximum number of seconds to wait for a generated text
 
 Examples:
     langdist download-bible en en_corpus.pkl
+    langdist preprocess corpora en.xml fr.xml ja.xml.gz
     langdist transliterate ja_corpus.pkl ja transliterated_ja_corpus.pkl
+    langdist convert-corpus en_corpus.pkl en_corpus.ldc
     langdist fit-encoder encoder.pkl en_corpus.pkl ja_corpus.pkl zh_corpus.pkl ar_corpus.pkl
     langdist train en_corpus.pkl encoder.pkl en_model --patience=819200 --logpath=langdist.log
+    langdist train en_corpus.pkl encoder.pkl en_model --intra-threads=16 --inter-threads=2
+    langdist train en_corpus.pkl encoder.pkl en_model --data-parallel=4 --batch-size=512 --lr-scaling=sqrt
     langdist retrain en_model encoder.pkl fr_corpus.pkl en2fr_model --patience=819200 --logpath=langdist.log
+    langdist train-grid grid.json --workers=8
     langdist generate en2fr_model --sample-num=50
+    langdist score en_model fr_corpus.txt de_corpus.pkl --output=scores.tsv
+    langdist distance-matrix distances.csv en.pkl fr.pkl ja.pkl --models=en_model,fr_model,ja_model --cache-dir=~/.langdist/cache
+    langdist serve en2fr_model --port=8000 --max-batch-size=64
 
 """
 import json
+from math import log
 import os
 import shutil
 import logging
 import pickle
 from urllib.request import urlretrieve
 
-from docopt import docopt
+from docopt import DocoptExit, docopt
 
-from langdist import __version__
+from langdist import __version__, corpus, grid
+from langdist.checkpoint import has_checkpoint
 from langdist.constant import LANG_CODE2LANGUAGE
-from langdist.util import get_logger, set_default_log_path, set_default_log_level, set_log_level, \
-    set_log_path
-from langdist.preprocess import preprocess_corpus
+from langdist.util import compute_perplexity, get_logger, set_default_log_path, \
+    set_default_log_level, set_log_level, set_log_path
+from langdist.preprocess import preprocess_corpora, preprocess_corpus
+from langdist.runtime import SessionConfig
 
 _BIBLE_CORPUS_URL = 'https://raw.githubusercontent.com/christos-c/bible-corpus/master/bibles/{}.xml'
 _HOME_DIR = '~/'
+# arguments of CharLSTM.train() supported by data-parallel training
+_DATA_PARALLEL_TRAIN_ARGS = ('batch_size', 'patience', 'valid_size', 'valid_max_tokens',
+                             'bucket_size', 'max_tokens', 'cache_dir', 'cache_size',
+                             'keep_checkpoints')
+# options not supported by data-parallel training (workers run with --threads threads each)
+_DATA_PARALLEL_UNSUPPORTED_OPTIONS = ('--stateful', '--async-validation', '--profile', '--resume',
+                                      '--autotune', '--intra-threads', '--inter-threads', '--xla')
 
 _LOGGER = get_logger(__name__)
 
@@ -112,20 +197,38 @@ def transliterate(input_corpus_path, lang_code, transliterated_corpus_path):
     that is supported by `langdist.transliterator` module.
     """
     from langdist.transliterator import get_transliterator  # import locally because it's slow
-    with open(input_corpus_path, 'rb') as input_corpus_file:
-        input_corpus = pickle.load(input_corpus_file)
     transliterator = get_transliterator(lang_code)
-    transliterated_corpus = transliterator.transliterate_corpus(input_corpus)
-    with open(transliterated_corpus_path, 'wb') as transliterated_corpus_file:
-        pickle.dump(transliterated_corpus, transliterated_corpus_file)
+    transliterated_corpus = (transliterator.transliterate(sample)
+                             for sample in corpus.iter_corpus(input_corpus_path))
+    corpus.dump_corpus(transliterated_corpus, transliterated_corpus_path)
+
 
+def convert_corpus(input_corpus_path, output_corpus_path, encoder_path=None):
+    """Convert a corpus into the binary corpus format (character IDs if encoder_path is given)."""
+    encoder = None
+    if encoder_path:
+        with open(encoder_path, 'rb') as encoder_file:
+            encoder = pickle.load(encoder_file)
+    corpus.convert_corpus(input_corpus_path, output_corpus_path, encoder)
 
-def fit_encoder(input_corpus_paths, encoder_path):
+
+def fit_encoder(input_corpus_paths, encoder_path, base_encoder_path=None):
     """
-    Fit an encoder on the corpora given and save it into a pickle file.
+    Fit an encoder on the corpora given and save it into a pickle file. If base_encoder_path is
+    given, the encoder at the path is fit incrementally to the corpora instead of a new encoder.
     """
     from langdist import encoder  # import locally because it's slow to import
-    encoder.fit_encoder(input_corpus_paths, encoder_path)
+    base_encoder = None
+    if base_encoder_path:
+        with open(base_encoder_path, 'rb') as encoder_file:
+            base_encoder = pickle.load(encoder_file)
+
+    fitted_encoder = encoder.fit_encoder(input_corpus_paths, encoder_path, base_encoder)
+    char_counts = fitted_encoder.char_counts
+    _LOGGER.info('Fitted the encoder on {:,} characters, vocab_size={:,}'
+                 .format(sum(char_counts.values()), fitted_encoder.vocab_size))
+    _LOGGER.debug('Character counts:\n{}'.format(
+        '\n'.join('{!r}\t{}'.format(char, count) for char, count in char_counts.most_common())))
 
 
 def train(init_args, train_args):
@@ -135,22 +238,103 @@ def train(init_args, train_args):
     char_lstm.train(**train_args)
 
 
-def retrain(old_model_path, train_args):
+def retrain(old_model_path, train_args, load_args=None):
     """Train a language model on top of the given language model."""
     from langdist.langmodel import CharLSTM  # import locally because it's slow to import
-    char_lstm = CharLSTM.load(old_model_path)
+    char_lstm = CharLSTM.load(old_model_path, **(load_args or {}))
     char_lstm.train(**train_args)
 
 
-def generate(model_path, sample_num, prompts, top_k, max_len):
+def resume(train_args, load_args=None):
+    """Resume an interrupted training from the latest checkpoint of the model."""
+    from langdist.langmodel import CharLSTM  # import locally because it's slow to import
+    char_lstm = CharLSTM.load(train_args['model_path'], resume=True, **(load_args or {}))
+    char_lstm.train(resume=True, **train_args)
+
+
+def train_data_parallel(samples_path, model_path, num_workers, train_args, init_args=None,
+                        base_model_path=None, threads_per_worker=None,
+                        learning_rate_scaling='none'):
+    """Train a language model with data-parallel worker processes."""
+    from langdist.distributed import train_data_parallel as train_parallel
+    train_parallel(samples_path, model_path, num_workers, init_args, base_model_path,
+                   threads_per_worker, learning_rate_scaling, **train_args)
+
+
+def train_grid(grid_path, num_workers=None, threads_per_job=None):
+    """Train a grid of language models in parallel."""
+    failed_jobs = grid.train_grid(grid_path, num_workers, threads_per_job)
+    if failed_jobs:
+        raise SystemExit(1)
+
+
+def generate(model_path, sample_num, prompts, top_k, max_len, top_p=None, temperature=1.0,
+             seed=None, beam_width=None, n_best=1, length_penalty=1.0, load_args=None):
     """Generate texts using a trained language model."""
     from langdist.langmodel import CharLSTM  # import locally because it's slow to import
-    char_lstm = CharLSTM.load(model_path)
-    texts = char_lstm.generate(sample_num=sample_num, prompts=prompts, pick_top_k=top_k,
-                               max_char_len=max_len)
+    char_lstm = CharLSTM.load(model_path, **(load_args or {}))
+    if beam_width:
+        results = char_lstm.beam_search(prompts=prompts, sample_num=sample_num,
+                                        beam_width=beam_width, max_char_len=max_len,
+                                        length_penalty=length_penalty, n_best=n_best)
+        texts = [text for hypotheses in results for text, _ in hypotheses]
+    else:
+        texts = char_lstm.generate(sample_num=sample_num, prompts=prompts, pick_top_k=top_k,
+                                   max_char_len=max_len, top_p=top_p, temperature=temperature,
+                                   random_state=seed)
     print('\n'.join(texts))
 
 
+def score(model_path, input_corpus_paths, batch_size, output_path=None, load_args=None):
+    """Compute the perplexity of a trained language model on each of the corpora."""
+    from langdist.langmodel import CharLSTM  # import locally because it's slow to import
+    char_lstm = CharLSTM.load(model_path, **(load_args or {}))
+    output_file = open(output_path, 'w') if output_path else None
+    try:
+        for input_corpus_path in input_corpus_paths:
+            log_prob_sum = 0.
+            char_num_sum = 0
+            out_of_vocab_num = 0
+            scores = char_lstm.iter_scores(corpus.iter_corpus(input_corpus_path), batch_size)
+            for text_id, (log_prob, char_num) in enumerate(scores):
+                if log_prob == float('-inf'):
+                    out_of_vocab_num += 1
+                else:
+                    log_prob_sum += log_prob
+                    char_num_sum += char_num
+                if output_file:
+                    output_file.write('{}\t{}\t{}\t{}\n'.format(
+                        input_corpus_path, text_id, log_prob, -log_prob / log(2) / char_num))
+
+            if out_of_vocab_num:
+                _LOGGER.warning('{:,} texts of {} contain characters unknown to the encoder or out '
+                                'of the vocabulary of the model and are excluded from the '
+                                'perplexity.'
+                                .format(out_of_vocab_num, input_corpus_path))
+            perplexity = compute_perplexity(log_prob_sum, char_num_sum)  # nan if all excluded
+            print('{}\tperplexity={:.4f}\tbits_per_char={:.4f}'.format(
+                input_corpus_path, perplexity, log(perplexity) / log(2)))
+    finally:
+        if output_file:
+            output_file.close()
+
+
+def distance_matrix(output_path, input_corpus_paths, model_paths, cache_dir=None, num_workers=None,
+                    batch_size=128):
+    """Compute the perplexity of every model on every corpus and save the matrix."""
+    from langdist.distance import compute_distance_matrix  # import locally because it's slow
+    compute_distance_matrix(model_paths, input_corpus_paths, output_path, cache_dir, num_workers,
+                            batch_size)
+
+
+def serve(model_path, host, port, max_batch_size, top_k, top_p=None, temperature=1.0, seed=None,
+          timeout=None, load_args=None):
+    """Serve generation requests over HTTP using a trained language model."""
+    from langdist.server import serve as serve_model  # import locally because it's slow to import
+    serve_model(model_path, host, port, max_batch_size, top_k, top_p, temperature, seed, timeout,
+                load_args)
+
+
 def _get_init_args(args):
     """Construct argument dict for CharLSTM.__init__() from args and return it."""
     with open(args['<encoder-path>'], 'rb') as encoder_file:
@@ -159,16 +343,47 @@ def _get_init_args(args):
             'num_rnn_layers': int(args['--num-layers']),
             'learning_rate': float(args['--learning-rate']),
             'rnn_dropouts': [float(dropout) for dropout in args['--rnn-dropouts'].split(',')],
-            'final_dropout': float(args['--final-dropout']), 'encoder': encoder}
+            'final_dropout': float(args['--final-dropout']), 'encoder': encoder,
+            'session_config': _get_session_config(args), 'cell_type': args['--cell-type'],
+            'softmax_loss': args['--softmax'], 'num_sampled': int(args['--num-sampled'])}
+
+
+def _get_session_config(args):
+    """Construct SessionConfig from args and return it (None if no runtime option is given)."""
+    if not (args['--intra-threads'] or args['--inter-threads'] or args['--xla']):
+        return None
+    return SessionConfig(intra_op_threads=int(args['--intra-threads'] or 0),
+                         inter_op_threads=int(args['--inter-threads'] or 0), xla=args['--xla'])
 
 
-def _get_train_args(args):
+def _get_load_args(args):
+    """Construct argument dict for CharLSTM.load() from args and return it."""
+    return {'session_config': _get_session_config(args), 'autotune': args['--autotune']}
+
+
+def _get_train_args(args, load_samples=True):
     """Construct argument dict for CharLSTM.train() from args and return it."""
-    with open(args['<input-corpus-path>'], 'rb') as input_corpus_file:
-        samples = pickle.load(input_corpus_file)
+    samples = corpus.load_corpus(args['<input-corpus-path>']) if load_samples else None
     return {'samples': samples, 'model_path': args['<model-path>'],
             'batch_size': int(args['--batch-size']), 'patience': int(args['--patience']),
-            'valid_size': float(args['--valid-size']), 'profile': args['--profile']}
+            'valid_size': float(args['--valid-size']), 'profile': args['--profile'],
+            'bucket_size': int(args['--bucket-size']) if args['--bucket-size'] else None,
+            'max_tokens': int(args['--max-tokens']) if args['--max-tokens'] else None,
+            'stateful': args['--stateful'], 'num_steps': int(args['--num-steps']),
+            'cache_dir': args['--cache-dir'], 'cache_size': int(args['--cache-size']) * 2 ** 20,
+            'prefetch': int(args['--prefetch']),
+            'valid_max_tokens': int(args['--valid-max-tokens']),
+            'async_validation': args['--async-validation'],
+            'keep_checkpoints': int(args['--keep-checkpoints'])}
+
+
+def _check_data_parallel_args(args):
+    """Exit with the usage if options not supported by data-parallel training are given."""
+    unsupported_options = [option for option in _DATA_PARALLEL_UNSUPPORTED_OPTIONS
+                           if args[option]]
+    if unsupported_options:
+        raise DocoptExit('{} can\'t be used with --data-parallel.'
+                         .format(', '.join(unsupported_options)))
 
 
 def _expand_user_path(args):
@@ -199,32 +414,92 @@ def main():
         download_bible(args['<lang-code>'], args['<output-corpus-path>'])
         return
 
+    if args['preprocess']:
+        preprocess_corpora(args['<input-corpus-paths>'], args['<output-dir>'],
+                           int(args['--workers']) if args['--workers'] else None)
+        return
+
     if args['transliterate']:
         transliterate(args['<input-corpus-path>'], args['<lang-code>'],
                       args['<output-corpus-path>'])
         return
 
+    if args['convert-corpus']:
+        convert_corpus(args['<input-corpus-path>'], args['<output-corpus-path>'],
+                       args['--encoder'])
+        return
+
     if args['fit-encoder']:
-        fit_encoder(args['<input-corpus-paths>'], args['<encoder-path>'])
+        fit_encoder(args['<input-corpus-paths>'], args['<encoder-path>'], args['--base-encoder'])
+        return
+
+    if args['train-grid']:
+        train_grid(args['<grid-path>'], int(args['--workers']) if args['--workers'] else None,
+                   int(args['--threads']) if args['--threads'] else None)
         return
 
     if args['generate']:
         generate(args['<model-path>'], int(args['--sample-num']), args['--prompts'],
-                 int(args['--top-k']), int(args['--max-len']))
+                 int(args['--top-k']), int(args['--max-len']),
+                 float(args['--top-p']) if args['--top-p'] else None,
+                 float(args['--temperature']), int(args['--seed']) if args['--seed'] else None,
+                 int(args['--beam-width']) if args['--beam-width'] else None,
+                 int(args['--n-best']), float(args['--length-penalty']), _get_load_args(args))
+        return
+
+    if args['score']:
+        score(args['<model-path>'], args['<input-corpus-paths>'], int(args['--batch-size']),
+              args['--output'], _get_load_args(args))
+        return
+
+    if args['distance-matrix']:
+        distance_matrix(args['<output-path>'], args['<input-corpus-paths>'],
+                        args['--models'].split(','), args['--cache-dir'],
+                        int(args['--workers']) if args['--workers'] else None,
+                        int(args['--batch-size']))
+        return
+
+    if args['serve']:
+        serve(args['<model-path>'], args['--host'], int(args['--port']),
+              int(args['--max-batch-size']), int(args['--top-k']),
+              float(args['--top-p']) if args['--top-p'] else None, float(args['--temperature']),
+              int(args['--seed']) if args['--seed'] else None,
+              float(args['--timeout']) if args['--timeout'] else None, _get_load_args(args))
+        return
+
+    if args['--data-parallel']:
+        _check_data_parallel_args(args)
+
+        # the corpus is loaded by the workers
+        train_args = _get_train_args(args, load_samples=False)
+        model_path = train_args['model_path']
+        if os.path.exists(model_path):
+            shutil.rmtree(model_path)
+        train_data_parallel(
+            args['<input-corpus-path>'], model_path, int(args['--data-parallel']),
+            {key: train_args[key] for key in _DATA_PARALLEL_TRAIN_ARGS},
+            _get_init_args(args) if args['train'] else None,
+            args['<old-model-path>'] if args['retrain'] else None,
+            int(args['--threads']) if args['--threads'] else None, args['--lr-scaling'])
         return
 
     # set arguments for __init__() and train()
     train_args = _get_train_args(args)
 
+    if args['--resume'] and has_checkpoint(train_args['model_path']):
+        resume(train_args, _get_load_args(args))
+        return
+
     # remove the model file if already exists
     if os.path.exists(train_args['model_path']):
         shutil.rmtree(train_args['model_path'])
 
     if args['train']:
         init_args = _get_init_args(args)
+        train_args['autotune'] = args['--autotune']
         train(init_args, train_args)
     elif args['retrain']:
-        retrain(args['<old-model-path>'], train_args)
+        retrain(args['<old-model-path>'], train_args, _get_load_args(args))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,295 @@
+# -*- coding: UTF-8 -*-
+"""
+Read and write corpora. Besides pickled lists of samples (.pkl) and raw text files with a sample per
+line (.txt), corpora can be stored in a compact binary format that is memory-mapped on loading.
+
+The binary format consists of:
+    1. magic bytes (8 bytes)
+    2. the length of the header (uint64, little endian)
+    3. JSON header (padded such that the arrays below are 8-byte aligned)
+    4. offsets (int64[num_samples + 1]), the i-th sample is tokens[offsets[i]: offsets[i + 1]]
+    5. tokens, either unicode codepoints (uint32) or character IDs (int32) of an encoder
+"""
+from itertools import islice
+import json
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+__author__ = 'kensk8er'
+
+BINARY_CORPUS_EXTENSION = '.ldc'
+CODEPOINTS = 'codepoints'  # tokens are unicode codepoints (independent of encoders)
+CHAR_IDS = 'char_ids'  # tokens are character IDs of an encoder
+
+_MAGIC = b'LDCORPUS'
+_FORMAT_VERSION = 1
+_OFFSET_DTYPE = '<i8'
+_TOKEN_DTYPES = {CODEPOINTS: '<u4', CHAR_IDS: '<i4'}
+_ALIGNMENT = 8
+_RAW_CORPUS_EXTENSION = '.txt'
+
+# the umask can only be read by setting it, so read it once on import (rather than on every write,
+# which would change it for a moment while other threads may be creating files)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class MmapCorpus(object):
+    """
+    Corpus stored in the binary format, whose offsets and tokens are memory-mapped (i.e. read
+    lazily from the disk without copying them into memory).
+
+    Basic Usage:
+        corpus = MmapCorpus('en.ldc')
+        for sample in corpus:  # str for codepoints corpora, array of IDs for char_ids corpora
+            do_something(sample)
+    """
+
+    def __init__(self, corpus_path):
+        self._corpus_path = corpus_path
+        with open(corpus_path, 'rb') as corpus_file:
+            header, data_offset = _read_header(corpus_file)
+
+        assert header['version'] <= _FORMAT_VERSION, \
+            'Unsupported corpus format version: {}'.format(header['version'])
+        self._token_type = header['token_type']
+        self._encoder_fingerprint = header.get('encoder_fingerprint')
+        num_samples = header['num_samples']
+        num_tokens = header['num_tokens']
+
+        self._offsets = np.memmap(corpus_path, dtype=_OFFSET_DTYPE, mode='r', offset=data_offset,
+                                  shape=(num_samples + 1,))
+        tokens_offset = data_offset + self._offsets.nbytes
+        if num_tokens:
+            self._tokens = np.memmap(corpus_path, dtype=_TOKEN_DTYPES[self._token_type],
+                                     mode='r', offset=tokens_offset, shape=(num_tokens,))
+        else:  # memmap can't map an empty array
+            self._tokens = np.zeros(0, dtype=_TOKEN_DTYPES[self._token_type])
+
+    @staticmethod
+    def is_mmap_corpus(corpus_path):
+        """True if the file at the path is a corpus in the binary format."""
+        with open(corpus_path, 'rb') as corpus_file:
+            return corpus_file.read(len(_MAGIC)) == _MAGIC
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        tokens = self._tokens[self._offsets[index]: self._offsets[index + 1]]
+        if self._token_type == CODEPOINTS:
+            return tokens.tobytes().decode('utf-32-le')
+        return tokens
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def encode(self, encoder):
+        """
+        Return the character IDs and offsets of the corpus for the given encoder. The memory-mapped
+        arrays are returned as they are (zero copy) if the corpus is already encoded by the encoder.
+
+        :param encoder: fitted CharEncoder
+        :return: (char_ids, offsets)
+        """
+        if self._token_type == CHAR_IDS:
+            assert self._encoder_fingerprint == encoder.fingerprint, \
+                'The corpus was encoded by a different encoder'
+            return self._tokens, self._offsets
+        return encoder.encode_codepoints(self._tokens), self._offsets
+
+    def fit_encoder(self, encoder):
+        """Fit the encoder incrementally to the characters of the corpus."""
+        assert self._token_type == CODEPOINTS, 'Only codepoints corpora can be used to fit encoders'
+        encoder.partial_fit_codepoints(self._tokens, sample_num=len(self))
+
+    @property
+    def tokens(self):
+        """Flat (memory-mapped) array of tokens."""
+        return self._tokens
+
+    @property
+    def offsets(self):
+        """(Memory-mapped) offsets of the samples in tokens."""
+        return self._offsets
+
+    @property
+    def token_type(self):
+        """Type of the tokens, CODEPOINTS or CHAR_IDS."""
+        return self._token_type
+
+    @property
+    def encoder_fingerprint(self):
+        """Fingerprint of the encoder that encoded the corpus (None for codepoints corpora)."""
+        return self._encoder_fingerprint
+
+    @property
+    def corpus_path(self):
+        """Path to the corpus file."""
+        return self._corpus_path
+
+
+def save_corpus(samples, corpus_path):
+    """
+    Save samples of characters into a corpus in the binary format (codepoints). Samples are written
+    one by one, so any iterable (e.g. a generator reading a file) works.
+
+    :param samples: samples of characters (e.g. sentences)
+    :param corpus_path: path to the corpus file to save
+    """
+    lengths = list()
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(corpus_path))) as tokens_file:
+        for sample in samples:
+            tokens_file.write(sample.encode('utf-32-le'))
+            lengths.append(len(sample))
+
+        offsets = np.zeros(len(lengths) + 1, dtype=_OFFSET_DTYPE)
+        np.cumsum(lengths, out=offsets[1:])
+        tokens_file.seek(0)
+        _write_corpus(corpus_path, CODEPOINTS, offsets, tokens_file)
+
+
+def save_encoded_corpus(char_ids, offsets, corpus_path, encoder):
+    """
+    Save a corpus encoded by the encoder (flat array of character IDs and offsets) in the binary
+    format.
+
+    :param char_ids: flat array of character IDs
+    :param offsets: offsets of the samples in char_ids
+    :param corpus_path: path to the corpus file to save
+    :param encoder: CharEncoder that encoded the corpus
+    """
+    _write_corpus(corpus_path, CHAR_IDS, np.asarray(offsets, dtype=_OFFSET_DTYPE),
+                  np.asarray(char_ids, dtype=_TOKEN_DTYPES[CHAR_IDS]), encoder.fingerprint)
+
+
+def _write_corpus(corpus_path, token_type, offsets, tokens, encoder_fingerprint=None):
+    """Write a corpus file (tokens is either an array or a file object of the token bytes)."""
+    num_tokens = int(offsets[-1])
+    header = {'version': _FORMAT_VERSION, 'token_type': token_type,
+              'num_samples': len(offsets) - 1, 'num_tokens': num_tokens,
+              'encoder_fingerprint': encoder_fingerprint}
+    header = json.dumps(header).encode('utf-8')
+    header_offset = len(_MAGIC) + 8
+    header += b' ' * (-(header_offset + len(header)) % _ALIGNMENT)
+
+    # write to a temporary file (unique per writer) first such that a corpus file is never left
+    # half-written, even when several processes write the same corpus at once
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(corpus_path)),
+        prefix='.{}.'.format(os.path.basename(corpus_path)), suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as corpus_file:
+            corpus_file.write(_MAGIC)
+            corpus_file.write(struct.pack('<Q', len(header)))
+            corpus_file.write(header)
+            corpus_file.write(offsets.tobytes())
+            if isinstance(tokens, np.ndarray):
+                corpus_file.write(tokens.tobytes())
+            else:
+                shutil.copyfileobj(tokens, corpus_file)
+        os.chmod(temp_path, 0o666 & ~_UMASK)  # mkstemp creates the file readable by the owner only
+        os.replace(temp_path, corpus_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _read_header(corpus_file):
+    """Read the header of a corpus file and return it with the offset of the data."""
+    assert corpus_file.read(len(_MAGIC)) == _MAGIC, 'Not a corpus in the binary format'
+    header_len = struct.unpack('<Q', corpus_file.read(8))[0]
+    header = json.loads(corpus_file.read(header_len).decode('utf-8'))
+    return header, len(_MAGIC) + 8 + header_len
+
+
+def load_corpus(corpus_path):
+    """
+    Load a corpus. Corpora in the binary format are memory-mapped (MmapCorpus), .txt corpora are
+    read as a list of lines, and the other corpora are unpickled.
+
+    :param corpus_path: path to the corpus
+    :return: MmapCorpus or list of samples
+    """
+    if MmapCorpus.is_mmap_corpus(corpus_path):
+        return MmapCorpus(corpus_path)
+    return list(iter_corpus(corpus_path))
+
+
+def iter_corpus(corpus_path):
+    """Yield samples of a corpus in any format (.txt files are streamed line by line)."""
+    if MmapCorpus.is_mmap_corpus(corpus_path):
+        yield from MmapCorpus(corpus_path)
+    elif corpus_path.endswith(_RAW_CORPUS_EXTENSION):
+        with open(corpus_path, 'r', encoding='utf-8') as corpus_file:
+            for line in corpus_file:
+                yield line.rstrip('\n')
+    else:
+        with open(corpus_path, 'rb') as corpus_file:
+            yield from pickle.load(corpus_file)
+
+
+def iter_encoded_chunks(samples, encoder, chunk_size):
+    """
+    Encode samples chunk by chunk, such that samples streamed from a file are never held in memory
+    at once. Characters unknown to the encoder are encoded into -1.
+
+    :param samples: iterable of samples of characters, or MmapCorpus (character IDs stored in it are
+                    used without copying them if they are encoded by the encoder)
+    :param encoder: CharEncoder
+    :param chunk_size: the number of samples per chunk
+    :return: generator of (tokens, offsets) of every chunk
+    """
+    if isinstance(samples, MmapCorpus):
+        if samples.token_type == CHAR_IDS:
+            tokens, offsets = samples.encode(encoder)  # raises if encoded by another encoder
+        else:
+            tokens, offsets = samples.tokens, samples.offsets
+        for start_index in range(0, len(samples), chunk_size):
+            end_index = min(start_index + chunk_size, len(samples))
+            chunk_tokens = tokens[offsets[start_index]: offsets[end_index]]
+            if samples.token_type == CHAR_IDS:
+                chunk_tokens = np.asarray(chunk_tokens)
+            else:
+                chunk_tokens = encoder.encode_codepoints(chunk_tokens, unknown_id=-1)
+            yield (chunk_tokens,
+                   np.asarray(offsets[start_index: end_index + 1]) - offsets[start_index])
+        return
+
+    samples = iter(samples)
+    while True:
+        chunk = list(islice(samples, chunk_size))
+        if not chunk:
+            return
+        yield encoder.encode_flat(chunk, unknown_id=-1)
+
+
+def dump_corpus(samples, corpus_path):
+    """Save samples into the binary format if the path ends with .ldc, else into a pickle file."""
+    if corpus_path.endswith(BINARY_CORPUS_EXTENSION):
+        save_corpus(samples, corpus_path)
+    else:
+        with open(corpus_path, 'wb') as corpus_file:
+            pickle.dump(list(samples), corpus_file)
+
+
+def convert_corpus(input_corpus_path, output_corpus_path, encoder=None):
+    """
+    Convert a corpus (.pkl or .txt) into the binary format.
+
+    :param input_corpus_path: path to the corpus to convert
+    :param output_corpus_path: path to the corpus file in the binary format
+    :param encoder: if given, store character IDs encoded by the encoder instead of codepoints
+    """
+    if encoder:
+        char_ids, offsets = encoder.encode_flat(iter_corpus(input_corpus_path))
+        save_encoded_corpus(char_ids, offsets, output_corpus_path, encoder)
+    else:
+        save_corpus(iter_corpus(input_corpus_path), output_corpus_path)
@@ -0,0 +1,236 @@
+# -*- coding: UTF-8 -*-
+"""
+Compute the matrix of perplexities of many language models on many corpora, which measures the
+distance between the languages of the models and the languages of the corpora.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+from langdist.batch import find_known_samples, select_samples
+from langdist.cache import hash_files
+from langdist.checkpoint import get_checkpoint_path
+from langdist.corpus import MmapCorpus, iter_corpus, iter_encoded_chunks, save_encoded_corpus
+from langdist.util import compute_perplexity, get_logger
+
+_LOGGER = get_logger(__name__)
+
+__author__ = 'kensk8er'
+
+_ENCODE_CHUNK_SIZE = 100000  # the number of texts encoded at once
+_ENCODED_DIR = 'encoded'
+_SCORES_DIR = 'scores'
+
+
+def compute_distance_matrix(model_paths, corpus_paths, output_path=None, cache_dir=None,
+                            num_workers=None, batch_size=128):
+    """
+    Compute the perplexity of every model on every corpus.
+
+    Every corpus is encoded once per encoder (models sharing an encoder share the encoded corpus),
+    and every model is loaded once by a worker process which scores all the corpora it hasn't
+    been scored on yet. Scores are cached in cache_dir per (model checkpoint, corpus) such that
+    adding a model or a corpus only computes its row or column.
+
+    Texts with characters unknown to the encoder of a model (or out of the vocabulary the model
+    was trained on) are excluded from the perplexity of the model on the corpus. The ratio of the
+    excluded texts is saved along with the matrix, and the perplexity is nan if all the texts of
+    the corpus are excluded.
+
+    :param model_paths: paths to the model directories
+    :param corpus_paths: paths to the corpora (.pkl, .txt with a sample per line, or .ldc)
+    :param output_path: if given, save the matrix to the path (.csv with the names of models and
+                        corpora, or .npy), and the ratios of excluded texts to the path suffixed
+                        by _excluded (e.g. distances_excluded.csv)
+    :param cache_dir: if given, cache encoded corpora and scores in the directory
+    :param num_workers: the number of worker processes (the number of models or CPUs if None)
+    :param batch_size: the maximum number of texts per batch
+    :return: array of perplexities of shape [len(model_paths), len(corpus_paths)]
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_dir = cache_dir or temp_dir
+        for directory in (_ENCODED_DIR, _SCORES_DIR):
+            os.makedirs(os.path.join(cache_dir, directory), exist_ok=True)
+
+        corpus_hashes = [hash_files([corpus_path]) for corpus_path in corpus_paths]
+        model_hashes = [_hash_model(model_path) for model_path in model_paths]
+        encoders = [_load_encoder(model_path) for model_path in model_paths]
+
+        # find the pairs of (model, corpus) which haven't been scored yet, grouped by models
+        tasks = dict()
+        encoded_paths = dict()
+        for model_id, model_path in enumerate(model_paths):
+            for corpus_id, corpus_path in enumerate(corpus_paths):
+                score_path = _get_score_path(cache_dir, model_hashes[model_id],
+                                             corpus_hashes[corpus_id])
+                if os.path.exists(score_path):
+                    continue
+
+                # encode the corpus once per encoder
+                encoder = encoders[model_id]
+                encoded_key = (corpus_id, encoder.fingerprint)
+                if encoded_key not in encoded_paths:
+                    encoded_paths[encoded_key] = _encode_corpus(
+                        corpus_path, encoder, cache_dir, corpus_hashes[corpus_id])
+                tasks.setdefault(model_id, list()).append(
+                    (encoded_paths[encoded_key], score_path))
+
+        _LOGGER.info('Scoring {:,} pairs of (model, corpus) ({:,} pairs are cached).'
+                     .format(sum(len(model_tasks) for model_tasks in tasks.values()),
+                             len(model_paths) * len(corpus_paths) -
+                             sum(len(model_tasks) for model_tasks in tasks.values())))
+        if tasks:
+            num_workers = num_workers or min(len(tasks), os.cpu_count())
+            # spawn (instead of fork) worker processes such that tensorflow is initialized cleanly
+            with ProcessPoolExecutor(num_workers, multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(_score_model, model_paths[model_id], model_tasks,
+                                           batch_size)
+                           for model_id, model_tasks in tasks.items()]
+                for future in futures:
+                    future.result()
+
+        perplexities = np.empty((len(model_paths), len(corpus_paths)), dtype=np.float64)
+        excluded_ratios = np.empty_like(perplexities)
+        for model_id, corpus_id in np.ndindex(*perplexities.shape):
+            score_path = _get_score_path(cache_dir, model_hashes[model_id],
+                                         corpus_hashes[corpus_id])
+            with open(score_path, 'r') as score_file:
+                scores = json.load(score_file)
+            perplexities[model_id, corpus_id] = compute_perplexity(scores['log_prob'],
+                                                                   scores['char_num'])
+            excluded_ratios[model_id, corpus_id] = (
+                scores['out_of_vocab_num'] / scores['text_num'] if scores['text_num']
+                else np.nan)
+
+    for model_id, corpus_id in zip(*np.nonzero(np.isnan(perplexities))):
+        _LOGGER.warning('All the texts of {} are out of the vocabulary of {}, its perplexity is '
+                        'nan.'.format(corpus_paths[corpus_id], model_paths[model_id]))
+    if output_path:
+        save_distance_matrix(perplexities, model_paths, corpus_paths, output_path)
+        save_distance_matrix(excluded_ratios, model_paths, corpus_paths,
+                             _get_excluded_path(output_path))
+    return perplexities
+
+
+def save_distance_matrix(perplexities, model_paths, corpus_paths, output_path):
+    """
+    Save a matrix of perplexities (or any values per model and corpus) to a .npy file, or to a .csv
+    file with the names (nan is written as nan).
+    """
+    if output_path.endswith('.npy'):
+        np.save(output_path, perplexities)
+        return
+
+    with open(output_path, 'w', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(['model'] + [os.path.basename(corpus_path) for corpus_path in corpus_paths])
+        for model_path, row in zip(model_paths, perplexities):
+            writer.writerow([os.path.basename(os.path.normpath(model_path))] +
+                            ['{:.6f}'.format(perplexity) for perplexity in row])
+
+
+def _score_model(model_path, model_tasks, batch_size):
+    """Load a model and score it on every encoded corpus of model_tasks (run by a worker)."""
+    from langdist.langmodel import CharLSTM  # import locally because it's slow to import
+    char_lstm = CharLSTM.load(model_path)
+    for encoded_path, score_path in model_tasks:
+        encoded_corpus = MmapCorpus(encoded_path)
+        with open('{}.json'.format(encoded_path), 'r') as info_file:
+            unknown_num = json.load(info_file)['unknown_num']
+
+        log_prob_sum = 0.
+        char_num_sum = 0
+        out_of_vocab_num = unknown_num
+        for log_prob, char_num in char_lstm.iter_scores(encoded_corpus, batch_size):
+            if np.isinf(log_prob):
+                out_of_vocab_num += 1
+                continue
+            log_prob_sum += log_prob
+            char_num_sum += char_num
+
+        _LOGGER.info('Scored {} on {}: perplexity={:.4f} ({:,} texts are out of vocabulary)'
+                     .format(model_path, encoded_path,
+                             compute_perplexity(log_prob_sum, char_num_sum), out_of_vocab_num))
+        _dump_json({'log_prob': log_prob_sum, 'char_num': char_num_sum,
+                    'text_num': len(encoded_corpus) + unknown_num,
+                    'out_of_vocab_num': out_of_vocab_num}, score_path)
+
+
+def _encode_corpus(corpus_path, encoder, cache_dir, corpus_hash):
+    """
+    Encode a corpus by the encoder and save it in the binary corpus format, excluding texts with
+    characters unknown to the encoder. Return the path to the encoded corpus.
+    """
+    encoded_path = os.path.join(cache_dir, _ENCODED_DIR, '{}_{}.ldc'.format(
+        corpus_hash, encoder.fingerprint))
+    if os.path.exists(encoded_path):
+        return encoded_path
+
+    _LOGGER.info('Encoding {} by the encoder {}...'.format(corpus_path, encoder.fingerprint))
+    char_ids = list()
+    lengths = list()
+    unknown_num = 0
+    samples = (MmapCorpus(corpus_path) if MmapCorpus.is_mmap_corpus(corpus_path)
+               else iter_corpus(corpus_path))
+    for tokens, offsets in iter_encoded_chunks(samples, encoder, _ENCODE_CHUNK_SIZE):
+        # exclude texts with unknown characters (encoded into -1)
+        is_known = find_known_samples(tokens, offsets)
+        tokens, offsets = select_samples(tokens, offsets, np.flatnonzero(is_known))
+        char_ids.append(tokens)
+        lengths.append(np.diff(offsets))
+        unknown_num += int((~is_known).sum())
+
+    offsets = np.zeros(sum(map(len, lengths)) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(lengths) if lengths else [], out=offsets[1:])
+    char_ids = np.concatenate(char_ids) if char_ids else np.zeros(0, dtype=np.int32)
+
+    # write the info first such that an existing corpus file always has its info
+    _dump_json({'unknown_num': unknown_num}, '{}.json'.format(encoded_path))
+    save_encoded_corpus(char_ids, offsets, encoded_path, encoder)
+    if unknown_num:
+        _LOGGER.warning('{:,} texts of {} contain characters unknown to the encoder {} and are '
+                        'excluded.'.format(unknown_num, corpus_path, encoder.fingerprint))
+    return encoded_path
+
+
+def _load_encoder(model_path):
+    """Load the encoder of a model without building its graph."""
+    from langdist.langmodel import CharLSTM  # import locally because it's slow to import
+    with open(os.path.join(get_checkpoint_path(model_path), CharLSTM._instance_file_name),
+              'rb') as model_file:
+        return pickle.load(model_file)._encoder
+
+
+def _hash_model(model_path):
+    """Return the hash of the checkpoint (the variables and the instance) of a model."""
+    from langdist.langmodel import CharLSTM  # import locally because it's slow to import
+    checkpoint_path = get_checkpoint_path(model_path)
+    file_names = sorted(file_name for file_name in os.listdir(checkpoint_path)
+                        if file_name.startswith(CharLSTM._checkpoint_file_name) or
+                        file_name == CharLSTM._instance_file_name)
+    return hash_files([os.path.join(checkpoint_path, file_name) for file_name in file_names])
+
+
+def _get_score_path(cache_dir, model_hash, corpus_hash):
+    """Return the path to the cached score of a model on a corpus."""
+    return os.path.join(cache_dir, _SCORES_DIR, '{}_{}.json'.format(model_hash, corpus_hash))
+
+
+def _get_excluded_path(output_path):
+    """Return the path to the ratios of excluded texts saved along with the matrix."""
+    root, extension = os.path.splitext(output_path)
+    return '{}_excluded{}'.format(root, extension)
+
+
+def _dump_json(content, path):
+    """Dump the content into a JSON file atomically."""
+    temp_path = '{}.tmp'.format(path)
+    with open(temp_path, 'w') as json_file:
+        json.dump(content, json_file)
+    os.replace(temp_path, path)
@@ -0,0 +1,204 @@
+# -*- coding: UTF-8 -*-
+"""
+Train a language model with synchronous data-parallel SGD over worker processes on a machine.
+
+Every worker process holds a replica of the model and trains it on its shard of the training
+samples. After every step, the gradients of the workers are summed by an allreduce over shared
+memory and every replica applies the same update, so the replicas never diverge.
+"""
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import pickle
+
+import numpy as np
+
+from langdist.checkpoint import get_checkpoint_path
+from langdist.runtime import SessionConfig
+from langdist.util import get_logger
+
+_LOGGER = get_logger(__name__)
+
+__author__ = 'kensk8er'
+
+_MAX_INTER_OP_THREADS = 2
+_LEARNING_RATE_SCALINGS = ('none', 'linear', 'sqrt')
+
+
+class SharedMemoryAllreduce(object):
+    """
+    Sum arrays of a fixed size over worker processes through shared memory.
+
+    Every worker writes its array into its own row of a shared buffer, sums a chunk of the columns
+    over the rows (reduce-scatter), and reads the whole sum back (all-gather), synchronised by a
+    barrier. Create it in the parent process, pass it to the worker processes, and attach every
+    worker to its rank.
+
+    Basic Usage:
+        allreduce = SharedMemoryAllreduce(size, num_workers, context)
+        # in the worker of rank
+        allreduce.attach(rank)
+        summed = allreduce.allreduce(array)
+    """
+
+    def __init__(self, size, num_workers, context=multiprocessing):
+        """
+        :param size: the number of elements of the arrays
+        :param num_workers: the number of worker processes
+        :param context: multiprocessing context the worker processes are started by
+        """
+        assert num_workers > 0, 'num_workers <= 0'
+        self.size = size
+        self.num_workers = num_workers
+        self.rank = None
+        self._buffer = context.RawArray('d', num_workers * size)
+        self._result = context.RawArray('d', size)
+        self._length = context.RawValue('q', 0)  # the length of the array broadcast
+        self._barrier = context.Barrier(num_workers)
+        self._views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = None  # numpy views of the shared memory aren't picklable
+        return state
+
+    def attach(self, rank):
+        """Attach the worker process of the rank."""
+        assert 0 <= rank < self.num_workers, 'rank is out of range'
+        self.rank = rank
+        self._views = (np.frombuffer(self._buffer, dtype=np.float64).reshape(self.num_workers,
+                                                                            self.size),
+                       np.frombuffer(self._result, dtype=np.float64))
+
+    def allreduce(self, array):
+        """Return the sum of the arrays of all the workers."""
+        buffer, result = self._views
+        buffer[self.rank] = array
+        self._barrier.wait()
+
+        # each worker sums its own chunk of the columns
+        bounds = np.linspace(0, self.size, self.num_workers + 1).astype(np.int64)
+        chunk = slice(bounds[self.rank], bounds[self.rank + 1])
+        result[chunk] = buffer[:, chunk].sum(axis=0)
+        self._barrier.wait()
+        return result.copy()
+
+    def broadcast(self, array, root=0):
+        """
+        Return the array of the root worker (arrays of the other workers can be anything). The
+        array can be shorter than size, the other workers receive its length from the root.
+        """
+        buffer, _ = self._views
+        if self.rank == root:
+            assert len(array) <= self.size, 'the array is longer than size'
+            buffer[root, :len(array)] = array
+            self._length.value = len(array)
+        self._barrier.wait()
+        array = buffer[root, :self._length.value].copy()
+        self._barrier.wait()  # the buffer can be reused once every worker has read it
+        return array
+
+    def barrier(self):
+        """Wait until all the workers reach here."""
+        self._barrier.wait()
+
+    def abort(self):
+        """Break the barrier such that workers waiting on it raise BrokenBarrierError."""
+        self._barrier.abort()
+
+
+def train_data_parallel(samples_path, model_path, num_workers=2, init_args=None,
+                        base_model_path=None, threads_per_worker=None,
+                        learning_rate_scaling='none', **train_args):
+    """
+    Train a language model with synchronous data-parallel SGD over worker processes.
+
+    A batch of batch_size samples (train_args) is split over the workers, so the training is the
+    same as a single process training on the batch size (except dropout and the order of samples)
+    and the learning rate doesn't need scaling. Increase batch_size with num_workers and scale the
+    learning rate ('linear' or 'sqrt') to trade the number of updates for the throughput.
+
+    :param samples_path: path to the corpus (read by every worker)
+    :param model_path: path to the model directory
+    :param num_workers: the number of worker processes
+    :param init_args: keyword arguments of CharLSTM.__init__() when training from the scratch
+    :param base_model_path: if given, retrain the model at the path instead
+    :param threads_per_worker: the number of threads used by tensorflow per worker (CPUs divided
+                               by num_workers if None)
+    :param learning_rate_scaling: scale the learning rate by the number of workers ('linear'), by
+                                  its square root ('sqrt'), or not ('none')
+    :param train_args: keyword arguments of CharLSTM._train_data_parallel() (e.g. batch_size,
+                       patience, valid_size)
+    :return: dict of the statistics of the training (e.g. samples_per_second)
+    """
+    from langdist.langmodel import CharLSTM  # import locally because it's slow to import
+    assert learning_rate_scaling in _LEARNING_RATE_SCALINGS, \
+        'learning_rate_scaling must be one of {}'.format(_LEARNING_RATE_SCALINGS)
+    threads_per_worker = threads_per_worker or max(os.cpu_count() // num_workers, 1)
+    batch_size = train_args.pop('batch_size', 128)
+    assert batch_size >= num_workers, 'batch_size < num_workers'
+    train_args['batch_size'] = batch_size // num_workers
+    train_args['learning_rate_scale'] = {'none': 1., 'linear': float(num_workers),
+                                         'sqrt': float(np.sqrt(num_workers))}[
+        learning_rate_scaling]
+
+    # build the graph once in order to size the allreduce buffer by the number of parameters
+    if base_model_path:
+        with open(os.path.join(get_checkpoint_path(base_model_path), CharLSTM._instance_file_name),
+                  'rb') as model_file:
+            char_lstm = pickle.load(model_file)
+    else:
+        char_lstm = CharLSTM(**init_args)
+    char_lstm._build_graph()
+    size = char_lstm._num_params + 3  # gradients, the loss, and the numbers of chars and samples
+    del char_lstm
+
+    # spawn (instead of fork) worker processes such that tensorflow is initialized cleanly
+    context = multiprocessing.get_context('spawn')
+    allreduce = SharedMemoryAllreduce(size, num_workers, context)
+    results = context.Queue()
+    processes = [context.Process(
+        target=_run_worker, name='data-parallel-{}'.format(rank),
+        args=(rank, allreduce, samples_path, model_path, init_args, base_model_path,
+              threads_per_worker, train_args, results)) for rank in range(num_workers)]
+    for process in processes:
+        process.start()
+
+    # stop every worker as soon as one of them fails (the others would wait for it forever)
+    running = {process.sentinel: process for process in processes}
+    failed = None
+    while running:
+        for sentinel in wait(list(running)):
+            process = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0 and failed is None:
+                failed = process
+                allreduce.abort()
+                for other_process in running.values():
+                    other_process.terminate()
+
+    if failed is not None:
+        raise RuntimeError('Worker {} failed (exitcode={})'.format(failed.name, failed.exitcode))
+    return results.get()
+
+
+def _run_worker(rank, allreduce, samples_path, model_path, init_args, base_model_path, threads,
+                train_args, results):
+    """Train the replica of a worker (run in a worker process)."""
+    # set before tensorflow is imported, which reads it when it creates its thread pools
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+
+    from langdist.corpus import load_corpus
+    from langdist.langmodel import CharLSTM  # import locally because it's slow to import
+    session_config = SessionConfig(intra_op_threads=threads,
+                                   inter_op_threads=min(threads, _MAX_INTER_OP_THREADS))
+    allreduce.attach(rank)
+
+    if base_model_path:
+        char_lstm = CharLSTM.load(base_model_path, session_config)
+    else:
+        char_lstm = CharLSTM(**dict(init_args, session_config=session_config))
+    stats = char_lstm._train_data_parallel(load_corpus(samples_path), model_path, allreduce,
+                                           **train_args)
+    if rank == 0:
+        results.put(stats)
@@ -2,15 +2,28 @@
 """
 Implement Encoder classes that encode characters into character IDs.
 """
+import hashlib
 import pickle
+from collections import Counter
 
+import numpy as np
 from sklearn.preprocessing import LabelEncoder
 
+from langdist.corpus import MmapCorpus, iter_corpus
+
 __author__ = 'kensk8er'
 
+_DENSE_LOOKUP_SIZE = 0x10000  # codepoints below this (BMP) are looked up in a dense table
+
 
 class CharEncoder(object):
-    """Encode characters into character IDs."""
+    """
+    Encode characters into character IDs.
+
+    Character IDs follow the ordering of the fitted LabelEncoder (i.e. characters sorted by their
+    codepoints), but encoding and decoding are done via lookup tables over the codepoints of the
+    characters, which are built lazily from the LabelEncoder and aren't pickled.
+    """
 
     _segment_char = '\n'  # the character that represents a border between samples
 
@@ -18,18 +31,83 @@ class CharEncoder(object):
         self._label_encoder = LabelEncoder()
         self._segment_char_id = None
         self._fit = False
+        self._lookup_tables = None
+        self._char_counts = Counter()
+        self._sample_num = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lookup_tables'] = None  # lookup tables can be rebuilt from the LabelEncoder
+        return state
+
+    def __setstate__(self, state):
+        # encoders pickled before lookup tables/character counts existed
+        state.setdefault('_lookup_tables', None)
+        state.setdefault('_char_counts', Counter())
+        state.setdefault('_sample_num', 0)
+        self.__dict__.update(state)
 
     def fit(self, samples):
         """
         Fit the character encoder to the samples of characters given.
 
-        :param samples: samples of characters (e.g. sentences)
+        :param samples: samples of characters (e.g. sentences), any iterable (e.g. a generator
+                        reading a file) works since samples are consumed one by one
+        """
+        self._label_encoder = LabelEncoder()
+        self._char_counts = Counter()
+        self._sample_num = 0
+        self._fit = False
+        self.partial_fit(samples)
+
+    def partial_fit(self, samples):
         """
-        characters = list(''.join(samples))
-        characters.insert(0, self._segment_char)
-        self._label_encoder.fit(characters)
-        self._segment_char_id = int(self._label_encoder.transform([self._segment_char])[0])
+        Fit the character encoder incrementally to additional samples of characters (e.g. corpus of
+        a new language), keeping the characters it has already been fit to.
+
+        Note that character IDs are assigned in the order of the characters, so adding new
+        characters can change the IDs of existing ones. A model trained with an encoder needs to
+        keep using that encoder (CharLSTM keeps its own copy).
+
+        :param samples: samples of characters (e.g. sentences), any iterable works since samples
+                        are consumed one by one
+        """
+        for sample in samples:
+            self._char_counts.update(sample)
+            self._sample_num += 1
+        self._update_classes()
+
+    def partial_fit_codepoints(self, codepoints, sample_num=0, chunk_size=2 ** 24):
+        """
+        Fit the character encoder incrementally to an array of unicode codepoints (e.g. tokens of a
+        memory-mapped corpus), counting them chunk by chunk.
+
+        :param codepoints: array of unicode codepoints
+        :param sample_num: the number of samples the codepoints consist of
+        :param chunk_size: the number of codepoints counted at a time
+        """
+        self._sample_num += sample_num
+        for start_index in range(0, len(codepoints), chunk_size):
+            unique_codepoints, counts = np.unique(
+                codepoints[start_index: start_index + chunk_size], return_counts=True)
+            self._char_counts.update(
+                {chr(codepoint): count for codepoint, count in
+                 zip(unique_codepoints.tolist(), counts.tolist())})
+        self._update_classes()
+
+    def _update_classes(self):
+        """Update the classes of the LabelEncoder with the characters counted so far."""
+        characters = set(self._char_counts)
+        characters.add(self._segment_char)
+        if self._fit:
+            characters.update(self._label_encoder.classes_)
+
+        # equivalent to LabelEncoder.fit(characters) without building a list of all characters
+        self._label_encoder.classes_ = np.array(sorted(characters))
+        self._segment_char_id = int(np.searchsorted(self._label_encoder.classes_,
+                                                    self._segment_char))
         self._fit = True
+        self._lookup_tables = None
 
     def encode(self, samples):
         """
@@ -38,10 +116,57 @@ class CharEncoder(object):
         :param samples: samples of characters (e.g. sentences)
         :return: Samples of character IDs
         """
-        encoded_samples = list()
-        for sample in samples:
-            encoded_samples.append(self._label_encoder.transform(list(sample)).tolist())
-        return encoded_samples
+        char_ids, offsets = self.encode_flat(samples)
+        return [char_ids[start_index: end_index].tolist()
+                for start_index, end_index in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+    def encode_flat(self, samples, unknown_id=None):
+        """
+        Encode samples of characters into a flat array of character IDs and an offsets array.
+
+        :param samples: samples of characters (e.g. sentences)
+        :param unknown_id: if given, encode characters unknown to the encoder into this ID instead
+                           of raising ValueError
+        :return: (char_ids, offsets) where the i-th sample is char_ids[offsets[i]: offsets[i + 1]]
+        """
+        if not isinstance(samples, (list, tuple)):
+            samples = list(samples)
+
+        offsets = np.zeros(len(samples) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, samples), dtype=np.int64, count=len(samples)),
+                  out=offsets[1:])
+        return self.encode_codepoints(_to_codepoints(''.join(samples)), unknown_id), offsets
+
+    def encode_codepoints(self, codepoints, unknown_id=None):
+        """
+        Encode an array of unicode codepoints into an array of character IDs.
+
+        :param codepoints: array of unicode codepoints
+        :param unknown_id: if given, encode characters unknown to the encoder into this ID instead
+                           of raising ValueError
+        :return: int32 array of character IDs
+        """
+        codepoint2id, sparse_codepoints, sparse_ids = self._get_lookup_tables()[1:]
+        codepoints = np.asarray(codepoints, dtype=np.int64)
+        char_ids = np.full(len(codepoints), -1, dtype=np.int32)
+
+        is_dense = codepoints < len(codepoint2id)
+        char_ids[is_dense] = codepoint2id[codepoints[is_dense]]
+
+        if not is_dense.all():
+            is_sparse = ~is_dense
+            positions = np.searchsorted(sparse_codepoints, codepoints[is_sparse])
+            positions = np.minimum(positions, max(len(sparse_codepoints) - 1, 0))
+            if len(sparse_codepoints):
+                found = sparse_codepoints[positions] == codepoints[is_sparse]
+                char_ids[np.flatnonzero(is_sparse)[found]] = sparse_ids[positions[found]]
+
+        if unknown_id is not None:
+            char_ids[char_ids < 0] = unknown_id
+        elif (char_ids < 0).any():
+            unknown_chars = sorted(set(chr(codepoint) for codepoint in codepoints[char_ids < 0]))
+            raise ValueError('Characters unknown to the encoder: {}'.format(unknown_chars))
+        return char_ids
 
     def decode(self, samples):
         """
@@ -51,19 +176,46 @@ class CharEncoder(object):
         :param samples: samples of characters (e.g. sentences)
         :return: Samples of original characters
         """
+        id2codepoint = self._get_lookup_tables()[0]
         decoded_samples = list()
         for sample in samples:
-            decoded_samples.append(''.join(self._label_encoder.inverse_transform(sample)))
+            codepoints = id2codepoint[np.asarray(sample, dtype=np.int64)]
+            decoded_samples.append(codepoints.tobytes().decode('utf-32-le'))
         return decoded_samples
 
+    def _get_lookup_tables(self):
+        """
+        Return lookup tables between codepoints and character IDs, building them if necessary.
+
+        :return: id2codepoint (array), codepoint2id (dense array for the codepoints below
+                 _DENSE_LOOKUP_SIZE, -1 for unknown characters), and sorted codepoints and their
+                 IDs for the other characters
+        """
+        if self._lookup_tables is None:
+            id2codepoint = _to_codepoints(''.join(self._label_encoder.classes_))
+            is_dense = id2codepoint < _DENSE_LOOKUP_SIZE
+            char_ids = np.arange(len(id2codepoint), dtype=np.int32)
+
+            dense_codepoints = id2codepoint[is_dense]
+            lookup_size = int(dense_codepoints.max()) + 1 if len(dense_codepoints) else 0
+            codepoint2id = np.full(lookup_size, -1, dtype=np.int32)
+            codepoint2id[dense_codepoints] = char_ids[is_dense]
+
+            self._lookup_tables = (id2codepoint, codepoint2id, id2codepoint[~is_dense],
+                                   char_ids[~is_dense])
+        return self._lookup_tables
+
     def fit_encode(self, samples):
         """
         Fit the character encoder to samples of characters and encode them into samples of 
         character IDs using the fitted encoder.
 
-        :param samples: samples of characters (e.g. sentences)
+        :param samples: samples of characters (e.g. sentences), iterators (e.g. a generator reading
+                        a file) are materialised into a list as they are consumed twice
         :return: Samples of character IDs
         """
+        if not isinstance(samples, (list, tuple)):
+            samples = list(samples)
         self.fit(samples)
         return self.encode(samples)
 
@@ -87,16 +239,47 @@ class CharEncoder(object):
         """True if the encoder is already fit, else False."""
         return self._fit
 
+    @property
+    def fingerprint(self):
+        """Hash of the vocabulary, which identifies the mapping between characters and IDs."""
+        return hashlib.sha1(''.join(self._label_encoder.classes_).encode('utf-8')).hexdigest()
 
-def fit_encoder(corpus_paths, encoder_path):
-    """Fit an encoder to the corpora and save it."""
-    corpora = list()
-    for corpus_path in corpus_paths:
-        with open(corpus_path, 'rb') as corpus_file:
-            corpora.extend(pickle.load(corpus_file))
+    @property
+    def char_counts(self):
+        """Counter of the characters the encoder has been fit to (empty for older encoders)."""
+        return Counter(self._char_counts)
 
-    encoder = CharEncoder()
-    encoder.fit(corpora)
+    @property
+    def sample_num(self):
+        """
+        The number of samples the encoder has been fit to, i.e. the count of the segment character
+        which ends every sample (0 for older encoders).
+        """
+        return self._sample_num
+
+
+def _to_codepoints(text):
+    """Convert a string into an array of its unicode codepoints (a UTF-32 view of the text)."""
+    return np.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+
+
+def fit_encoder(corpus_paths, encoder_path, encoder=None):
+    """
+    Fit an encoder to the corpora and save it. Corpora are read one by one such that only one of
+    them is in memory at a time (text corpora are streamed line by line and binary corpora are
+    memory-mapped).
+
+    :param corpus_paths: paths to the corpora to fit the encoder to
+    :param encoder_path: path to where you save the fitted encoder
+    :param encoder: if given, fit this encoder incrementally instead of a new one
+    """
+    encoder = encoder if encoder else CharEncoder()
+    for corpus_path in corpus_paths:
+        if MmapCorpus.is_mmap_corpus(corpus_path):
+            MmapCorpus(corpus_path).fit_encoder(encoder)
+        else:
+            encoder.partial_fit(iter_corpus(corpus_path))
 
     with open(encoder_path, 'wb') as encoder_file:
         pickle.dump(encoder, encoder_file)
+    return encoder
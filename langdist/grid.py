@@ -0,0 +1,194 @@
+# -*- coding: UTF-8 -*-
+"""
+Train a grid of language models (monolingual models and models retrained on top of them) in
+parallel, following the dependencies between them.
+
+A grid is specified in a JSON file such as:
+    {
+        "init": {"rnn_size": 256, "num_rnn_layers": 2},
+        "train": {"batch_size": 128, "patience": 819200},
+        "jobs": [
+            {"name": "en", "corpus": "corpora/en.pkl", "encoder": "encoder.pkl",
+             "model": "models/en"},
+            {"name": "en2fr", "parent": "en", "corpus": "corpora/fr.pkl", "model": "models/en2fr",
+             "train": {"patience": 409600}}
+        ]
+    }
+
+A job without a parent trains a model from the scratch (keyword arguments of CharLSTM.__init__()
+are given by "init"), and a job with a parent retrains the model of the parent job. "train" gives
+keyword arguments of CharLSTM.train(). Top-level "init" and "train" are defaults for every job.
+Relative paths are relative to the directory of the JSON file. Interrupted jobs resume from their
+latest checkpoints.
+"""
+import json
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import pickle
+import shutil
+
+from langdist.checkpoint import has_checkpoint
+from langdist.runtime import SessionConfig
+from langdist.util import get_logger
+
+_LOGGER = get_logger(__name__)
+
+__author__ = 'kensk8er'
+
+_DONE_FILE_NAME = '.done'  # marks a model whose training has finished
+_MAX_INTER_OP_THREADS = 2
+_START_METHOD = 'spawn'  # start a fresh process per job such that tensorflow is initialized cleanly
+
+
+def load_grid(grid_path):
+    """
+    Load and validate a grid specification from a JSON file.
+
+    :param grid_path: path to the JSON file
+    :return: dict of job name -> job (with the paths resolved and the defaults merged)
+    """
+    with open(grid_path, 'r') as grid_file:
+        grid = json.load(grid_file)
+    grid_dir = os.path.dirname(os.path.abspath(grid_path))
+
+    jobs = dict()
+    for job in grid['jobs']:
+        name = job['name']
+        if name in jobs:
+            raise ValueError('Job name {} is duplicated'.format(name))
+        jobs[name] = {
+            'name': name, 'parent': job.get('parent'),
+            'corpus': os.path.join(grid_dir, os.path.expanduser(job['corpus'])),
+            'model': os.path.join(grid_dir, os.path.expanduser(job['model'])),
+            'encoder': (os.path.join(grid_dir, os.path.expanduser(job['encoder']))
+                        if job.get('encoder') else None),
+            'init': dict(grid.get('init', {}), **job.get('init', {})),
+            'train': dict(grid.get('train', {}), **job.get('train', {}))}
+
+    for job in jobs.values():
+        if job['parent'] is None and job['encoder'] is None:
+            raise ValueError('Job {} needs either a parent or an encoder'.format(job['name']))
+        if job['parent'] is not None and job['parent'] not in jobs:
+            raise ValueError('Parent {} of job {} is not defined'.format(job['parent'],
+                                                                         job['name']))
+
+    # detect cycles of dependencies
+    for job in jobs.values():
+        visited = {job['name']}
+        parent = job['parent']
+        while parent is not None:
+            if parent in visited:
+                raise ValueError('Job {} depends on itself'.format(job['name']))
+            visited.add(parent)
+            parent = jobs[parent]['parent']
+    return jobs
+
+
+def train_grid(grid_path, num_workers=None, threads_per_job=None):
+    """
+    Train all the models of a grid. Jobs whose parents have finished run concurrently in a pool
+    of worker processes, and each retraining job starts as soon as its parent has finished.
+
+    Retraining jobs wait for their parents to finish rather than starting from the first
+    checkpoint of their parents: the checkpoint could be evicted by the parent while the child is
+    loading it, and the child would be retrained from a model whose quality depends on when it
+    happened to start.
+
+    Finished jobs are marked such that running the grid again (e.g. after a crash) skips them, and
+    resumes the unfinished jobs from their latest checkpoints.
+
+    :param grid_path: path to the JSON file of the grid specification
+    :param num_workers: the number of jobs running at once (the number of CPUs if None)
+    :param threads_per_job: the number of threads used by tensorflow per job (CPUs divided by the
+                            number of workers if None) such that jobs don't oversubscribe CPUs
+    :return: list of the names of the jobs that failed (or were skipped as their parents failed)
+    """
+    jobs = load_grid(grid_path)
+    num_workers = num_workers or os.cpu_count()
+    threads_per_job = threads_per_job or max(os.cpu_count() // num_workers, 1)
+
+    finished = {name for name, job in jobs.items() if is_finished(job['model'])}
+    failed = set()
+    running = dict()  # sentinel of the process -> (job name, process)
+    if finished:
+        _LOGGER.info('Skip {:,} finished jobs: {}'.format(len(finished), sorted(finished)))
+
+    # a fresh process per job such that tensorflow threads are configured for every job
+    context = multiprocessing.get_context(_START_METHOD)
+
+    def start_ready_jobs():
+        """Start the jobs whose parents have finished, up to num_workers jobs at once."""
+        running_names = {name for name, _ in running.values()}
+        for name, job in jobs.items():
+            if len(running) >= num_workers:
+                return
+            if (name in finished or name in failed or name in running_names or
+                    (job['parent'] is not None and job['parent'] not in finished)):
+                continue
+            _LOGGER.info('Start job {} (model={})'.format(name, job['model']))
+            process = context.Process(target=_run_job, name='train-grid-{}'.format(name),
+                                      args=(job, jobs.get(job['parent']), threads_per_job))
+            process.start()
+            running[process.sentinel] = (name, process)
+
+    start_ready_jobs()
+    while running:
+        for sentinel in wait(list(running)):
+            name, process = running.pop(sentinel)
+            process.join()
+            if process.exitcode == 0 and is_finished(jobs[name]['model']):
+                finished.add(name)
+                _LOGGER.info('Finished job {}'.format(name))
+            else:
+                failed.add(name)
+                _LOGGER.error('Job {} failed (exitcode={})'.format(name, process.exitcode))
+        start_ready_jobs()
+
+    not_finished = sorted(set(jobs) - finished)
+    if not_finished:
+        _LOGGER.error('{:,} jobs failed or were skipped: {}'.format(len(not_finished),
+                                                                   not_finished))
+    return not_finished
+
+
+def is_finished(model_path):
+    """Return True if the training of the model at the path has finished."""
+    return os.path.exists(os.path.join(model_path, _DONE_FILE_NAME))
+
+
+def _run_job(job, parent_job, threads):
+    """Train the model of a job (run in a fresh worker process)."""
+    # set before tensorflow is imported, which reads it when it creates its thread pools
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+
+    from langdist.corpus import load_corpus
+    from langdist.langmodel import CharLSTM  # import locally because it's slow to import
+    session_config = SessionConfig(intra_op_threads=threads,
+                                   inter_op_threads=min(threads, _MAX_INTER_OP_THREADS))
+
+    if has_checkpoint(job['model']):
+        # resume the job that was interrupted
+        char_lstm = CharLSTM.load(job['model'], session_config, resume=True)
+        char_lstm.train(load_corpus(job['corpus']), job['model'], resume=True, **job['train'])
+        _mark_finished(job['model'])
+        return
+
+    # start over the job that was interrupted before its first checkpoint
+    if os.path.exists(job['model']):
+        shutil.rmtree(job['model'])
+
+    if parent_job is None:
+        with open(job['encoder'], 'rb') as encoder_file:
+            encoder = pickle.load(encoder_file)
+        char_lstm = CharLSTM(encoder=encoder, session_config=session_config, **job['init'])
+    else:
+        char_lstm = CharLSTM.load(parent_job['model'], session_config)
+    char_lstm.train(load_corpus(job['corpus']), job['model'], **job['train'])
+    _mark_finished(job['model'])
+
+
+def _mark_finished(model_path):
+    """Mark the training of the model at the path as finished."""
+    with open(os.path.join(model_path, _DONE_FILE_NAME), 'w') as done_file:
+        done_file.write('')
@@ -2,26 +2,40 @@
 """
 This module implements language modeling algorithms.
 """
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
+from functools import partial
 import os
 import pickle
-from itertools import chain
-from math import ceil
+import time
 
 import numpy as np
 import regex
 import tensorflow as tf
 from sklearn.model_selection import train_test_split
-from tensorflow.contrib.rnn import DropoutWrapper, LSTMCell, MultiRNNCell
+from tensorflow.contrib.rnn import DropoutWrapper, LSTMBlockCell, LSTMBlockFusedCell, LSTMCell, \
+    MultiRNNCell
 from tensorflow.contrib.rnn import LSTMStateTuple
 from tensorflow.contrib.seq2seq import sequence_loss
 from tensorflow.python.client import timeline
 
-from langdist.batch import BatchGenerator
+from langdist.batch import BatchGenerator, PrefetchIterator, StreamBatchGenerator, \
+    find_known_samples, pad_batch, select_samples, split_by_tokens
+from langdist.beam import beam_search
+from langdist.cache import EncodedCorpusCache, hash_corpus
+from langdist.checkpoint import BEST, LATEST, AsyncCheckpointer, get_checkpoint_path
+from langdist.corpus import CHAR_IDS, MmapCorpus, iter_encoded_chunks
 from langdist.encoder import CharEncoder
-from langdist.util import get_logger
+from langdist.runtime import autotune_session_config
+from langdist.sampling import sample_from_probs
+from langdist.util import compute_perplexity, get_logger
 
 _LOGGER = get_logger(__name__)
+_DEFAULT_CACHE_SIZE = 10 * 2 ** 30  # 10GB
+_PREFILL_MAX_TOKENS = 2 ** 16  # the maximum number of padded characters per prefill call
+_VALID_MAX_TOKENS = 2 ** 16  # the maximum number of padded characters per validation batch
+_CELL_TYPES = ('lstm', 'block', 'fused')
+_SOFTMAX_LOSSES = ('full', 'sampled')
 
 __author__ = 'kensk8er'
 
@@ -32,15 +46,25 @@ class CharLSTM(object):
     _random_state = 0  # this is to make train/test split always return the same split
     _checkpoint_file_name = 'model.ckpt'
     _instance_file_name = 'instance.pkl'
+    _training_state_file_name = 'training_state.pkl'
     _tensorboard_dir = 'tensorboard.log'
+    _session_config = None  # default for the models saved before session configs were introduced
+    _cell_type = 'lstm'  # default for the models saved before cell types were introduced
+    _softmax_loss = 'full'  # default for the models saved before sampled softmax was introduced
+    _num_sampled = 64
 
     def __init__(self, embedding_size=128, rnn_size=256, num_rnn_layers=2, learning_rate=0.001,
-                 rnn_dropouts=None, final_dropout=1.0, encoder=None):
+                 rnn_dropouts=None, final_dropout=1.0, encoder=None, session_config=None,
+                 cell_type='lstm', softmax_loss='full', num_sampled=64):
         # in order to avoid using mutable object as a default argument
         if rnn_dropouts is None:
             # default is 1.0, which means no dropout
             rnn_dropouts = [1.0 for _ in range(num_rnn_layers)]
         assert len(rnn_dropouts) == num_rnn_layers, 'len(rnn_dropouts) != num_rnn_layers'
+        assert cell_type in _CELL_TYPES, 'cell_type must be one of {}'.format(_CELL_TYPES)
+        assert softmax_loss in _SOFTMAX_LOSSES, \
+            'softmax_loss must be one of {}'.format(_SOFTMAX_LOSSES)
+        assert num_sampled > 0, 'num_sampled <= 0'
 
         self._embedding_size = embedding_size
         self._rnn_size = rnn_size
@@ -57,51 +81,86 @@ class CharLSTM(object):
         self._segment_char_id = encoder.segment_char_id if encoder else None
         self._session = None
         self._target_vocab_ids = None
+        self._session_config = session_config
+        self._cell_type = cell_type
+        self._softmax_loss = softmax_loss
+        self._num_sampled = num_sampled
 
     def train(self, samples, model_path, batch_size=128, patience=819200, stat_interval=25,
-              valid_intervals=None, summary_interval=50, valid_size=0.1, valid_batch_num=10,
-              profile=False):
-        """Train a language model on the samples of word IDs."""
+              valid_intervals=None, summary_interval=50, valid_size=0.1,
+              valid_max_tokens=_VALID_MAX_TOKENS, profile=False, bucket_size=None,
+              max_tokens=None, stateful=False, num_steps=100, cache_dir=None,
+              cache_size=_DEFAULT_CACHE_SIZE, prefetch=2, autotune=False, async_validation=False,
+              keep_checkpoints=3, resume=False):
+        """
+        Train a language model on the samples of word IDs.
+
+        :param samples: list of samples of characters, or MmapCorpus (which is read lazily without
+                        loading it into memory if it is encoded by the encoder of the model)
+        :param bucket_size: if given, batch samples of similar lengths together by sorting them
+                            within mega-batches of bucket_size * batch_size samples
+        :param max_tokens: if given, the maximum number of (padded) characters per batch, which is
+                           used instead of batch_size
+        :param stateful: if True, train with truncated back-propagation through time on batch_size
+                         continuous streams of characters, carrying the RNN states between batches
+        :param num_steps: the number of characters per stream in a batch when stateful is True
+        :param cache_dir: if given, cache the encoded corpus and its train/validation split in this
+                          directory, and reuse them when training on the same corpus again
+        :param cache_size: the maximum size of the cache in bytes
+        :param prefetch: the number of batches prepared in a background thread while the model is
+                         trained on the current batch (0 to prepare batches in the main thread)
+        :param autotune: if True, benchmark a few session configurations on a synthetic batch and
+                         train with the fastest one (only when training from the scratch, use
+                         load(autotune=True) for retraining)
+        :param valid_max_tokens: the maximum number of (padded) characters per validation batch,
+                                 which bounds the memory used by validation
+        :param async_validation: if True, validate a snapshot of the variables in a background
+                                 thread (on a separate session) while training goes on, validations
+                                 due while the previous one is running are skipped
+        :param keep_checkpoints: the number of the latest checkpoints kept in model_path (the best
+                                 one is always kept), checkpoints are written in the background
+        :param resume: if True, resume the training from the latest checkpoint in model_path (the
+                       model needs to be loaded by load(model_path, resume=True)), the other
+                       arguments need to be the same as the ones of the interrupted training
+        """
 
-        def add_metric_summary(summary_writer, mode, iteration, perplexity):
+        def add_metric_summary(summary_writer, mode, iteration, value, metric='perplexity'):
             """Add summary for metric."""
             metric_summary = tf.Summary()
-            metric_summary.value.add(tag='{}_perplexity'.format(mode), simple_value=perplexity)
+            metric_summary.value.add(tag='{}_{}'.format(mode, metric), simple_value=value)
             summary_writer.add_summary(metric_summary, global_step=iteration)
 
-        def validate(X_valid, Y_valid, seq_lens_valid, batch_id, best_perplexity, summary_writer):
-            """Validate the model on validation set."""
-            valid_losses = list()
-            batch_size = ceil(len(X_valid) / valid_batch_num)
-            for index in range(valid_batch_num):
-                X_valid_batch = X_valid[index * batch_size: (index + 1) * batch_size]
-                Y_valid_batch = Y_valid[index * batch_size: (index + 1) * batch_size]
-                seq_lens_valid_batch = seq_lens_valid[index * batch_size: (index + 1) * batch_size]
-
-                valid_loss = session.run(
-                    nodes['loss'],
-                    feed_dict={nodes['X']: X_valid_batch, nodes['Y']: Y_valid_batch,
-                               nodes['seq_lens']: seq_lens_valid_batch, nodes['is_train']: False},
-                    options=run_options, run_metadata=run_metadata)
-                valid_losses.append(valid_loss)
-
-            valid_loss = np.mean(valid_losses, dtype=np.float64)
-            perplexity = np.exp(np.mean(valid_loss))  # cross entropy is log-perplexity
+        def validate(valid_session, epoch, iteration, training_state):
+            """Validate the model on validation set, and save a checkpoint of the model."""
+            nonlocal best_perplexity
+            profile_valid = run_metadata is not None and not async_validation
+            log_prob, char_num = self._evaluate(
+                valid_session, tokens, offsets, valid_ids, valid_max_tokens,
+                options=run_options if profile_valid else None,
+                run_metadata=run_metadata if profile_valid else None)
+            perplexity = np.exp(-log_prob / max(char_num, 1))  # per character of the whole set
             _LOGGER.info('Epoch={}, Iter={:,}, Mean Perplexity (Validation set)= {:.3f}'
                          .format(epoch, iteration, perplexity))
             add_metric_summary(summary_writer, 'valid', iteration, perplexity)
 
-            if perplexity < best_perplexity:
+            is_best = perplexity < best_perplexity
+            if is_best:
                 _LOGGER.info('Best perplexity so far, save the model.')
-                self._save(model_path, session)
                 best_perplexity = perplexity
+            self._save(checkpointer, valid_session, iteration,
+                       dict(training_state, best_perplexity=best_perplexity), is_best)
 
-            if run_metadata:
+            if profile_valid:
                 with open('profile_valid.json', 'w') as file_:
                     file_.write(
                         timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
 
-            return best_perplexity
+            self._generate(valid_session)
+
+        def validate_snapshot(values, epoch, iteration, training_state):
+            """Load a snapshot of the variables into the validation session and validate it."""
+            self._load_variables(valid_session, values)
+            validate(valid_session, epoch, iteration, training_state)
 
         # in order to avoid using mutable object as a default argument
         if valid_intervals is None:
@@ -109,62 +168,140 @@ class CharLSTM(object):
             valid_intervals = [2 ** i for i in range(9)]
 
         retrain = True if self._session else False
-        fit_encoder = False if self._encoder.is_fit else True
-        X = self._encode_chars(samples, fit=fit_encoder)
-        X_train, X_valid = train_test_split(
-            X, random_state=self._random_state, test_size=valid_size)
-
-        X_valid, Y_valid = self._create_Y(X_valid)
-        X_valid, Y_valid, seq_lens_valid = self._add_padding(X_valid, Y_valid)
+        if resume:
+            if not retrain:
+                raise ValueError('Load the model by load(model_path, resume=True) to resume the '
+                                 'training.')
+            training_state_path = os.path.join(get_checkpoint_path(model_path, LATEST),
+                                               self._training_state_file_name)
+            if not os.path.exists(training_state_path):
+                raise ValueError('The latest checkpoint in {} has no training state to resume '
+                                 'from (e.g. it was written by data-parallel training).'
+                                 .format(model_path))
+            with open(training_state_path, 'rb') as pickle_file:
+                training_state = pickle.load(pickle_file)
+        tokens, offsets, train_ids, valid_ids = self._encode_and_split(
+            samples, valid_size, cache_dir, cache_size)
+        # batch validation samples of similar lengths together
+        valid_ids = valid_ids[np.argsort(np.diff(offsets)[valid_ids], kind='stable')]
 
         if not retrain:
             self._build_graph()
+            if autotune:
+                self.autotune(batch_size=batch_size)
+        elif autotune:
+            _LOGGER.warning('autotune is ignored when retraining a loaded model, load the model '
+                            'with load(autotune=True) instead.')
         nodes = self._nodes
-        train_size = len(X_train)
-        train_batch_generator = BatchGenerator(X_train, batch_size)
-        best_perplexity = np.float64('inf')
+        train_size = len(train_ids)
+        if stateful:
+            train_batch_generator = StreamBatchGenerator(
+                select_samples(tokens, offsets, train_ids), batch_size, num_steps,
+                self._segment_char_id, random_state=self._random_state)
+        else:
+            train_batch_generator = BatchGenerator(
+                (tokens, offsets), batch_size, self._segment_char_id, self._padding_id,
+                random_state=self._random_state, bucket_size=bucket_size, max_tokens=max_tokens,
+                indices=train_ids)
+        if resume:
+            train_batch_generator.set_state(training_state['generator_state'])
+        if prefetch:
+            train_batch_generator = PrefetchIterator(
+                train_batch_generator, prefetch,
+                attributes=['padding_ratio', 'state', 'reset_states', 'num_samples'] if stateful
+                else ['padding_ratio', 'state'])
+        best_perplexity = training_state['best_perplexity'] if resume else np.float64('inf')
 
         # Launch the graph
-        session = self._session if retrain else tf.Session(graph=self._graph)
+        session = self._session if retrain else self._create_session()
         summary_writer = tf.summary.FileWriter(
             os.path.join(model_path, self._tensorboard_dir), session.graph)
         if not retrain:
             session.run(nodes['init'])
         losses = list()
-        iteration = 0
-        valid_interval = valid_intervals.pop(0)
-        self._set_target_vocabs(X, session, nodes)
+        if resume:
+            iteration = training_state['iteration']
+            start_batch_id = training_state['batch_id']
+            valid_interval = training_state['valid_interval']
+            valid_intervals = training_state['valid_intervals']
+            states = training_state['lstm_states']
+            _LOGGER.info('Resume the training from Iter={:,}.'.format(iteration))
+        else:
+            iteration = 0
+            start_batch_id = 0
+            valid_interval = valid_intervals.pop(0)
+            states = None
+        self._set_target_vocabs(tokens, session, nodes)
         _LOGGER.info('Start fitting a model...')
 
-        # profiler
+        # profiler (validation isn't profiled when it runs asynchronously)
         run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE) if profile else None
         run_metadata = tf.RunMetadata() if profile else None
 
+        # checkpoints are written by a session of their own in the background
+        save_session = self._create_session()
+        checkpointer = AsyncCheckpointer(
+            model_path, partial(self._write_checkpoint, save_session), keep_checkpoints)
+
+        if async_validation:
+            valid_session = self._create_session()
+            valid_executor = ThreadPoolExecutor(max_workers=1)
+            valid_future = None
+
         # iterate over batches
-        for batch_id, X_batch in enumerate(train_batch_generator):
+        generator_state = train_batch_generator.state
+        for batch_id, (X_batch, Y_batch, seq_lens) in enumerate(train_batch_generator,
+                                                                start_batch_id):
             epoch = 1 + iteration // train_size
+            # the state of the batch generator before this batch
+            batch_state, generator_state = generator_state, train_batch_generator.state
 
-            if batch_id % valid_interval == 0:
-                best_perplexity = validate(
-                    X_valid, Y_valid, seq_lens_valid, batch_id, best_perplexity, summary_writer)
-                self._generate(session)
+            # (the model was validated at the batch the training is resumed from)
+            if batch_id % valid_interval == 0 and not (resume and batch_id == start_batch_id):
                 valid_interval = valid_intervals.pop(0) if valid_intervals else valid_interval
+                # everything needed to resume the training from this batch
+                training_state = {'iteration': iteration, 'batch_id': batch_id,
+                                  'valid_interval': valid_interval,
+                                  'valid_intervals': list(valid_intervals),
+                                  'generator_state': batch_state, 'lstm_states': states}
+                if not async_validation:
+                    validate(session, epoch, iteration, training_state)
+                elif valid_future is None or valid_future.done():
+                    if valid_future is not None:
+                        valid_future.result()  # raise the error of the previous validation if any
+                    valid_future = valid_executor.submit(
+                        validate_snapshot, session.run(nodes['global_variables']), epoch, iteration,
+                        training_state)
+                else:
+                    _LOGGER.info('Skip the validation at Iter={:,} as the previous one is still '
+                                 'running.'.format(iteration))
 
             if batch_id % summary_interval == 0:
                 summaries = session.run(nodes['summaries'])
                 summary_writer.add_summary(summaries, global_step=iteration)
 
-            X_batch, Y_batch = self._create_Y(X_batch)
-            X_batch, Y_batch, seq_lens = self._add_padding(X_batch, Y_batch)
-
-            # Predict labels and update the parameters
-            _, loss = session.run(
-                [nodes['optimizer'], nodes['loss']],
-                feed_dict={nodes['X']: X_batch, nodes['Y']: Y_batch,
-                           nodes['seq_lens']: seq_lens, nodes['is_train']: True},
-                options=run_options, run_metadata=run_metadata)
+            feed_dict = {nodes['X']: X_batch, nodes['Y']: Y_batch, nodes['seq_lens']: seq_lens,
+                         nodes['is_train']: True}
+
+            if stateful:
+                # carry the states over from the previous window of the streams
+                if train_batch_generator.reset_states:
+                    states = np.zeros((self._num_rnn_layers, 2, batch_size, self._rnn_size),
+                                      dtype=np.float32)
+                feed_dict[nodes['initial_states']] = states
+
+                _, loss, states = session.run(
+                    [nodes['optimizer'], nodes['train_loss'], nodes['states']],
+                    feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+                states = np.array(states)
+                iteration += train_batch_generator.num_samples
+            else:
+                # Predict labels and update the parameters
+                _, loss = session.run(
+                    [nodes['optimizer'], nodes['train_loss']], feed_dict=feed_dict,
+                    options=run_options, run_metadata=run_metadata)
+                iteration += len(seq_lens)
             losses.append(loss)
-            iteration += batch_size
 
             if run_metadata:
                 with open('profile_train.json', 'w') as file_:
@@ -172,60 +309,242 @@ class CharLSTM(object):
                         timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
 
             if batch_id % stat_interval == 0:
-                perplexity = np.exp(np.mean(losses))  # cross entropy is log-perplexity
-                _LOGGER.info('Epoch={}, Iter={:,}, Mean Perplexity (Training batch)= {:.3f}'
-                             .format(epoch, iteration, perplexity))
+                metric, value = self._get_train_metric(losses)
+                _LOGGER.info('Epoch={}, Iter={:,}, Mean {} (Training batch)= {:.3f}, '
+                             'Padding Ratio={:.3f}'.format(epoch, iteration, metric, value,
+                                                           train_batch_generator.padding_ratio))
                 losses = list()
-                add_metric_summary(summary_writer, 'train', iteration, perplexity)
+                add_metric_summary(summary_writer, 'train', iteration, value,
+                                   metric.lower().replace(' ', '_'))
 
             if iteration > patience:
                 _LOGGER.info('Iteration is more than patience, finish training.')
                 break
 
+        if async_validation:
+            valid_executor.shutdown(wait=True)
+            valid_session.close()
+            if valid_future is not None:
+                valid_future.result()
+
+        checkpointer.close()
+        save_session.close()
+
         _LOGGER.info('Finished fitting the model.')
         _LOGGER.info('Best perplexity: {:.3f}'.format(best_perplexity))
 
-        # close the session
+        # stop prefetching batches and close the session
+        if prefetch:
+            train_batch_generator.close()
         session.close()
 
-    def _set_target_vocabs(self, X, session, nodes):
-        """Set target vocabulary IDs from word IDs of samples."""
-        target_vocab_ids = set(chain.from_iterable(X))
-        target_vocab_ids.add(self._segment_char_id)
-        target_vocab_ids = list(target_vocab_ids)
+    def _train_data_parallel(self, samples, model_path, allreduce, batch_size=128, patience=819200,
+                             learning_rate_scale=1., stat_interval=25, valid_intervals=None,
+                             valid_size=0.1, valid_max_tokens=_VALID_MAX_TOKENS, bucket_size=None,
+                             max_tokens=None, cache_dir=None, cache_size=_DEFAULT_CACHE_SIZE,
+                             keep_checkpoints=3):
+        """
+        Train a language model as a worker of synchronous data-parallel training (see
+        langdist.distributed, which runs this in every worker process).
+
+        Every worker trains on its shard of the training samples, and the gradients of the workers
+        are summed by allreduce, weighted by the number of characters of their batches, such that
+        a step is the same as a step on the union of their batches. The first worker validates the
+        model and saves checkpoints (which can't be used for train(resume=True)).
+
+        :param allreduce: langdist.distributed.SharedMemoryAllreduce attached to the worker
+        :param batch_size: the number of samples per batch of a worker
+        :param learning_rate_scale: the learning rate is multiplied by this (e.g. the number of
+                                    workers when the effective batch size grows with it)
+        :return: dict of the statistics of the training (filled by the first worker only)
+        """
+        rank, num_workers = allreduce.rank, allreduce.num_workers
+        if valid_intervals is None:
+            valid_intervals = [2 ** i for i in range(9)]
+
+        # the first worker encodes (and caches) the corpus before the others read it from the cache
+        if rank == 0:
+            tokens, offsets, train_ids, valid_ids = self._encode_and_split(
+                samples, valid_size, cache_dir, cache_size)
+        allreduce.barrier()
+        if rank != 0:
+            tokens, offsets, train_ids, valid_ids = self._encode_and_split(
+                samples, valid_size, cache_dir, cache_size)
+        valid_ids = valid_ids[np.argsort(np.diff(offsets)[valid_ids], kind='stable')]
+
+        retrain = True if self._session else False
+        if not retrain:
+            self._build_graph()
+        nodes = self._nodes
+        session = self._session if retrain else self._create_session()
+        if not retrain:
+            session.run(nodes['init'])
+        self._set_target_vocabs(tokens, session, nodes)
+
+        # start from the variables of the first worker
+        variables = nodes['trainable_variables']
+        shapes = [variable.get_shape().as_list() for variable in variables]
+        split_indices = np.cumsum([int(np.prod(shape)) for shape in shapes])[:-1]
+        values = allreduce.broadcast(
+            np.concatenate([value.ravel() for value in session.run(variables)]))
+        for variable, value, shape in zip(variables, np.split(values, split_indices), shapes):
+            variable.load(value.reshape(shape), session)
+
+        train_batch_generator = PrefetchIterator(BatchGenerator(
+            (tokens, offsets), batch_size, self._segment_char_id, self._padding_id,
+            random_state=self._random_state + rank, bucket_size=bucket_size, max_tokens=max_tokens,
+            indices=train_ids[rank::num_workers]), attributes=['padding_ratio'])
+        learning_rate = self._learning_rate * learning_rate_scale
+        if rank == 0:
+            save_session = self._create_session()
+            checkpointer = AsyncCheckpointer(
+                model_path, partial(self._write_checkpoint, save_session), keep_checkpoints)
+
+        best_perplexity = np.float64('inf')
+        losses = list()
+        iteration = 0
+        valid_interval = valid_intervals.pop(0)
+        stats = dict()
+        start_time, start_iteration = None, 0
+        _LOGGER.info('Start fitting a model (worker {} of {})...'.format(rank, num_workers))
+
+        for batch_id, (X_batch, Y_batch, seq_lens) in enumerate(train_batch_generator):
+            epoch = 1 + iteration // len(train_ids)
+
+            if batch_id % valid_interval == 0:
+                if rank == 0:
+                    log_prob, char_num = self._evaluate(session, tokens, offsets, valid_ids,
+                                                        valid_max_tokens)
+                    perplexity = np.exp(-log_prob / max(char_num, 1))
+                    _LOGGER.info('Epoch={}, Iter={:,}, Mean Perplexity (Validation set)= {:.3f}'
+                                 .format(epoch, iteration, perplexity))
+                    if perplexity < best_perplexity:
+                        _LOGGER.info('Best perplexity so far, save the model.')
+                        self._save(checkpointer, session, iteration)
+                        best_perplexity = perplexity
+                valid_interval = valid_intervals.pop(0) if valid_intervals else valid_interval
+
+            gradients, loss = session.run(
+                [nodes['gradients'], nodes['train_loss']],
+                feed_dict={nodes['X']: X_batch, nodes['Y']: Y_batch, nodes['seq_lens']: seq_lens,
+                           nodes['is_train']: True})
+
+            # sum the gradients and the losses weighted by the number of characters of the batches
+            char_num = float(seq_lens.sum())
+            summed = allreduce.allreduce(np.concatenate(
+                [gradient.ravel() * char_num for gradient in gradients] +
+                [[loss * char_num, char_num, len(seq_lens)]]))
+            char_num = summed[-2]
+            feed_dict = {gradient_input: gradient.reshape(shape) / char_num
+                         for gradient_input, gradient, shape
+                         in zip(nodes['gradient_inputs'], np.split(summed[:-3], split_indices),
+                                shapes)}
+            feed_dict[nodes['learning_rate']] = learning_rate
+            session.run(nodes['apply_gradients'], feed_dict=feed_dict)
+            iteration += int(summed[-1])
+            losses.append(summed[-3] / char_num)
+
+            # measure the throughput from the second step on (the first one warms up)
+            if start_time is None:
+                start_time, start_iteration = time.perf_counter(), iteration
+
+            if rank == 0 and batch_id % stat_interval == 0:
+                metric, value = self._get_train_metric(losses)
+                _LOGGER.info('Epoch={}, Iter={:,}, Mean {} (Training batch)= {:.3f}, '
+                             'Padding Ratio={:.3f}'.format(epoch, iteration, metric, value,
+                                                           train_batch_generator.padding_ratio))
+                losses = list()
+
+            if iteration > patience:
+                _LOGGER.info('Iteration is more than patience, finish training.')
+                break
+
+        train_batch_generator.close()
+        if rank == 0:
+            checkpointer.close()
+            save_session.close()
+            seconds = time.perf_counter() - start_time
+            stats = {'iteration': iteration, 'best_perplexity': float(best_perplexity),
+                     'seconds': seconds,
+                     'samples_per_second': (iteration - start_iteration) / max(seconds, 1e-9)}
+            _LOGGER.info('Finished fitting the model ({:.1f} samples/sec).'
+                         .format(stats['samples_per_second']))
+        session.close()
+        return stats
+
+    def _get_train_metric(self, losses):
+        """Return the name and the value of the metric logged for the losses of training batches."""
+        if self._softmax_loss == 'sampled':
+            # exp of the sampled loss isn't the perplexity (the softmax is over sampled characters)
+            return 'Sampled Softmax Loss', float(np.mean(losses))
+        return 'Perplexity', float(np.exp(np.mean(losses)))  # cross entropy is log-perplexity
+
+    def _set_target_vocabs(self, word_ids, session, nodes, chunk_size=2 ** 24):
+        """Set target vocabulary IDs from word IDs of samples (flat array of word IDs)."""
+        # count word IDs chunk by chunk such that (memory-mapped) word_ids are never copied at once
+        word_ids = np.asarray(word_ids, dtype=np.int32)
+        is_target = np.zeros(self._vocab_size, dtype=bool)
+        for start_index in range(0, len(word_ids), chunk_size):
+            is_target |= np.bincount(word_ids[start_index: start_index + chunk_size],
+                                     minlength=self._vocab_size) > 0
+        is_target[self._segment_char_id] = True
+        target_vocab_ids = np.flatnonzero(is_target).astype(np.int32)
         session.run(nodes['assign_target_vocab_ids'],
                     feed_dict={nodes['target_vocab_ids']: target_vocab_ids})
 
-        orig_id2target_id = [target_vocab_ids.index(id_) if id_ in target_vocab_ids else 0
-                             for id_ in range(self._vocab_size)]
+        orig_id2target_id = np.zeros(self._vocab_size, dtype=np.int32)
+        orig_id2target_id[target_vocab_ids] = np.arange(len(target_vocab_ids), dtype=np.int32)
         session.run(nodes['assign_orig_id2target_id'],
                     feed_dict={nodes['orig_id2target_id']: orig_id2target_id})
 
-        self._target_vocab_ids = target_vocab_ids
+        self._target_vocab_ids = target_vocab_ids.tolist()
 
     @classmethod
-    def load(cls, model_path):
+    def load(cls, model_path, session_config=None, autotune=False, resume=False, cell_type=None):
         """
         Load the model from the saved model directory.
 
         :param model_path: path to the model directory you want to load the model from.
+        :param session_config: if given, run the model with this SessionConfig instead of the one
+                               saved with the model
+        :param autotune: if True, benchmark a few session configurations and run the model with the
+                         fastest one
+        :param resume: if True, load the latest checkpoint (instead of the best one) including the
+                       states of the optimizer in order to resume its training by
+                       train(resume=True)
+        :param cell_type: if given, run the model with this cell type instead of the one it was
+                          trained with (checkpoints are interchangeable between the cell types)
         :return: instance of the model
         """
         _LOGGER.debug('Started loading the model...')
+        checkpoint_path = get_checkpoint_path(model_path, LATEST if resume else BEST)
+
         # load the instance, set _model_path appropriately
-        with open(os.path.join(model_path, cls._instance_file_name), 'rb') as model_file:
+        with open(os.path.join(checkpoint_path, cls._instance_file_name), 'rb') as model_file:
             instance = pickle.load(model_file)
+        if session_config is not None:
+            instance._session_config = session_config
+        if cell_type is not None:
+            assert cell_type in _CELL_TYPES, 'cell_type must be one of {}'.format(_CELL_TYPES)
+            instance._cell_type = cell_type
 
         # build the graph and restore the session
         instance._build_graph()
-        instance._session = tf.Session(graph=instance._graph)
+        if autotune:
+            instance.autotune()
+        instance._session = instance._create_session()
         instance._session.run(instance._nodes['init'])
+        if resume:
+            instance._nodes['saver'].restore(
+                instance._session, os.path.join(checkpoint_path, instance._checkpoint_file_name))
+            _LOGGER.debug('Finished loading the model.')
+            return instance
 
         # this is in order to cope with older code that uses self._target_vocab_ids
         instance._set_target_vocabs(
-            [instance._target_vocab_ids], instance._session, instance._nodes)
+            instance._target_vocab_ids, instance._session, instance._nodes)
         instance._nodes['saver_without_target_vocab_ids'].restore(
-            instance._session, os.path.join(model_path, instance._checkpoint_file_name))
+            instance._session, os.path.join(checkpoint_path, instance._checkpoint_file_name))
 
         # initialize only variables relating to optimizer again such that we can retrain a model
         instance._session.run(instance._nodes['init_optimizer'])
@@ -233,7 +552,66 @@ class CharLSTM(object):
         _LOGGER.debug('Finished loading the model.')
         return instance
 
-    def generate(self, sample_num=10, prompts=None, pick_top_k=10, max_char_len=300, log=False):
+    def autotune(self, mode='train', batch_size=128, seq_len=100, candidates=None):
+        """
+        Benchmark session configurations on a synthetic batch and use the fastest one from the next
+        session on (it's saved along with the model).
+
+        :param mode: 'train' to benchmark training steps, 'generate' to benchmark inference steps
+        :param batch_size: the number of samples in the synthetic batch
+        :param seq_len: the number of characters per sample in the synthetic batch
+        :param candidates: list of SessionConfig to compare (runtime.get_candidate_configs() if
+                           None)
+        :return: the fastest SessionConfig
+        """
+        fetch, feed_dict = self._get_benchmark_step(mode, batch_size, seq_len)
+        self._session_config = autotune_session_config(
+            self._create_benchmark_session, lambda session: session.run(fetch, feed_dict),
+            candidates)[0]
+        return self._session_config
+
+    def _get_benchmark_step(self, mode, batch_size, seq_len):
+        """Return the node to fetch and the feed dict of a step on a synthetic batch."""
+        assert mode in ('train', 'generate'), "mode must be either 'train' or 'generate'"
+        nodes = self._nodes
+        random_state = np.random.RandomState(self._random_state)
+        if mode == 'train':
+            X = random_state.randint(self._vocab_size, size=(batch_size, seq_len), dtype=np.int32)
+            return nodes['optimizer'], {
+                nodes['X']: X, nodes['Y']: np.roll(X, -1, axis=1),
+                nodes['seq_lens']: np.full(batch_size, seq_len, dtype=np.int32),
+                nodes['is_train']: True}
+
+        return nodes['step_probs'], {
+            nodes['step_X']: random_state.randint(self._vocab_size, size=batch_size,
+                                                  dtype=np.int32),
+            nodes['step_states']: np.zeros(
+                (self._num_rnn_layers, 2, batch_size, self._rnn_size), np.float32)}
+
+    def _create_benchmark_session(self, session_config):
+        """Create a session whose target vocabulary is the whole vocabulary."""
+        nodes = self._nodes
+        session = tf.Session(graph=self._graph, config=session_config.to_config_proto())
+        session.run(nodes['init'])
+        vocab_ids = np.arange(self._vocab_size, dtype=np.int32)
+        session.run([nodes['assign_target_vocab_ids'], nodes['assign_orig_id2target_id']],
+                    feed_dict={nodes['target_vocab_ids']: vocab_ids,
+                               nodes['orig_id2target_id']: vocab_ids})
+        return session
+
+    @property
+    def session_config(self):
+        """SessionConfig of the sessions the model runs on (None for the default of tensorflow)."""
+        return self._session_config
+
+    def _create_session(self):
+        """Create a session of the graph configured by the session config."""
+        if self._session_config is None:
+            return tf.Session(graph=self._graph)
+        return tf.Session(graph=self._graph, config=self._session_config.to_config_proto())
+
+    def generate(self, sample_num=10, prompts=None, pick_top_k=10, max_char_len=300, log=False,
+                 top_p=None, temperature=1.0, random_state=None):
         """
         Generate samples of characters using a trained model running on the given session.
         
@@ -243,25 +621,326 @@ class CharLSTM(object):
         :param pick_top_k: if given, always sample from top k most probable characters
         :param max_char_len: the maximum length of characters to generate per text
         :param log: if True, log generated texts
+        :param top_p: if given, always sample from the smallest set of most probable characters
+                      whose cumulative probability is at least top_p (nucleus sampling)
+        :param temperature: sharpen (< 1.0) or flatten (> 1.0) the predicted distributions (0 always
+                            picks the most probable character)
+        :param random_state: seed (or np.random.Generator) used for sampling
         :return: list of generated texts
         """
-        return self._generate(self._session, sample_num, prompts, pick_top_k, max_char_len, log)
+        return self._generate(self._session, sample_num, prompts, pick_top_k, max_char_len, log,
+                              top_p, temperature, random_state)
+
+    def beam_search(self, prompts=None, sample_num=1, beam_width=5, max_char_len=300,
+                    length_penalty=1.0, n_best=1, log=False):
+        """
+        Find the most probable texts following the given prompts by beam search (deterministic).
+
+        :param prompts: the first characters which you generate texts from (if None start from
+                        empty texts)
+        :param sample_num: the number of texts to generate (only used when prompts is None)
+        :param beam_width: the number of beams kept per text
+        :param max_char_len: the maximum length of characters per text (including the prompt),
+                             prompts of max_char_len characters or more are returned unchanged
+        :param length_penalty: exponent of the length normalisation of the scores (0. ranks texts
+                               by their log probability, which favours shorter texts)
+        :param n_best: the number of texts returned per prompt
+        :param log: if True, log generated texts
+        :return: list (per prompt) of lists of (text, score) sorted by score in descending order
+        """
+        if not prompts:
+            prompts = ['' for _ in range(sample_num)]
+
+        target_vocab_ids = np.array(self._target_vocab_ids)
+        tokens, offsets = self._encode_chars(list(prompts), fit=False, flat=True)
+        probs, states = self._prefill(self._session, tokens, offsets)
+
+        def step(X, states):
+            """Run a step of the model on the target vocabulary IDs X."""
+            return self._run_step(self._session, target_vocab_ids[X], states)
+
+        end_id = int(np.searchsorted(target_vocab_ids, self._segment_char_id))
+        results = beam_search(step, probs, states, end_id, max_char_len - np.diff(offsets),
+                              beam_width, length_penalty, n_best)
+
+        texts = list()
+        for prompt_id, hypotheses in enumerate(results):
+            prompt = tokens[offsets[prompt_id]: offsets[prompt_id + 1]].tolist()
+            decoded = self._decode_chars(
+                [prompt + target_vocab_ids[ids].tolist() for ids, _ in hypotheses])
+            texts.append([(text.strip(), score)
+                          for text, (_, score) in zip(decoded, hypotheses)])
+
+        if log:
+            _LOGGER.info('Generated Samples: \n{}'.format(
+                '\n'.join(text for hypotheses in texts for text, _ in hypotheses)))
+        return texts
+
+    def score(self, texts, batch_size=128, sort_size=100):
+        """
+        Compute how likely the model generates the given texts, e.g. to measure how close the
+        language of the texts is to the language of the model.
+
+        Texts whose characters are unknown to the encoder or out of the vocabulary of the model get
+        -inf log probability, and are excluded from the perplexity (which is nan if all the texts
+        are excluded).
+
+        :param texts: iterable of texts (e.g. corpus.iter_corpus(path) to stream them from a file)
+        :param batch_size: the maximum number of texts per batch
+        :param sort_size: texts are sorted by length within chunks of sort_size * batch_size texts
+                          such that texts of similar lengths are batched together
+        :return: array of the log probability (in nats) of each text, array of the bits per
+                 character of each text, and the perplexity (per character) of all the texts
+        """
+        log_probs = list()
+        char_nums = list()
+        for log_prob, char_num in self.iter_scores(texts, batch_size, sort_size):
+            log_probs.append(log_prob)
+            char_nums.append(char_num)
+        log_probs = np.array(log_probs, dtype=np.float64)
+        char_nums = np.array(char_nums, dtype=np.int64)
+
+        bits_per_char = -log_probs / np.log(2) / char_nums
+        is_in_vocab = np.isfinite(log_probs)
+        perplexity = compute_perplexity(log_probs[is_in_vocab].sum(),
+                                        int(char_nums[is_in_vocab].sum()))
+        return log_probs, bits_per_char, perplexity
+
+    def iter_scores(self, texts, batch_size=128, sort_size=100):
+        """
+        Compute the log probability of texts lazily, such that texts streamed from a file are never
+        held in memory at once.
+
+        :param texts: iterable of texts or MmapCorpus (character IDs stored in it are used as they
+                      are if they are encoded by the encoder of the model)
+        :param batch_size: the maximum number of texts per batch
+        :param sort_size: texts are sorted by length within chunks of sort_size * batch_size texts
+        :return: generator of (log probability in nats, the number of characters including the end
+                 of the text) of each text, in the order of texts (the log probability is -inf if
+                 the text has characters unknown to the encoder or out of the vocabulary)
+        """
+        for tokens, offsets in iter_encoded_chunks(texts, self._encoder, sort_size * batch_size):
+            # texts with unknown characters (encoded into -1) aren't run through the model
+            is_known = find_known_samples(tokens, offsets)
+            if is_known.all():
+                log_probs = self._score_samples(self._session, tokens, offsets, batch_size)
+            else:
+                known_ids = np.flatnonzero(is_known)
+                log_probs = np.full(len(offsets) - 1, -np.inf, dtype=np.float64)
+                log_probs[known_ids] = self._score_samples(
+                    self._session, *select_samples(tokens, offsets, known_ids), batch_size)
+            yield from zip(log_probs.tolist(), (np.diff(offsets) + 1).tolist())
+
+    def rescore(self, candidates, length_penalty=1.0):
+        """
+        Score candidate texts (e.g. n-best outputs of another system) in batched passes and rank
+        them. The score of a text is its log probability (including the end of the text) divided
+        by its length (including the end) to the power of length_penalty, same as beam_search().
+
+        :param candidates: list of candidate texts
+        :param length_penalty: exponent of the length normalisation of the scores
+        :return: list of (text, score) sorted by score in descending order
+        """
+        tokens, offsets = self._encode_chars(list(candidates), fit=False, flat=True)
+        scores = (self._score_samples(self._session, tokens, offsets) /
+                  (np.diff(offsets) + 1) ** length_penalty)
+        ranking = np.argsort(-scores, kind='stable')
+        return [(candidates[candidate_id], float(scores[candidate_id]))
+                for candidate_id in ranking]
+
+    @property
+    def segment_char_id(self):
+        """Character ID of the segment character, which starts and ends every text."""
+        return self._segment_char_id
+
+    @property
+    def target_vocab_ids(self):
+        """Character IDs the probabilities returned by step() and prefill() are over."""
+        return list(self._target_vocab_ids)
+
+    def encode(self, texts):
+        """Encode texts into lists of character IDs (raise ValueError for unknown characters)."""
+        return self._encode_chars(list(texts), fit=False)
+
+    def decode(self, char_ids):
+        """Decode lists of character IDs into texts."""
+        return self._decode_chars(char_ids)
+
+    def zero_states(self, batch_size):
+        """
+        Return the states of texts which nothing has been fed into yet, to start step() from (feed
+        the segment character first).
+
+        :return: array of shape [num_rnn_layers, 2, batch_size, rnn_size]
+        """
+        return np.zeros((self._num_rnn_layers, 2, batch_size, self._rnn_size), dtype=np.float32)
+
+    def step(self, X, states):
+        """
+        Feed a character into each text, e.g. to generate texts character by character.
+
+        :param X: array of character IDs of shape [batch_size]
+        :param states: array of states of shape [num_rnn_layers, 2, batch_size, rnn_size]
+        :return: probabilities over target_vocab_ids of shape [batch_size, len(target_vocab_ids)]
+                 and the next states
+        """
+        return self._run_step(self._session, X, states)
+
+    def prefill(self, prompts):
+        """
+        Feed prompts (with the segment character prepended) into the model at once, such that
+        step() continues from the returned states.
+
+        :param prompts: list of prompts (raise ValueError for characters unknown to the encoder)
+        :return: probabilities over target_vocab_ids after the last character of each prompt, and
+                 the states after it
+        """
+        return self._prefill(self._session,
+                             *self._encode_chars(list(prompts), fit=False, flat=True))
+
+    def _score_samples(self, session, tokens, offsets, batch_size=None,
+                       max_tokens=_PREFILL_MAX_TOKENS):
+        """
+        Compute the log probability of encoded samples (including the segment character that ends
+        them). Samples are sorted by length and batched up to batch_size samples and max_tokens
+        padded characters per batch.
+
+        :param tokens: flat buffer of character IDs of the samples
+        :param offsets: offsets of the samples in tokens
+        :return: array of the natural log probability of each sample (-inf if the sample contains
+                 characters out of the target vocabulary)
+        """
+        sample_num = len(offsets) - 1
+        log_probs = np.empty(sample_num, dtype=np.float64)
+        sample_ids = np.argsort(np.diff(offsets), kind='stable')
+        for batch_ids, batch_log_probs in self._iter_log_probs(
+                session, tokens, offsets, sample_ids, batch_size, max_tokens):
+            log_probs[batch_ids] = batch_log_probs
+
+        # the model never generates characters out of the target vocabulary
+        is_target = np.zeros(self._vocab_size, dtype=bool)
+        is_target[self._target_vocab_ids] = True
+        out_of_vocab_positions = np.flatnonzero(~is_target[tokens])
+        log_probs[np.searchsorted(offsets, out_of_vocab_positions, side='right') - 1] = -np.inf
+        return log_probs
+
+    def _evaluate(self, session, tokens, offsets, sample_ids, max_tokens=_VALID_MAX_TOKENS,
+                  options=None, run_metadata=None):
+        """
+        Compute the total log probability of the samples and their total number of characters
+        (including the segment characters that end them) in a single pass over batches of up to
+        max_tokens padded characters, such that the memory doesn't grow with the number of samples.
+
+        :param sample_ids: indices of the samples to evaluate (sort them by length beforehand to
+                           minimise padding)
+        :return: the natural log probability and the number of characters
+        """
+        log_prob = 0.
+        char_num = 0
+        lengths = np.diff(offsets)
+        for batch_ids, batch_log_probs in self._iter_log_probs(
+                session, tokens, offsets, sample_ids, None, max_tokens, options, run_metadata):
+            log_prob += float(np.sum(batch_log_probs, dtype=np.float64))
+            char_num += int(lengths[batch_ids].sum()) + len(batch_ids)
+        return log_prob, char_num
+
+    def _iter_log_probs(self, session, tokens, offsets, sample_ids, batch_size=None,
+                        max_tokens=_PREFILL_MAX_TOKENS, options=None, run_metadata=None):
+        """
+        Yield batches of sample indices and the log probability of each sample, in the order of
+        sample_ids. Batches have up to batch_size samples and max_tokens padded characters.
+        """
+        nodes = self._nodes
+        lengths = np.diff(offsets)
+        batch_size = batch_size or max(len(sample_ids), 1)
+        for start_index in range(0, len(sample_ids), batch_size):
+            batch_ids = sample_ids[start_index: start_index + batch_size]
+            for token_batch_ids in split_by_tokens(batch_ids, lengths[batch_ids] + 1, max_tokens):
+                X, Y, seq_lens = pad_batch(tokens, offsets, token_batch_ids,
+                                           self._segment_char_id, self._padding_id)
+                yield token_batch_ids, session.run(
+                    nodes['log_probs'], feed_dict={nodes['X']: X, nodes['Y']: Y,
+                                                   nodes['seq_lens']: seq_lens,
+                                                   nodes['is_train']: False},
+                    options=options, run_metadata=run_metadata)
+
+    def _run_step(self, session, X, states):
+        """
+        Run a single step of the model using the inference graph.
 
-    def _save(self, model_path, session):
-        """Save the tensorflow session and the instance object of this Python class."""
-        if not os.path.exists(model_path):
-            os.makedirs(model_path)
+        :param X: array of character IDs of shape [batch_size]
+        :param states: array of LSTM states of shape [num_rnn_layers, 2, batch_size, rnn_size]
+        :return: probabilities over the target vocabulary and the next states
+        """
+        nodes = self._nodes
+        return session.run([nodes['step_probs'], nodes['step_next_states']],
+                           feed_dict={nodes['step_X']: X, nodes['step_states']: states})
 
-        # save the session
-        self._nodes['saver'].save(session, os.path.join(model_path, self._checkpoint_file_name))
+    def _prefill(self, session, tokens, offsets, max_tokens=_PREFILL_MAX_TOKENS):
+        """
+        Run encoded prompts (with the segment character prepended) through the model. Prompts are
+        sorted by length and batched up to max_tokens padded characters per call, such that
+        prompts of mixed lengths don't waste computation on padding.
+
+        :param tokens: flat buffer of character IDs of the prompts
+        :param offsets: offsets of the prompts in tokens
+        :return: probabilities over the target vocabulary after the last character of each prompt
+                 and the states after it (of shape [num_rnn_layers, 2, num_prompts, rnn_size])
+        """
+        nodes = self._nodes
+        prompt_num = len(offsets) - 1
+        probs = np.empty((prompt_num, len(self._target_vocab_ids)), dtype=np.float32)
+        states = np.empty((self._num_rnn_layers, 2, prompt_num, self._rnn_size), dtype=np.float32)
+
+        lengths = np.diff(offsets)
+        prompt_ids = np.argsort(lengths, kind='stable')
+        for batch_ids in split_by_tokens(prompt_ids, lengths[prompt_ids] + 1, max_tokens):
+            X, _, seq_lens = pad_batch(tokens, offsets, batch_ids, self._segment_char_id,
+                                       self._padding_id)
+            probs[batch_ids], states[:, :, batch_ids] = session.run(
+                [nodes['prefill_probs'], nodes['prefill_states']],
+                feed_dict={nodes['X']: X, nodes['seq_lens']: seq_lens, nodes['is_train']: False})
+        return probs, states
+
+    def _save(self, checkpointer, session, step, training_state=None, best=True):
+        """
+        Save the variables of the session (including the states of the optimizer) and the instance
+        object of this Python class. The variables are copied into host memory and written by the
+        checkpointer in the background.
+
+        :param training_state: if given, save this dict as well in order to resume the training
+        :param best: if True, the checkpoint is the best one so far (which load() loads)
+        """
 
-        # save the instance
-        instance = copy(self)
-        instance._graph = None  # _graph is not picklable
-        instance._nodes = None  # _nodes is not pciklable
-        instance._session = None  # _session is not pciklable
-        with open(os.path.join(model_path, self._instance_file_name), 'wb') as pickle_file:
+        def take_snapshot():
+            """Return the values of the variables and a picklable copy of the instance."""
+            instance = copy(self)
+            instance._graph = None  # _graph is not picklable
+            instance._nodes = None  # _nodes is not pciklable
+            instance._session = None  # _session is not pciklable
+            values = session.run(self._nodes['global_variables'])
+            return values, instance, training_state
+
+        checkpointer.save(step, take_snapshot, best)
+
+    def _write_checkpoint(self, session, checkpoint_path, snapshot):
+        """Write a snapshot taken by _save() into the directory using a session for saving."""
+        values, instance, training_state = snapshot
+        self._load_variables(session, values)
+        self._nodes['saver'].save(session,
+                                  os.path.join(checkpoint_path, self._checkpoint_file_name))
+        with open(os.path.join(checkpoint_path, self._instance_file_name), 'wb') as pickle_file:
             pickle.dump(instance, pickle_file)
+        if training_state is not None:
+            with open(os.path.join(checkpoint_path, self._training_state_file_name),
+                      'wb') as pickle_file:
+                pickle.dump(training_state, pickle_file)
+
+    def _load_variables(self, session, values):
+        """Assign values (in the order of nodes['global_variables']) to the variables."""
+        nodes = self._nodes
+        session.run(nodes['assign_variables'],
+                    feed_dict=dict(zip(nodes['variable_inputs'], values)))
 
     def _build_graph(self):
         """Build computational graph."""
@@ -286,6 +965,8 @@ class CharLSTM(object):
                 nodes['Y'] = tf.placeholder(tf.int32, [None, None], name='Y')
                 nodes['seq_lens'] = tf.placeholder(tf.int32, [None], name='seq_lens')
                 nodes['is_train'] = tf.placeholder(tf.bool, shape=[], name='is_train')
+                nodes['learning_rate'] = tf.placeholder_with_default(
+                    tf.constant(self._learning_rate, tf.float32), [], name='learning_rate')
                 rnn_dropouts = tf.where(nodes['is_train'], tf.constant(self._rnn_dropouts),
                                         tf.ones([self._num_rnn_layers]))
                 final_dropout = tf.where(
@@ -323,15 +1004,25 @@ class CharLSTM(object):
                 embedded = tf.nn.embedding_lookup(nodes['embeddings'], nodes['X'])
 
             with tf.name_scope('rnn_layer'):
-                cells = list()
-                for layer_id in range(self._num_rnn_layers):
-                    cell = LSTMCell(num_units=self._rnn_size)
-                    cell = DropoutWrapper(cell, input_keep_prob=rnn_dropouts[layer_id])
-                    cells.append(cell)
-
-                rnn_cell = MultiRNNCell(cells)
-                rnn_outputs, nodes['states'] = tf.nn.dynamic_rnn(
-                    rnn_cell, embedded, nodes['seq_lens'], initial_states, dtype=tf.float32)
+                if self._cell_type == 'fused':
+                    rnn_outputs, nodes['states'] = self._build_fused_rnn(
+                        embedded, initial_states, nodes['seq_lens'], rnn_dropouts)
+                    # cells that run a single step using the variables of the fused cells
+                    lstm_cells = [LSTMBlockCell(num_units=self._rnn_size)
+                                  for _ in range(self._num_rnn_layers)]
+                else:
+                    cell_class = LSTMBlockCell if self._cell_type == 'block' else LSTMCell
+                    lstm_cells = list()
+                    cells = list()
+                    for layer_id in range(self._num_rnn_layers):
+                        cell = cell_class(num_units=self._rnn_size)
+                        lstm_cells.append(cell)
+                        cell = DropoutWrapper(cell, input_keep_prob=rnn_dropouts[layer_id])
+                        cells.append(cell)
+
+                    rnn_cell = MultiRNNCell(cells)
+                    rnn_outputs, nodes['states'] = tf.nn.dynamic_rnn(
+                        rnn_cell, embedded, nodes['seq_lens'], initial_states, dtype=tf.float32)
 
                 # reshape rnn_outputs so we can compute activations for all the time steps at once
                 rnn_outputs = tf.reshape(rnn_outputs, [-1, self._rnn_size])
@@ -352,13 +1043,47 @@ class CharLSTM(object):
                 # compute mean loss after masking padding inputs easily by using sequence_loss
                 logits = tf.reshape(logits, [batch_size, max_seq_len, -1])
 
-                # convert back to original vocab_ids, add 0. probability for the other vocabs
+                # convert back to original vocab_ids, add 0. probability for the other vocabs (only
+                # computed when fetched, the training fetches the loss only)
                 nodes['Y_prob'] = tf.transpose(tf.scatter_nd(
                     indices=tf.expand_dims(target_vocab_ids, axis=1),
                     updates=tf.transpose(tf.nn.softmax(logits), [2, 0, 1]),
                     shape=[self._vocab_size, batch_size, max_seq_len]), [1, 2, 0])
                 nodes['Y_pred'] = tf.argmax(nodes['Y_prob'], axis=2)
 
+            with tf.name_scope('inference_step'):
+                # lean graph that runs a single step of the LSTM layers (sharing their variables)
+                # without dropout, and returns probabilities over the target vocabulary only
+                nodes['step_X'] = tf.placeholder(tf.int32, [None], name='step_X')
+                nodes['step_states'] = tf.placeholder(
+                    tf.float32, [self._num_rnn_layers, 2, None, self._rnn_size], 'step_states')
+                step_states = tf.unstack(nodes['step_states'], axis=0)
+                step_states = tuple(
+                    [LSTMStateTuple(step_states[layer_id][0], step_states[layer_id][1])
+                     for layer_id in range(self._num_rnn_layers)])
+
+                step_embedded = tf.nn.embedding_lookup(nodes['embeddings'], nodes['step_X'])
+                with tf.variable_scope('rnn', reuse=True):
+                    step_outputs, next_step_states = MultiRNNCell(lstm_cells)(
+                        step_embedded, step_states)
+
+                nodes['step_logits'] = tf.matmul(step_outputs, W_s) + b_s
+                nodes['step_probs'] = tf.nn.softmax(nodes['step_logits'])
+                nodes['step_next_states'] = tf.stack(
+                    [tf.stack([state.c, state.h]) for state in next_step_states],
+                    name='step_next_states')
+
+            with tf.name_scope('prefill'):
+                # probabilities over the target vocabulary at the last valid character of each
+                # sample only, and the states after it (dynamic_rnn stops updating the states of a
+                # sample after its seq_len)
+                last_ids = tf.range(batch_size) * max_seq_len + nodes['seq_lens'] - 1
+                last_outputs = tf.gather(rnn_outputs, last_ids)
+                nodes['prefill_probs'] = tf.nn.softmax(tf.matmul(last_outputs, W_s) + b_s)
+                nodes['prefill_states'] = tf.stack(
+                    [tf.stack([state.c, state.h]) for state in nodes['states']],
+                    name='prefill_states')
+
             with tf.variable_scope('optimizer') as scope:
                 # weights for sequence_loss, all 1 for actual entries and 0 for paddings
                 weights = tf.cast(tf.sequence_mask(nodes['seq_lens'], max_seq_len), tf.float32)
@@ -367,8 +1092,34 @@ class CharLSTM(object):
                 target_Y = tf.nn.embedding_lookup(orig_id2target_id, nodes['Y'])
 
                 nodes['loss'] = sequence_loss(logits=logits, targets=target_Y, weights=weights)
-                nodes['optimizer'] = tf.train.AdamOptimizer(self._learning_rate).minimize(
-                    nodes['loss'])
+
+                # loss minimised by the training, the exact loss above is used for evaluation
+                if self._softmax_loss == 'sampled':
+                    nodes['train_loss'] = self._build_sampled_loss(
+                        rnn_outputs, nodes['W_s'], nodes['b_s'], nodes['Y'], weights)
+                else:
+                    nodes['train_loss'] = nodes['loss']
+
+                # log probability of every target character (0. for paddings) and of every sample
+                nodes['token_log_probs'] = -weights * \
+                    tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target_Y, logits=logits)
+                nodes['log_probs'] = tf.reduce_sum(nodes['token_log_probs'], axis=1)
+
+                optimizer = tf.train.AdamOptimizer(nodes['learning_rate'])
+                grads_and_vars = [(gradient, variable) for gradient, variable
+                                  in optimizer.compute_gradients(nodes['train_loss'])
+                                  if gradient is not None]
+                nodes['optimizer'] = optimizer.apply_gradients(grads_and_vars)
+
+                # gradients computed and applied separately (e.g. averaged over workers between),
+                # both share the states of the optimizer with nodes['optimizer']
+                nodes['trainable_variables'] = [variable for _, variable in grads_and_vars]
+                nodes['gradients'] = [tf.convert_to_tensor(gradient)
+                                      for gradient, _ in grads_and_vars]
+                nodes['gradient_inputs'] = [tf.placeholder(tf.float32, variable.shape)
+                                            for variable in nodes['trainable_variables']]
+                nodes['apply_gradients'] = optimizer.apply_gradients(
+                    zip(nodes['gradient_inputs'], nodes['trainable_variables']))
 
                 # initialize variables relating to the optimizer
                 nodes['init_optimizer'] = tf.variables_initializer(
@@ -378,6 +1129,25 @@ class CharLSTM(object):
             # initialize the variables
             nodes['init'] = tf.global_variables_initializer()
 
+            with tf.name_scope('load_variables'):
+                # assign values to the variables (e.g. of a snapshot), the vocabulary variables are
+                # assigned through their placeholders of unknown shape as their static shape is (0,)
+                nodes['global_variables'] = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+                nodes['variable_inputs'] = list()
+                nodes['assign_variables'] = list()
+                for variable in nodes['global_variables']:
+                    if variable is target_vocab_ids:
+                        variable_input = nodes['target_vocab_ids']
+                        assign_variable = nodes['assign_target_vocab_ids']
+                    elif variable is orig_id2target_id:
+                        variable_input = nodes['orig_id2target_id']
+                        assign_variable = nodes['assign_orig_id2target_id']
+                    else:
+                        variable_input = tf.placeholder(variable.dtype.base_dtype, variable.shape)
+                        assign_variable = tf.assign(variable, variable_input)
+                    nodes['variable_inputs'].append(variable_input)
+                    nodes['assign_variables'].append(assign_variable)
+
             # count the number of parameters
             self._num_params = get_num_params()
             _LOGGER.debug('Total number of parameters = {:,}'.format(self._num_params))
@@ -402,92 +1172,151 @@ class CharLSTM(object):
         self._graph = graph
         self._nodes = nodes
 
-    def _add_padding(self, X, Y=None):
+    def _build_sampled_loss(self, rnn_outputs, W_s, b_s, Y, weights):
         """
-        Add paddings to X and Y in order to align the sequence lengths.
-
-        :param X: list of sequences of word IDs
-        :param Y: list of sequences of word IDs
-        :return: padded list of sequences of word IDs and list of sequence length before padding
+        Build the sampled softmax loss, which computes the logits of the targets and num_sampled
+        characters sampled by their frequencies (in the corpora the encoder was fit to) only,
+        instead of the logits of the whole target vocabulary.
+
+        :param rnn_outputs: outputs of the RNN layers of shape [batch_size * max_seq_len, rnn_size]
+        :param W_s: weights of the softmax layer over the whole vocabulary
+        :param b_s: biases of the softmax layer over the whole vocabulary
+        :param Y: target character IDs (original IDs) of shape [batch_size, max_seq_len]
+        :param weights: 1 for actual characters and 0 for paddings, of the same shape as Y
+        :return: mean loss per character
         """
-        max_len = max(len(x) for x in X)
-        seq_lens = list()
-
-        if not Y:
-            for x in X:
-                seq_lens.append(len(x))
-                pad_len = max_len - len(x)
-                x.extend([self._padding_id for _ in range(pad_len)])
-            return X, seq_lens
+        # characters never seen get a count of 1 such that they can still be sampled
+        unigrams = np.ones(self._vocab_size, dtype=np.float64)
+        char_counts = self._encoder.char_counts
+        if char_counts:
+            chars = list(char_counts)
+            unigrams[self._encoder.encode_flat(chars)[0]] += [char_counts[char] for char in chars]
+        # the segment character ends every sample (and isn't counted in char_counts)
+        unigrams[self._segment_char_id] += self._encoder.sample_num
+
+        num_sampled = min(self._num_sampled, self._vocab_size)
+        labels = tf.reshape(tf.cast(Y, tf.int64), [-1, 1])
+        sampled_values = tf.nn.fixed_unigram_candidate_sampler(
+            labels, num_true=1, num_sampled=num_sampled, unique=True, range_max=self._vocab_size,
+            distortion=0.75, unigrams=unigrams.tolist())
+        losses = tf.nn.sampled_softmax_loss(
+            weights=tf.transpose(W_s), biases=b_s, labels=labels, inputs=rnn_outputs,
+            num_sampled=num_sampled, num_classes=self._vocab_size, sampled_values=sampled_values)
+        weights = tf.reshape(weights, [-1])
+        return tf.reduce_sum(losses * weights) / tf.reduce_sum(weights)
+
+    def _build_fused_rnn(self, embedded, initial_states, seq_lens, rnn_dropouts):
+        """
+        Build the LSTM layers with LSTMBlockFusedCell, which runs all the time steps of a layer in a
+        single op. Variables are named after the ones of MultiRNNCell in dynamic_rnn, such that
+        checkpoints are interchangeable between the cell types.
 
-        for x, y in zip(X, Y):
-            seq_lens.append(len(x))
-            pad_len = max_len - len(x)
-            x.extend([self._padding_id for _ in range(pad_len)])
-            y.extend([self._padding_id for _ in range(pad_len)])
-        return X, Y, seq_lens
+        :return: outputs of the last layer (batch-major) and the final states of the layers
+        """
+        outputs = tf.transpose(embedded, [1, 0, 2])  # fused cells take time-major inputs
+        states = list()
+        for layer_id in range(self._num_rnn_layers):
+            with tf.variable_scope('rnn/multi_rnn_cell/cell_{}'.format(layer_id)):
+                cell = LSTMBlockFusedCell(self._rnn_size, name='lstm_cell')
+                outputs = tf.nn.dropout(outputs, rnn_dropouts[layer_id])
+                outputs, (c, h) = cell(outputs, initial_state=tuple(initial_states[layer_id]),
+                                       dtype=tf.float32, sequence_length=seq_lens)
+                states.append(LSTMStateTuple(c, h))
+        return tf.transpose(outputs, [1, 0, 2]), tuple(states)
+
+    def _encode_and_split(self, samples, valid_size, cache_dir=None,
+                          cache_size=_DEFAULT_CACHE_SIZE):
+        """
+        Encode samples (fitting the encoder if it isn't fit yet) and split them into training and
+        validation sets. If cache_dir is given, the result is cached on the disk.
 
-    def _create_Y(self, X):
+        :return: flat array of character IDs, offsets, and indices of training/validation samples
         """
-        Create Y (correct character sequences) based on X (input character sequences). Also prepend
-        the segment character to X (in order to learn the beginning of a sample).
+        if not self._encoder.is_fit:
+            self._fit_encoder(samples)
+
+        cache = None
+        if cache_dir and not (isinstance(samples, MmapCorpus) and samples.token_type == CHAR_IDS):
+            cache = EncodedCorpusCache(cache_dir, cache_size)
+            key = cache.make_key(hash_corpus(samples), self._encoder.fingerprint, valid_size,
+                                 self._random_state)
+            entry = cache.get(key, self._encoder)
+            if entry:
+                return entry
+
+        tokens, offsets = self._encode_chars(samples, fit=False, flat=True)
+        train_ids, valid_ids = train_test_split(
+            np.arange(len(offsets) - 1), random_state=self._random_state, test_size=valid_size)
+
+        if cache:
+            cache.put(key, tokens, offsets, train_ids, valid_ids, self._encoder)
+        return tokens, offsets, train_ids, valid_ids
+
+    def _encode_chars(self, samples, fit, flat=False):
         """
-        Y = list()
-        for x in X:
-            y = copy(x)
-            y.append(self._segment_char_id)
-            Y.append(y)
-            x.insert(0, self._segment_char_id)
-            assert len(x) == len(y), 'len(x) != len(y)'
-        return X, Y
+        Convert samples of characters into encoded characters (character IDs).
 
-    def _encode_chars(self, samples, fit):
-        """Convert samples of characters into encoded characters (character IDs)."""
+        :param samples: list of samples of characters or MmapCorpus
+        :param flat: if True, return a flat array of character IDs and an offsets array instead of
+                     a list of lists of character IDs
+        """
         if fit:
-            encoded_samples = self._encoder.fit_encode(samples)
-            self._vocab_size = self._encoder.vocab_size
-            self._segment_char = self._encoder.segment_char
-            self._segment_char_id = self._encoder.segment_char_id
+            self._fit_encoder(samples)
+
+        if isinstance(samples, MmapCorpus):
+            char_ids, offsets = samples.encode(self._encoder)
+            if flat:
+                return char_ids, offsets
+            return [sample.tolist() for sample in np.split(char_ids, offsets[1:-1])]
+
+        if flat:
+            return self._encoder.encode_flat(samples)
+        return self._encoder.encode(samples)
+
+    def _fit_encoder(self, samples):
+        """Fit the encoder to samples of characters (or MmapCorpus) and set vocabulary info."""
+        if isinstance(samples, MmapCorpus):
+            self._encoder.fit([])
+            samples.fit_encoder(self._encoder)
         else:
-            encoded_samples = self._encoder.encode(samples)
-        return encoded_samples
+            self._encoder.fit(samples)
+        self._vocab_size = self._encoder.vocab_size
+        self._segment_char = self._encoder.segment_char
+        self._segment_char_id = self._encoder.segment_char_id
 
     def _decode_chars(self, samples):
         """Convert samples of encoded character IDs into decoded characters."""
         return self._encoder.decode(samples)
 
     def _generate(self, session, sample_num=10, prompts=None, pick_top_k=10, max_char_len=300,
-                  log=True):
+                  log=True, top_p=None, temperature=1.0, random_state=None):
         """Generate samples of characters using a trained model running on the given session."""
 
-        def generate_chars_from_probs(Y_prob):
-            """Generate a character for each sample based on the predicted probabilities."""
-            Y_prob = np.squeeze(Y_prob, axis=1)
-            chars = list()
-            for y_prob in Y_prob:
-                if pick_top_k:
-                    y_prob[np.argsort(y_prob)[:-pick_top_k]] = 0
-                    y_prob /= np.sum(y_prob)
-                chars.append(np.random.choice(self._vocab_size, 1, p=y_prob)[0])
-            return chars
+        def generate_chars_from_probs(probs):
+            """
+            Generate a character for each sample based on the predicted probabilities over the
+            target vocabulary.
+            """
+            return target_vocab_ids[sample_from_probs(probs, random_state, pick_top_k, top_p,
+                                                      temperature)]
+
+        random_state = np.random.default_rng(random_state)
+        target_vocab_ids = np.array(self._target_vocab_ids)
+        sample_ids = list(range(sample_num))  # IDs of samples to still generate
 
         if prompts:
             assert sample_num == len(prompts), 'sample_num != len(prompts)'
-            samples = self._encode_chars(list(prompts), fit=False)
         else:
-            samples = [[self._segment_char_id] for _ in range(sample_num)]
+            prompts = ['' for _ in range(sample_num)]
 
-        X, seq_lens = self._add_padding(samples)
-        sample_ids = list(range(sample_num))  # IDs of samples to still generate
-        nodes = self._nodes
-        initial_states = np.zeros((self._num_rnn_layers, 2, sample_num, self._rnn_size))
+        # run all the prompts at once, then generate characters step by step
+        tokens, offsets = self._encode_chars(list(prompts), fit=False, flat=True)
+        probs, states = self._prefill(session, tokens, offsets)
+        samples = [tokens[offsets[sample_id]: offsets[sample_id + 1]].tolist()
+                   for sample_id in range(sample_num)]
 
         while len(max(samples, key=len)) < max_char_len:
-            Y_prob, states = session.run(
-                [nodes['Y_prob'], nodes['states']],
-                feed_dict={nodes['X']: X, nodes['seq_lens']: seq_lens, nodes['is_train']: False,
-                           nodes['initial_states']: initial_states})
-            sampled_char_ids = generate_chars_from_probs(Y_prob)
+            sampled_char_ids = generate_chars_from_probs(probs)
             next_sample_ids = list()
 
             for sequence_id, sample_id in enumerate(sample_ids):
@@ -506,12 +1335,11 @@ class CharLSTM(object):
 
             # prepare next input
             # don't process samples that already finish sampling
-            sample_ids = [sample_ids[sample_id] for sample_id in next_sample_ids]
-            initial_states = np.array(states)[:, :, np.array(next_sample_ids)]
-            X = list()
-            for sample_id in sample_ids:
-                X.append([samples[sample_id][-1]])
-            X, seq_lens = self._add_padding(X)
+            if len(next_sample_ids) < len(sample_ids):
+                sample_ids = [sample_ids[sample_id] for sample_id in next_sample_ids]
+                states = states[:, :, np.array(next_sample_ids)]
+            X = np.array([samples[sample_id][-1] for sample_id in sample_ids], dtype=np.int32)
+            probs, states = self._run_step(session, X, states)
 
         samples = self._decode_chars(samples)
         samples = [sample.strip() for sample in samples]
@@ -2,17 +2,25 @@
 """
 This module is used to preprocess corpora.
 """
+import os
 import pickle
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import regex
 
-from langdist.util import CorpusParser
+from langdist.util import CorpusParser, get_logger
+
+_LOGGER = get_logger(__name__)
 
 __author__ = 'kensk8er'
 
 _SENTENCE_BORDER_REGEX = regex.compile(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\!|\?)\s')
 _SENTENCE_BORDER_REGEX_ZH = regex.compile(r'\.|\?|\!|。|．|！|？')
 _MAX_SENTENCE_LEN = 500
+_CHUNK_SIZE = 2000  # the number of paragraphs per chunk sent to a worker process
+_RAW_CORPUS_EXTENSION = '.txt'
 
 
 def _sent_tokenize(paragraph, lang_code):
@@ -40,6 +48,24 @@ def _preprocess(paragraph, lang_code):
     return (sentence.strip() for sentence in _sent_tokenize(paragraph, lang_code))
 
 
+def _preprocess_paragraphs(paragraphs, lang_code):
+    """
+    Preprocess paragraphs into sentences, filtering out empty and too long sentences.
+
+    :return: list of sentences, the number of bytes processed and the time spent
+    """
+    start_time = time.perf_counter()
+    corpus = list()
+    num_bytes = 0
+    for paragraph in paragraphs:
+        num_bytes += len(paragraph.encode('utf-8'))
+        sentences = _preprocess(paragraph, lang_code)
+        for sentence in sentences:
+            if sentence and len(sentence) < _MAX_SENTENCE_LEN:
+                corpus.append(sentence)
+    return corpus, num_bytes, time.perf_counter() - start_time
+
+
 def preprocess_corpus(xml_corpus_path, processed_corpus_path):
     """
     Preprocess the raw xml corpus that was downloaded from Multilingual Bible Parallel Corpus
@@ -48,15 +74,133 @@ def preprocess_corpus(xml_corpus_path, processed_corpus_path):
     :param xml_corpus_path: locale of the corpus to preprocess
     :param processed_corpus_path: path to the .pkl file that you save the preprocessed corpus to
     """
-    corpus = list()
     parser = CorpusParser(xml_corpus_path)
-    lang_code = parser.lang_code
-
-    for paragraph in parser.gen_paragraphs():
-        sentences = _preprocess(paragraph, lang_code)
-        for sentence in sentences:
-            if sentence and len(sentence) < _MAX_SENTENCE_LEN:
-                corpus.append(sentence)
+    corpus = _preprocess_paragraphs(parser.gen_paragraphs(), parser.lang_code)[0]
 
     with open(processed_corpus_path, 'wb') as processed_file:
         pickle.dump(corpus, processed_file)
+
+
+def _get_corpus_name(corpus_path):
+    """Return the file name of the corpus without extensions (e.g. en.xml.gz -> en)."""
+    return os.path.basename(corpus_path).split('.')[0]
+
+
+def _gen_chunks(corpus_path, chunk_size):
+    """
+    Yield chunks of paragraphs of a corpus with its language code. The corpus is either a bible XML
+    corpus (optionally gzip-compressed) or a raw text corpus (.txt) with a paragraph per line whose
+    language code is the file name before the first '_' (e.g. en.txt, en_news.txt).
+    """
+    if corpus_path.endswith(_RAW_CORPUS_EXTENSION):
+        lang_code = _get_corpus_name(corpus_path).split('_')[0]
+        corpus_file = open(corpus_path, 'r', encoding='utf-8')
+        paragraphs = (line.rstrip('\n') for line in corpus_file)
+    else:
+        parser = CorpusParser(corpus_path)
+        lang_code = parser.lang_code
+        corpus_file = None
+        paragraphs = parser.gen_paragraphs()
+
+    try:
+        chunk = list()
+        for paragraph in paragraphs:
+            chunk.append(paragraph)
+            if len(chunk) == chunk_size:
+                yield lang_code, chunk
+                chunk = list()
+        if chunk:
+            yield lang_code, chunk
+    finally:
+        if corpus_file:
+            corpus_file.close()
+
+
+def preprocess_corpora(corpus_paths, output_dir, num_workers=None, chunk_size=_CHUNK_SIZE):
+    """
+    Preprocess many corpora in parallel and save each of them to a .pkl file in output_dir (e.g.
+    en.xml -> output_dir/en.pkl). Corpora are split into chunks of paragraphs which are processed
+    by a pool of worker processes, and sentences are saved in the same order as
+    preprocess_corpus() would save them.
+
+    :param corpus_paths: paths to bible XML corpora (optionally gzip-compressed) or raw text
+                         corpora (.txt files with a paragraph per line, named after the language
+                         code, e.g. en.txt or en_news.txt)
+    :param output_dir: path to the directory to save the preprocessed corpora to
+    :param num_workers: the number of worker processes (the number of CPUs if None)
+    :param chunk_size: the number of paragraphs per chunk sent to a worker process
+    :return: dict of corpus path -> stats (lang_code, output path, the number of sentences and
+             bytes, and the time spent by worker processes)
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    def gen_tasks():
+        """Yield (corpus_id, lang_code, chunk) for every chunk of every corpus, then a sentinel."""
+        for corpus_id, corpus_path in enumerate(corpus_paths):
+            for lang_code, chunk in _gen_chunks(corpus_path, chunk_size):
+                yield corpus_id, lang_code, chunk
+            yield corpus_id, None, None  # marks the end of the corpus
+
+    def finish_corpus(corpus_id):
+        """Save the corpus whose chunks have all been processed and log its throughput."""
+        corpus_path = corpus_paths[corpus_id]
+        stats = all_stats[corpus_path]
+        output_path = os.path.join(output_dir, '{}.pkl'.format(_get_corpus_name(corpus_path)))
+        with open(output_path, 'wb') as processed_file:
+            pickle.dump(corpora.pop(corpus_id), processed_file)
+
+        stats['output_path'] = output_path
+        seconds = max(stats['seconds'], 1e-9)
+        _LOGGER.info('Preprocessed {} (lang_code={}): {:,} sentences, {:.1f} MB, '
+                     '{:,.0f} sentences/sec, {:.2f} MB/sec (per worker)'
+                     .format(corpus_path, stats['lang_code'], stats['sentences'],
+                             stats['bytes'] / 2 ** 20, stats['sentences'] / seconds,
+                             stats['bytes'] / 2 ** 20 / seconds))
+
+    num_workers = num_workers or os.cpu_count()
+    max_pending = 2 * num_workers  # bound the number of chunks kept in memory
+    corpora = dict()
+    all_stats = dict()
+    pending = deque()
+    start_time = time.perf_counter()
+
+    with ProcessPoolExecutor(num_workers) as executor:
+        def consume():
+            """Consume the oldest pending task (results are consumed in submission order)."""
+            corpus_id, future = pending.popleft()
+            if future is None:
+                finish_corpus(corpus_id)
+                return
+            sentences, num_bytes, seconds = future.result()
+            corpora[corpus_id].extend(sentences)
+            stats = all_stats[corpus_paths[corpus_id]]
+            stats['sentences'] += len(sentences)
+            stats['bytes'] += num_bytes
+            stats['seconds'] += seconds
+
+        for corpus_id, lang_code, chunk in gen_tasks():
+            if corpus_id not in corpora:
+                corpora[corpus_id] = list()
+                all_stats[corpus_paths[corpus_id]] = {
+                    'lang_code': lang_code, 'sentences': 0, 'bytes': 0, 'seconds': 0.}
+
+            if chunk is None:
+                pending.append((corpus_id, None))
+            else:
+                pending.append(
+                    (corpus_id, executor.submit(_preprocess_paragraphs, chunk, lang_code)))
+
+            while len(pending) > max_pending:
+                consume()
+
+        while pending:
+            consume()
+
+    elapsed = time.perf_counter() - start_time
+    total_sentences = sum(stats['sentences'] for stats in all_stats.values())
+    total_bytes = sum(stats['bytes'] for stats in all_stats.values())
+    _LOGGER.info('Preprocessed {} corpora in {:.1f} sec: {:,.0f} sentences/sec, {:.2f} MB/sec'
+                 .format(len(all_stats), elapsed, total_sentences / elapsed,
+                         total_bytes / 2 ** 20 / elapsed))
+    return all_stats
@@ -0,0 +1,103 @@
+# -*- coding: UTF-8 -*-
+"""
+Define the runtime configuration of tensorflow sessions (threading and performance options) here.
+"""
+import os
+import time
+
+from langdist.util import get_logger
+
+_LOGGER = get_logger(__name__)
+
+__author__ = 'kensk8er'
+
+
+class SessionConfig(object):
+    """
+    Configuration of tensorflow sessions, which is saved along with a model.
+
+    Basic Usage:
+        session_config = SessionConfig(intra_op_threads=8, inter_op_threads=2)
+        session = tf.Session(graph=graph, config=session_config.to_config_proto())
+    """
+
+    def __init__(self, intra_op_threads=0, inter_op_threads=0, xla=False, optimize_graph=True):
+        """
+        :param intra_op_threads: the number of threads used to run an op in parallel (e.g. matrix
+                                 multiplications), 0 lets tensorflow decide (the number of CPUs)
+        :param inter_op_threads: the number of threads used to run independent ops in parallel, 0
+                                 lets tensorflow decide (the number of CPUs)
+        :param xla: if True, compile the graph with XLA JIT
+        :param optimize_graph: if False, disable graph optimizations (common subexpression
+                               elimination and constant folding)
+        """
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.xla = xla
+        self.optimize_graph = optimize_graph
+
+    def to_config_proto(self):
+        """Return tf.ConfigProto of the configuration."""
+        import tensorflow as tf  # import locally because it's slow to import
+        config = tf.ConfigProto(intra_op_parallelism_threads=self.intra_op_threads,
+                                inter_op_parallelism_threads=self.inter_op_threads)
+        optimizer_options = config.graph_options.optimizer_options
+        optimizer_options.opt_level = (tf.OptimizerOptions.L1 if self.optimize_graph else
+                                       tf.OptimizerOptions.L0)
+        if self.xla:
+            optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        return config
+
+    def __eq__(self, other):
+        return isinstance(other, SessionConfig) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return 'SessionConfig({})'.format(
+            ', '.join('{}={!r}'.format(key, value) for key, value in sorted(vars(self).items())))
+
+
+def get_candidate_configs(cpu_count=None, xla=False):
+    """
+    Return a few session configurations worth comparing on a machine with cpu_count CPUs: all,
+    half and a quarter of CPUs for intra-op threads, combined with 1 or 2 inter-op threads.
+    """
+    cpu_count = cpu_count or os.cpu_count()
+    intra_op_threads = sorted({max(cpu_count // divisor, 1) for divisor in (1, 2, 4)},
+                              reverse=True)
+    return [SessionConfig(intra_threads, inter_threads, xla)
+            for intra_threads in intra_op_threads for inter_threads in (1, 2)]
+
+
+def autotune_session_config(create_session, run_step, candidates=None, warmup=2, repeats=5):
+    """
+    Benchmark session configurations and return the fastest one.
+
+    :param create_session: function that receives SessionConfig and returns a session ready to run
+                           the benchmark
+    :param run_step: function that receives a session and runs a step of the benchmark
+    :param candidates: list of SessionConfig to compare (get_candidate_configs() if None)
+    :param warmup: the number of steps run before measuring the time
+    :param repeats: the number of steps measured (the median is used)
+    :return: the fastest SessionConfig and a list of (SessionConfig, seconds per step)
+    """
+    candidates = candidates or get_candidate_configs()
+    timings = list()
+    for config in candidates:
+        session = create_session(config)
+        try:
+            for _ in range(warmup):
+                run_step(session)
+            seconds = list()
+            for _ in range(repeats):
+                start_time = time.perf_counter()
+                run_step(session)
+                seconds.append(time.perf_counter() - start_time)
+        finally:
+            session.close()
+        seconds = sorted(seconds)[len(seconds) // 2]
+        _LOGGER.info('{}: {:.4f} sec/step'.format(config, seconds))
+        timings.append((config, seconds))
+
+    best_config = min(timings, key=lambda timing: timing[1])[0]
+    _LOGGER.info('The fastest configuration: {}'.format(best_config))
+    return best_config, timings
@@ -0,0 +1,60 @@
+# -*- coding: UTF-8 -*-
+"""
+Batched sampling of characters from predicted probability distributions.
+"""
+import numpy as np
+
+__author__ = 'kensk8er'
+
+
+def sample_from_probs(probs, random_state, top_k=None, top_p=None, temperature=1.0):
+    """
+    Sample an ID from each row of probabilities at once (one call to the random number generator).
+
+    :param probs: array of probabilities of shape [batch_size, vocab_size] (rows don't need to be
+                  normalized)
+    :param random_state: np.random.Generator used for sampling
+    :param top_k: if given, only sample from the top k most probable IDs
+    :param top_p: if given, only sample from the smallest set of most probable IDs whose cumulative
+                  probability is at least top_p (nucleus sampling)
+    :param temperature: sharpen (< 1.0) or flatten (> 1.0) the distributions before sampling, 0
+                        always picks the most probable ID (greedy decoding)
+    :return: int array of sampled IDs of shape [batch_size]
+    """
+    if temperature < 0:
+        raise ValueError('temperature must be non-negative: {}'.format(temperature))
+    probs = np.asarray(probs, dtype=np.float64)
+    batch_size, vocab_size = probs.shape
+
+    if temperature == 0:
+        return np.argmax(probs, axis=1)
+
+    if temperature != 1.0:
+        # scale the rows by their maximum first such that the most probable IDs stay 1 instead of
+        # underflowing to 0 at low temperatures
+        max_probs = probs.max(axis=1, keepdims=True)
+        probs = np.power(probs / np.where(max_probs > 0., max_probs, 1.), 1. / temperature)
+
+    if top_k and top_k < vocab_size:
+        top_k_ids = np.argpartition(probs, -top_k, axis=1)[:, -top_k:]
+        filtered_probs = np.zeros_like(probs)
+        np.put_along_axis(filtered_probs, top_k_ids,
+                          np.take_along_axis(probs, top_k_ids, axis=1), axis=1)
+        probs = filtered_probs
+
+    if top_p and top_p < 1.0:
+        sorted_ids = np.argsort(-probs, axis=1)
+        sorted_probs = np.take_along_axis(probs, sorted_ids, axis=1)
+        cumulative_probs = np.cumsum(sorted_probs, axis=1)
+
+        # keep IDs until the cumulative probability reaches top_p (always keep the most probable)
+        is_kept = cumulative_probs - sorted_probs < top_p * cumulative_probs[:, -1:]
+        filtered_probs = np.zeros_like(probs)
+        np.put_along_axis(filtered_probs, sorted_ids, np.where(is_kept, sorted_probs, 0.), axis=1)
+        probs = filtered_probs
+
+    # inverse CDF: the first ID whose cumulative probability exceeds a uniform draw
+    cumulative_probs = np.cumsum(probs, axis=1)
+    thresholds = random_state.random(batch_size) * cumulative_probs[:, -1]
+    sampled_ids = np.sum(cumulative_probs <= thresholds[:, np.newaxis], axis=1)
+    return np.minimum(sampled_ids, vocab_size - 1)
@@ -0,0 +1,364 @@
+# -*- coding: UTF-8 -*-
+"""
+Long-running generation service which keeps a trained model loaded and merges concurrent requests
+into a single running batch (continuous batching).
+"""
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import queue
+import threading
+import time
+
+import numpy as np
+
+from langdist.sampling import sample_from_probs
+from langdist.util import get_logger
+
+_LOGGER = get_logger(__name__)
+
+__author__ = 'kensk8er'
+
+
+class GenerationRequest(object):
+    """A request for a generated text, completed asynchronously by GenerationServer."""
+
+    def __init__(self, prompt_ids, max_char_len):
+        """
+        :param prompt_ids: list of character IDs of the prompt
+        :param max_char_len: the maximum length of characters to generate (including the prompt)
+        """
+        self.prompt_ids = prompt_ids
+        self.max_char_len = max_char_len
+        self.char_ids = list(prompt_ids)
+        self.text = None
+        self.error = None
+        self.submitted_at = time.time()
+        self._done = threading.Event()
+
+    def set_result(self, text=None, error=None):
+        """Complete the request with the generated text (or the error which occurred)."""
+        self.text = text
+        self.error = error
+        self._done.set()
+
+    def result(self, timeout=None):
+        """Wait until the request is completed and return the generated text."""
+        if not self._done.wait(timeout):
+            raise TimeoutError('The request has not been completed in {} seconds'.format(timeout))
+        if self.error is not None:
+            raise self.error
+        return self.text
+
+
+class GenerationServer(object):
+    """
+    GenerationServer class runs a generation loop in a background thread. Every step of the loop
+    runs a single batch which contains all the active requests. New requests join the batch as soon
+    as there is room, and finished requests leave it, so requests never wait for the longest text
+    of an unrelated batch.
+
+    Prompts are fed one character per step, in the same batch as the rows that are decoding, so
+    joining requests don't stall the others.
+
+    Basic Usage:
+        with GenerationServer(CharLSTM.load(model_path), max_batch_size=64) as server:
+            text = server.generate('Hello', max_char_len=100)
+            print(server.metrics())
+    """
+    _idle_timeout = 0.1  # seconds to wait for new requests before checking whether it's stopped
+
+    def __init__(self, model, max_batch_size=64, pick_top_k=10, top_p=None, temperature=1.0,
+                 random_state=None, metrics_window=10.):
+        """
+        :param model: trained CharLSTM instance (e.g. loaded by CharLSTM.load()), or any object
+                      with its incremental decoding interface (segment_char_id, target_vocab_ids,
+                      encode(), decode(), zero_states() and step())
+        :param max_batch_size: the maximum number of requests processed in a batch at once
+        :param pick_top_k: if given, always sample from top k most probable characters
+        :param top_p: if given, always sample from the smallest set of most probable characters
+                      whose cumulative probability is at least top_p (nucleus sampling)
+        :param temperature: sharpen (< 1.0) or flatten (> 1.0) the predicted distributions (0 always
+                            picks the most probable character)
+        :param random_state: seed (or np.random.Generator) used for sampling
+        :param metrics_window: the number of seconds over which tokens/sec is measured
+        """
+        assert max_batch_size > 0, 'max_batch_size <= 0'
+        assert temperature >= 0, 'temperature < 0'
+        self._model = model
+        self._max_batch_size = max_batch_size
+        self._pick_top_k = pick_top_k
+        self._top_p = top_p
+        self._temperature = temperature
+        self._random_state = np.random.default_rng(random_state)
+        self._target_vocab_ids = np.array(model.target_vocab_ids)
+
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._submit_lock = threading.Lock()  # no request is queued once the server is stopped
+        self._thread = None
+
+        self._metrics_lock = threading.Lock()
+        self._metrics_window = metrics_window
+        self._token_history = deque()  # (timestamp, the number of tokens) of recent steps
+        self._started_at = None
+        self._active_size = 0
+        self._total_tokens = 0
+        self._total_requests = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        """Start the generation loop in a background thread."""
+        assert self._thread is None, 'GenerationServer has already been started'
+        self._started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name='GenerationServer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the generation loop, requests which haven't been completed get an error."""
+        with self._submit_lock:
+            self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._fail_queued(RuntimeError('GenerationServer has been stopped'))
+
+    def submit(self, prompt=None, max_char_len=300):
+        """
+        Submit a request for a generated text and return it without waiting for the result.
+
+        :param prompt: the first characters which you generate a text from (if None start from an
+                       empty text)
+        :param max_char_len: the maximum length of characters to generate (including the prompt), a
+                             prompt of max_char_len characters or more is returned unchanged
+        :return: GenerationRequest, call its result() method to get the generated text
+        """
+        if max_char_len < 0:
+            raise ValueError('max_char_len must not be negative')
+
+        # encode here (instead of in the generation loop) such that unknown characters are reported
+        # to the caller right away
+        prompt_ids = self._model.encode([prompt])[0] if prompt else []
+        request = GenerationRequest(list(prompt_ids), max_char_len)
+        if len(prompt_ids) >= max_char_len:
+            request.set_result(text=self._model.decode([request.char_ids])[0].strip())
+            return request
+
+        with self._submit_lock:
+            if self._stopped.is_set():
+                raise RuntimeError('GenerationServer has been stopped')
+            self._queue.put(request)
+        return request
+
+    def generate(self, prompt=None, max_char_len=300, timeout=None):
+        """Submit a request for a generated text and wait for the result."""
+        return self.submit(prompt, max_char_len).result(timeout)
+
+    @property
+    def queue_depth(self):
+        """The number of requests waiting for joining the running batch."""
+        return self._queue.qsize()
+
+    def metrics(self):
+        """Return a dict of metrics of the server."""
+        now = time.time()
+        with self._metrics_lock:
+            self._prune_token_history(now)
+            window = min(self._metrics_window, now - self._started_at) if self._started_at else 0.
+            recent_tokens = sum(num_tokens for _, num_tokens in self._token_history)
+            return {'queue_depth': self.queue_depth,
+                    'active_requests': self._active_size,
+                    'tokens_per_sec': recent_tokens / window if window > 0 else 0.,
+                    'total_tokens': self._total_tokens,
+                    'total_requests': self._total_requests}
+
+    def _run(self):
+        """Run the generation loop until the server gets stopped."""
+        model = self._model
+        rows = list()  # active requests
+        inputs = list()  # character IDs to feed into each row (the prompt while prefilling)
+        states = model.zero_states(0)
+
+        while not self._stopped.is_set():
+            # let new requests join the batch
+            new_rows = self._admit(self._max_batch_size - len(rows), block=not rows)
+            if new_rows:
+                rows.extend(new_rows)
+                inputs.extend(deque([model.segment_char_id] + request.prompt_ids)
+                              for request in new_rows)
+                states = np.concatenate([states, model.zero_states(len(new_rows))], axis=2)
+            if not rows:
+                continue
+
+            try:
+                X = np.array([row_inputs.popleft() for row_inputs in inputs], dtype=np.int32)
+                probs, states = model.step(X, states)
+                keep_ids = self._decode(rows, inputs, probs)
+            except Exception as error:
+                _LOGGER.exception('Failed to run a generation step.')
+                for request in rows:
+                    request.set_result(error=error)
+                keep_ids = []
+
+            # don't process requests that already finish generating
+            if len(keep_ids) < len(rows):
+                rows = [rows[row_id] for row_id in keep_ids]
+                inputs = [inputs[row_id] for row_id in keep_ids]
+                states = states[:, :, np.array(keep_ids, dtype=np.int64)]
+
+            with self._metrics_lock:
+                self._active_size = len(rows)
+
+        for request in rows:
+            request.set_result(error=RuntimeError('GenerationServer has been stopped'))
+
+    def _decode(self, rows, inputs, probs):
+        """
+        Sample the next characters of the rows which finished prefilling, complete the requests
+        that finish generating, and return the IDs of the rows to keep in the batch.
+        """
+        model = self._model
+        decoding_ids = [row_id for row_id, row_inputs in enumerate(inputs) if not row_inputs]
+        finished_ids = set()
+        if decoding_ids:
+            sampled_char_ids = self._target_vocab_ids[sample_from_probs(
+                probs[decoding_ids], self._random_state, self._pick_top_k, self._top_p,
+                self._temperature)]
+            for row_id, sampled_char_id in zip(decoding_ids, sampled_char_ids.tolist()):
+                request = rows[row_id]
+                if sampled_char_id != model.segment_char_id:
+                    request.char_ids.append(sampled_char_id)
+                    inputs[row_id].append(sampled_char_id)
+                if (sampled_char_id == model.segment_char_id or
+                        len(request.char_ids) >= request.max_char_len):
+                    finished_ids.add(row_id)
+                    text = model.decode([request.char_ids])[0].strip()
+                    request.set_result(text=text)
+            self._record_tokens(len(decoding_ids), len(finished_ids))
+        return [row_id for row_id in range(len(rows)) if row_id not in finished_ids]
+
+    def _admit(self, size, block):
+        """Take up to `size` requests from the queue (wait for a request if block is True)."""
+        requests = list()
+        while len(requests) < size:
+            try:
+                if block and not requests:
+                    requests.append(self._queue.get(timeout=self._idle_timeout))
+                else:
+                    requests.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return requests
+
+    def _record_tokens(self, num_tokens, num_requests):
+        """Record the number of tokens generated in a step and the number of completed requests."""
+        now = time.time()
+        with self._metrics_lock:
+            self._token_history.append((now, num_tokens))
+            self._prune_token_history(now)
+            self._total_tokens += num_tokens
+            self._total_requests += num_requests
+
+    def _prune_token_history(self, now):
+        """Remove steps older than the metrics window from the token history."""
+        while self._token_history and self._token_history[0][0] < now - self._metrics_window:
+            self._token_history.popleft()
+
+    def _fail_queued(self, error):
+        """Complete all the requests still in the queue with the error."""
+        while True:
+            try:
+                self._queue.get_nowait().set_result(error=error)
+            except queue.Empty:
+                return
+
+
+class _GenerationRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP front end of GenerationServer.
+
+    POST /generate with a JSON body {"prompt": str, "max_char_len": int} returns {"text": str}.
+    GET /metrics returns the metrics of the server in JSON.
+    """
+    generation_server = None
+    timeout_seconds = None
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self._respond(404, {'error': 'Not found: {}'.format(self.path)})
+            return
+        self._respond(200, self.generation_server.metrics())
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/generate':
+            self._respond(404, {'error': 'Not found: {}'.format(self.path)})
+            return
+
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(content_length).decode('utf-8') or '{}')
+            if not isinstance(body, dict):
+                raise ValueError('The body must be a JSON object')
+            prompt = body.get('prompt')
+            if prompt is not None and not isinstance(prompt, str):
+                raise ValueError('prompt must be a string')
+            request = self.generation_server.submit(prompt, int(body.get('max_char_len', 300)))
+        except (ValueError, TypeError) as error:  # malformed body or characters unknown to encoder
+            self._respond(400, {'error': str(error)})
+            return
+        except RuntimeError as error:  # the server has been stopped
+            self._respond(503, {'error': str(error)})
+            return
+
+        try:
+            text = request.result(self.timeout_seconds)
+        except Exception as error:
+            self._respond(500, {'error': str(error)})
+            return
+        self._respond(200, {'text': text})
+
+    def _respond(self, status, content):
+        body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _LOGGER.debug('{} - {}'.format(self.address_string(), format % args))
+
+
+def serve(model_path, host='127.0.0.1', port=8000, max_batch_size=64, pick_top_k=10, top_p=None,
+          temperature=1.0, random_state=None, timeout_seconds=None, load_args=None):
+    """
+    Load the model once and serve generation requests over HTTP until interrupted.
+
+    :param model_path: path to the model directory
+    :param host: host name to listen on
+    :param port: port number to listen on
+    :param max_batch_size: the maximum number of requests processed in a batch at once
+    :param timeout_seconds: if given, the maximum number of seconds to wait for a generated text
+    :param load_args: keyword arguments of CharLSTM.load() (e.g. session_config)
+    """
+    from langdist.langmodel import CharLSTM  # import locally because it's slow to import
+    model = CharLSTM.load(model_path, **(load_args or {}))
+    handler = type('GenerationRequestHandler', (_GenerationRequestHandler,), {})
+
+    with GenerationServer(model, max_batch_size, pick_top_k, top_p, temperature,
+                          random_state) as generation_server:
+        handler.generation_server = generation_server
+        handler.timeout_seconds = timeout_seconds
+        http_server = ThreadingHTTPServer((host, port), handler)
+        _LOGGER.info('Serving {} on http://{}:{}'.format(model_path, host, port))
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http_server.server_close()
@@ -2,10 +2,12 @@
 """
 Utility module.
 """
+import gzip
 import logging
+import math
 import os
 from logging import getLogger
-from xml.dom import minidom
+from xml.etree.ElementTree import iterparse
 
 _LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 _DEFAULT_LOG_PATH = None  # don't write to a file in default
@@ -15,10 +17,16 @@ __author__ = 'kensk8er'
 
 
 class CorpusParser(object):
-    """Parser for the parallel multilingual bible corpora (http://christos-c.com/bible/)."""
+    """
+    Parser for the parallel multilingual bible corpora (http://christos-c.com/bible/).
+
+    The XML file (optionally gzip-compressed) is parsed in a streaming manner, and elements are
+    discarded as soon as they are parsed, so memory usage doesn't depend on the size of the corpus.
+    """
     _language_tag = 'language'
     _id_attribute = 'id'
     _segment_tag = 'seg'
+    _gzip_magic = b'\x1f\x8b'
 
     def __init__(self, corpus_path):
         self._lang_code = None
@@ -28,18 +36,54 @@ class CorpusParser(object):
     def lang_code(self):
         """Return the language code of the corpus."""
         if not self._lang_code:
-            xmldoc = minidom.parse(self._corpus_path)
-            self._lang_code = xmldoc.getElementsByTagName(
-                self._language_tag)[0].attributes[self._id_attribute].value
+            # the language is defined in the header, so stop parsing as soon as it's found
+            for _ in self._gen_segments():
+                if self._lang_code:
+                    break
         return self._lang_code
 
     def gen_paragraphs(self):
         """Yield paragraph of the corpus."""
-        xmldoc = minidom.parse(self._corpus_path)
-        segments = xmldoc.getElementsByTagName(self._segment_tag)
-        for segment in segments:
-            if segment.childNodes:
-                yield segment.childNodes[0].nodeValue
+        for segment in self._gen_segments():
+            if segment:
+                yield segment
+
+    def _gen_segments(self):
+        """Parse the corpus and yield the text of each segment (the language code is set too)."""
+        with self._open() as corpus_file:
+            parents = list()
+            for event, element in iterparse(corpus_file, events=('start', 'end')):
+                if event == 'start':
+                    parents.append(element)
+                    continue
+
+                parents.pop()
+                tag = element.tag.rsplit('}', 1)[-1]  # ignore the namespace if any
+                if tag == self._language_tag and not self._lang_code:
+                    self._lang_code = element.get(self._id_attribute)
+                elif tag == self._segment_tag:
+                    yield element.text
+
+                # discard the parsed element (parents have at most one child at any time)
+                if parents:
+                    parents[-1].remove(element)
+
+    def _open(self):
+        """Open the corpus file, decompressing it if it is gzip-compressed."""
+        with open(self._corpus_path, 'rb') as corpus_file:
+            is_gzip = corpus_file.read(len(self._gzip_magic)) == self._gzip_magic
+        return gzip.open(self._corpus_path, 'rb') if is_gzip else open(self._corpus_path, 'rb')
+
+
+def compute_perplexity(log_prob, char_num):
+    """
+    Return the perplexity per character of texts from their total log probability (in nats) and
+    their total number of characters, or nan if no character is scored (e.g. all the texts are out
+    of the vocabulary of the model), which must not be mistaken for the best perplexity 1.0.
+    """
+    if not char_num:
+        return float('nan')
+    return math.exp(-log_prob / char_num)
 
 
 def get_logger(name, filepath=None, log_level=None):
@@ -0,0 +1,149 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for batch module.
+"""
+import unittest
+
+import numpy as np
+
+from langdist.batch import BatchGenerator, PrefetchIterator, StreamBatchGenerator, \
+    find_known_samples, flatten_samples, pad_batch, select_samples
+
+__author__ = 'kensk8er'
+
+_SEGMENT_ID = 99
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.X = [[1, 2, 3], [4], [5, 6], [7, 8, 9, 10]]
+
+    def test_flatten_samples(self):
+        tokens, offsets = flatten_samples(self.X)
+        self.assertListEqual(tokens.tolist(), [1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+        self.assertListEqual(offsets.tolist(), [0, 3, 4, 6, 10])
+
+        tokens, offsets = select_samples(tokens, offsets, [3, 1])
+        self.assertListEqual(tokens.tolist(), [7, 8, 9, 10, 4])
+        self.assertListEqual(offsets.tolist(), [0, 4, 5])
+
+    def test_find_known_samples(self):
+        tokens, offsets = flatten_samples([[1, -1], [], [2, 3], [-1], [-1, 4, -1]])
+        self.assertListEqual(find_known_samples(tokens, offsets).tolist(),
+                             [False, True, True, False, False])
+
+    def test_pad_batch(self):
+        tokens, offsets = flatten_samples(self.X)
+        X, Y, seq_lens = pad_batch(tokens, offsets, np.array([1, 0]), _SEGMENT_ID)
+        self.assertEqual(X.dtype, np.int32)
+        self.assertListEqual(X.tolist(), [[_SEGMENT_ID, 4, 0, 0], [_SEGMENT_ID, 1, 2, 3]])
+        self.assertListEqual(Y.tolist(), [[4, _SEGMENT_ID, 0, 0], [1, 2, 3, _SEGMENT_ID]])
+        self.assertListEqual(seq_lens.tolist(), [2, 4])
+
+    def test_batch_generator(self):
+        batch_generator = BatchGenerator(self.X, 3, _SEGMENT_ID, random_state=0)
+
+        # every sample appears exactly once per epoch
+        seen = list()
+        for _ in range(4):
+            X, Y, seq_lens = next(batch_generator)
+            self.assertEqual(X.shape[0], 3)
+            seen.extend(tuple(x[1: seq_len].tolist()) for x, seq_len in zip(X, seq_lens))
+        self.assertSetEqual(set(seen[:4]), set(tuple(x) for x in self.X))
+        self.assertSetEqual(set(seen[4:8]), set(tuple(x) for x in self.X))
+
+        # the original samples are left untouched
+        self.assertListEqual(self.X, [[1, 2, 3], [4], [5, 6], [7, 8, 9, 10]])
+
+    def test_bucketing(self):
+        random_state = np.random.RandomState(0)
+        X = [[1] * random_state.randint(1, 100) for _ in range(1000)]
+        plain_generator = BatchGenerator(X, 10, _SEGMENT_ID, random_state=0)
+        bucket_generator = BatchGenerator(X, 10, _SEGMENT_ID, random_state=0, bucket_size=10)
+        for _ in range(100):
+            next(plain_generator)
+            next(bucket_generator)
+        self.assertLess(bucket_generator.padding_ratio, plain_generator.padding_ratio)
+
+    def test_max_tokens(self):
+        batch_generator = BatchGenerator(self.X, 3, _SEGMENT_ID, random_state=0, max_tokens=8)
+        num_samples = 0
+        for _ in range(10):
+            X, _, seq_lens = next(batch_generator)
+            self.assertTrue(X.size <= 8 or len(seq_lens) == 1)
+            num_samples += len(seq_lens)
+        self.assertGreater(num_samples, 10)
+
+    def test_batch_generator_state(self):
+        random_state = np.random.RandomState(0)
+        X = [[1] * random_state.randint(1, 20) for _ in range(50)]
+        for kwargs in ({}, {'bucket_size': 2}, {'max_tokens': 40}):
+            batch_generator = BatchGenerator(X, 7, _SEGMENT_ID, random_state=0, **kwargs)
+            for _ in range(11):
+                next(batch_generator)
+            state = batch_generator.state
+            expected = [next(batch_generator) for _ in range(20)]
+
+            # a new generator resumes from the state
+            resumed_generator = BatchGenerator(X, 7, _SEGMENT_ID, random_state=1, **kwargs)
+            resumed_generator.set_state(state)
+            for expected_batch in expected:
+                for expected_array, array in zip(expected_batch, next(resumed_generator)):
+                    np.testing.assert_array_equal(array, expected_array)
+
+    def test_stream_batch_generator_state(self):
+        batch_generator = StreamBatchGenerator(self.X, 2, 2, _SEGMENT_ID, random_state=0)
+        for _ in range(7):
+            state = batch_generator.state
+            expected = [next(batch_generator) for _ in range(5)]
+            resumed_generator = StreamBatchGenerator(self.X, 2, 2, _SEGMENT_ID, random_state=1)
+            resumed_generator.set_state(state)
+            for expected_batch in expected:
+                for expected_array, array in zip(expected_batch, next(resumed_generator)):
+                    np.testing.assert_array_equal(array, expected_array)
+            next(batch_generator)
+
+    def test_stream_batch_generator(self):
+        batch_generator = StreamBatchGenerator(self.X, 2, 3, _SEGMENT_ID, shuffle=False)
+        X, Y, seq_lens = next(batch_generator)
+        self.assertTrue(batch_generator.reset_states)
+        self.assertListEqual(X.tolist(), [[_SEGMENT_ID, 1, 2], [_SEGMENT_ID, 5, 6]])
+        self.assertListEqual(Y.tolist(), [[1, 2, 3], [5, 6, _SEGMENT_ID]])
+        self.assertListEqual(seq_lens.tolist(), [3, 3])
+
+        # the second window continues the streams of the first one
+        X, Y, _ = next(batch_generator)
+        self.assertFalse(batch_generator.reset_states)
+        self.assertListEqual(X.tolist(), [[3, _SEGMENT_ID, 4], [_SEGMENT_ID, 7, 8]])
+        self.assertListEqual(Y.tolist(), [[_SEGMENT_ID, 4, _SEGMENT_ID], [7, 8, 9]])
+        self.assertEqual(batch_generator.num_samples, 2)
+
+        next(batch_generator)
+        self.assertTrue(batch_generator.reset_states)
+
+    def test_prefetch_iterator(self):
+        batch_generator = StreamBatchGenerator(self.X, 2, 3, _SEGMENT_ID, shuffle=False)
+        prefetch_iterator = PrefetchIterator(
+            StreamBatchGenerator(self.X, 2, 3, _SEGMENT_ID, shuffle=False), depth=3,
+            attributes=['reset_states', 'num_samples'])
+        try:
+            for _ in range(5):
+                X, Y, seq_lens = next(prefetch_iterator)
+                X_expected, Y_expected, _ = next(batch_generator)
+                self.assertListEqual(X.tolist(), X_expected.tolist())
+                self.assertListEqual(Y.tolist(), Y_expected.tolist())
+
+                # attributes correspond to the consumed item, not to the latest prefetched one
+                self.assertEqual(prefetch_iterator.reset_states, batch_generator.reset_states)
+                self.assertEqual(prefetch_iterator.num_samples, batch_generator.num_samples)
+        finally:
+            prefetch_iterator.close()
+
+        # items are exhausted together with the wrapped iterator and errors are propagated
+        self.assertListEqual(list(PrefetchIterator(iter([1, 2, 3]))), [1, 2, 3])
+        with self.assertRaises(ZeroDivisionError):
+            list(PrefetchIterator(1 // x for x in [1, 0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
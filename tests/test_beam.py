@@ -0,0 +1,108 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for beam module.
+"""
+from itertools import product
+import unittest
+
+import numpy as np
+
+from langdist.beam import beam_search
+
+__author__ = 'kensk8er'
+
+
+class BeamTest(unittest.TestCase):
+    def setUp(self):
+        # a bigram model whose states count the number of steps
+        random_state = np.random.RandomState(0)
+        self.transitions = random_state.dirichlet(np.ones(4), size=4)
+        self.first_probs = random_state.dirichlet(np.ones(4), size=2)
+        self.states = np.zeros((1, 2, 2, 3))
+
+    def step(self, X, states):
+        assert states.shape[2] == len(X), 'states and X have different batch sizes'
+        return self.transitions[X], states + 1
+
+    def brute_force(self, first_probs, max_len, end_id=0, length_penalty=0.):
+        """Enumerate all the sequences and return (IDs, score) sorted by score."""
+        hypotheses = list()
+        for length in range(1, max_len + 1):
+            for ids in product(range(4), repeat=length):
+                if end_id in ids[:-1] or (length < max_len and ids[-1] != end_id):
+                    continue
+                log_prob = np.log(first_probs[ids[0]]) + sum(
+                    np.log(self.transitions[prev_id, next_id])
+                    for prev_id, next_id in zip(ids[:-1], ids[1:]))
+                hypotheses.append((list(ids[:-1]) if ids[-1] == end_id else list(ids),
+                                   log_prob / length ** length_penalty))
+        return sorted(hypotheses, key=lambda hypothesis: -hypothesis[1])
+
+    def test_beam_search(self):
+        # wide enough beams make the search exhaustive
+        results = beam_search(self.step, self.first_probs, self.states, end_id=0, max_lens=5,
+                              beam_width=27, length_penalty=0., n_best=3)
+        self.assertEqual(len(results), 2)
+        for first_probs, hypotheses in zip(self.first_probs, results):
+            expected = self.brute_force(first_probs, 5)[:3]
+            self.assertListEqual([ids for ids, _ in hypotheses], [ids for ids, _ in expected])
+            np.testing.assert_allclose([score for _, score in hypotheses],
+                                       [score for _, score in expected])
+
+        # inputs are decoded independently of the other inputs in the batch
+        batch_results = beam_search(self.step, self.first_probs, self.states, end_id=0,
+                                    max_lens=[3, 6], beam_width=2)
+        for input_id, max_len in enumerate([3, 6]):
+            single_result = beam_search(
+                self.step, self.first_probs[input_id: input_id + 1],
+                self.states[:, :, input_id: input_id + 1], end_id=0, max_lens=max_len,
+                beam_width=2)
+            self.assertEqual(batch_results[input_id], single_result[0])
+            self.assertLessEqual(len(batch_results[input_id][0][0]), max_len)
+
+    def test_no_length_left(self):
+        # inputs without length left (e.g. prompts longer than the maximum length) are returned
+        # unchanged, and don't change the results of the other inputs
+        results = beam_search(self.step, self.first_probs, self.states, end_id=0, max_lens=[0, 3],
+                              beam_width=2, n_best=2)
+        self.assertListEqual(results[0], [([], 0.)])
+        self.assertEqual(results[1], beam_search(
+            self.step, self.first_probs[1:], self.states[:, :, 1:], end_id=0, max_lens=3,
+            beam_width=2, n_best=2)[0])
+        self.assertListEqual(beam_search(self.step, self.first_probs, self.states, end_id=0,
+                                         max_lens=-2), [[([], 0.)], [([], 0.)]])
+
+    def test_length_penalty(self):
+        # normalized scores are sorted, and a penalty > 0. doesn't favour shorter outputs
+        results = beam_search(self.step, self.first_probs, self.states, end_id=0, max_lens=8,
+                              beam_width=4, length_penalty=1., n_best=4)
+        for hypotheses in results:
+            scores = [score for _, score in hypotheses]
+            self.assertListEqual(scores, sorted(scores, reverse=True))
+        unnormalized = beam_search(self.step, self.first_probs, self.states, end_id=0,
+                                   max_lens=8, beam_width=4, length_penalty=0.)
+        for hypotheses, unnormalized_hypotheses in zip(results, unnormalized):
+            self.assertGreaterEqual(len(hypotheses[0][0]), len(unnormalized_hypotheses[0][0]))
+
+        # early stopping doesn't miss longer hypotheses which the normalisation favours (beams
+        # are wide enough to make the search exhaustive)
+        for seed in range(20):
+            random_state = np.random.RandomState(seed)
+            self.transitions = random_state.dirichlet(np.ones(4), size=4)
+            self.first_probs = random_state.dirichlet(np.ones(4), size=2)
+            for length_penalty in (0.5, 1., 2.):
+                results = beam_search(self.step, self.first_probs, self.states, end_id=0,
+                                      max_lens=4, beam_width=27, length_penalty=length_penalty,
+                                      n_best=3)
+                for first_probs, hypotheses in zip(self.first_probs, results):
+                    expected = self.brute_force(first_probs, 4, length_penalty=length_penalty)
+                    expected_scores = {tuple(ids): score for ids, score in expected}
+                    # compare the scores only, as hypotheses with the same transitions tie
+                    np.testing.assert_allclose([score for _, score in hypotheses],
+                                               [score for _, score in expected[:3]])
+                    np.testing.assert_allclose(
+                        [score for _, score in hypotheses],
+                        [expected_scores[tuple(ids)] for ids, _ in hypotheses])
+
+if __name__ == '__main__':
+    unittest.main()
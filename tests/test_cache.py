@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for cache module.
+"""
+import os
+import shutil
+import time
+import unittest
+
+import numpy as np
+
+from langdist.cache import EncodedCorpusCache, hash_corpus, hash_files
+from langdist.corpus import MmapCorpus, save_corpus
+from langdist.encoder import CharEncoder
+
+_TEST_ROOT = os.path.dirname(__file__)
+
+__author__ = 'kensk8er'
+
+
+class EncodedCorpusCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = os.path.join(_TEST_ROOT, 'cache')
+        self.samples = ['abc', 'de', 'fghi']
+        self.encoder = CharEncoder()
+        self.encoder.fit(self.samples)
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def test_hash_corpus(self):
+        self.assertEqual(hash_corpus(self.samples), hash_corpus(list(self.samples)))
+        self.assertNotEqual(hash_corpus(['ab']), hash_corpus(['a', 'b']))
+
+        # files are hashed by their content only, such that renaming them keeps the hash
+        os.makedirs(self.cache_dir)
+        corpus_paths = [os.path.join(self.cache_dir, name) for name in ('a.ldc', 'b.ldc')]
+        for corpus_path in corpus_paths:
+            save_corpus(self.samples, corpus_path)
+        self.assertEqual(hash_corpus(MmapCorpus(corpus_paths[0])), hash_files(corpus_paths[1:]))
+        self.assertNotEqual(hash_files(corpus_paths[:1]), hash_files(corpus_paths))
+
+    def test_get_put(self):
+        cache = EncodedCorpusCache(self.cache_dir, 2 ** 20)
+        key = cache.make_key(hash_corpus(self.samples), self.encoder.fingerprint, 0.1, 0)
+        self.assertIsNone(cache.get(key, self.encoder))
+
+        char_ids, offsets = self.encoder.encode_flat(self.samples)
+        cache.put(key, char_ids, offsets, np.array([2, 0]), np.array([1]), self.encoder)
+
+        cached_char_ids, cached_offsets, train_ids, valid_ids = cache.get(key, self.encoder)
+        self.assertListEqual(cached_char_ids.tolist(), char_ids.tolist())
+        self.assertListEqual(cached_offsets.tolist(), offsets.tolist())
+        self.assertListEqual(train_ids.tolist(), [2, 0])
+        self.assertListEqual(valid_ids.tolist(), [1])
+
+    def test_eviction(self):
+        char_ids, offsets = self.encoder.encode_flat(self.samples)
+        cache = EncodedCorpusCache(self.cache_dir, 2 ** 20)
+        cache.put('old', char_ids, offsets, np.array([0]), np.array([1]), self.encoder)
+        entry_size = sum(os.path.getsize(os.path.join(self.cache_dir, 'old', file_name))
+                         for file_name in os.listdir(os.path.join(self.cache_dir, 'old')))
+
+        # only 2 entries fit in the cache, the least recently used one is evicted
+        cache = EncodedCorpusCache(self.cache_dir, 2 * entry_size)
+        time.sleep(0.01)
+        cache.put('new', char_ids, offsets, np.array([0]), np.array([1]), self.encoder)
+        time.sleep(0.01)
+        cache.get('old', self.encoder)
+        time.sleep(0.01)
+        cache.put('newest', char_ids, offsets, np.array([0]), np.array([1]), self.encoder)
+        self.assertSetEqual(set(os.listdir(self.cache_dir)), {'old', 'newest'})
+
+        # the entry just put is never evicted, even if it doesn't fit in the cache by itself
+        cache = EncodedCorpusCache(self.cache_dir, 1)
+        os.utime(os.path.join(self.cache_dir, 'newest'), (time.time() + 60, time.time() + 60))
+        cache.put('large', char_ids, offsets, np.array([0]), np.array([1]), self.encoder)
+        self.assertSetEqual(set(os.listdir(self.cache_dir)), {'large'})
+        self.assertIsNotNone(cache.get('large', self.encoder))
+
+
+if __name__ == '__main__':
+    unittest.main()
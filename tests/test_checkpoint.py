@@ -0,0 +1,108 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for checkpoint module.
+"""
+import os
+import shutil
+import threading
+import unittest
+
+from langdist.checkpoint import AsyncCheckpointer, BEST, CHECKPOINTS_DIR, LATEST, \
+    get_checkpoint_path, has_checkpoint
+
+_TEST_ROOT = os.path.dirname(__file__)
+
+__author__ = 'kensk8er'
+
+
+def _write_checkpoint(path, snapshot):
+    with open(os.path.join(path, 'snapshot.txt'), 'w') as snapshot_file:
+        snapshot_file.write(snapshot)
+
+
+class AsyncCheckpointerTest(unittest.TestCase):
+    def setUp(self):
+        self.model_path = os.path.join(_TEST_ROOT, 'checkpoint_model')
+
+    def tearDown(self):
+        if os.path.exists(self.model_path):
+            shutil.rmtree(self.model_path)
+
+    def read_snapshot(self, pointer):
+        with open(os.path.join(get_checkpoint_path(self.model_path, pointer), 'snapshot.txt'),
+                  'r') as snapshot_file:
+            return snapshot_file.read()
+
+    def test_save(self):
+        checkpointer = AsyncCheckpointer(self.model_path, _write_checkpoint, keep_num=2)
+        checkpointer.save(1, lambda: 'step 1')
+        checkpointer.save(2, lambda: 'step 2')
+        checkpointer.save(3, lambda: 'step 3', best=False)
+        checkpointer.save(4, lambda: 'step 4', best=False)
+        checkpointer.close()
+
+        self.assertEqual(self.read_snapshot(LATEST), 'step 4')
+        self.assertEqual(self.read_snapshot(BEST), 'step 2')
+
+        # the last 2 checkpoints and the best one are kept
+        self.assertListEqual(sorted(os.listdir(os.path.join(self.model_path, CHECKPOINTS_DIR))),
+                             [BEST, LATEST, 'ckpt-2', 'ckpt-3', 'ckpt-4'])
+
+    def test_save_in_background(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def write_checkpoint(path, snapshot):
+            started.set()
+            release.wait()
+            _write_checkpoint(path, snapshot)
+
+        checkpointer = AsyncCheckpointer(self.model_path, write_checkpoint)
+        checkpointer.save(1, lambda: 'step 1')
+        started.wait()
+
+        # nothing is visible until the checkpoint is complete
+        self.assertEqual(get_checkpoint_path(self.model_path), self.model_path)
+        self.assertFalse(has_checkpoint(self.model_path))
+        release.set()
+        checkpointer.close()
+        self.assertEqual(self.read_snapshot(BEST), 'step 1')
+        self.assertTrue(has_checkpoint(self.model_path))
+
+    def test_overwrite(self):
+        checkpointer = AsyncCheckpointer(self.model_path, _write_checkpoint)
+        checkpointer.save(1, lambda: 'step 1')
+        checkpointer.close()
+
+        # the checkpoint BEST points to is kept while its replacement is written, and after the
+        # replacement fails
+        def write_checkpoint(path, snapshot):
+            self.assertEqual(self.read_snapshot(BEST), 'step 1')
+            raise IOError('disk full')
+
+        checkpointer = AsyncCheckpointer(self.model_path, write_checkpoint)
+        checkpointer.save(1, lambda: 'step 1 again')
+        with self.assertRaises(IOError):
+            checkpointer.close()
+        self.assertEqual(self.read_snapshot(BEST), 'step 1')
+
+        checkpointer = AsyncCheckpointer(self.model_path, _write_checkpoint)
+        checkpointer.save(1, lambda: 'step 1 again')
+        checkpointer.close()
+        self.assertEqual(self.read_snapshot(BEST), 'step 1 again')
+        self.assertListEqual(sorted(os.listdir(os.path.join(self.model_path, CHECKPOINTS_DIR))),
+                             [BEST, LATEST, 'ckpt-1'])
+
+    def test_failed_write(self):
+        def write_checkpoint(path, snapshot):
+            raise IOError('disk full')
+
+        checkpointer = AsyncCheckpointer(self.model_path, write_checkpoint)
+        checkpointer.save(1, lambda: 'step 1')
+        with self.assertRaises(IOError):
+            checkpointer.close()
+        self.assertEqual(get_checkpoint_path(self.model_path), self.model_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for corpus module.
+"""
+import os
+import pickle
+import threading
+import unittest
+
+import numpy as np
+
+from langdist.corpus import CHAR_IDS, MmapCorpus, convert_corpus, iter_encoded_chunks, \
+    load_corpus, save_corpus
+from langdist.encoder import CharEncoder
+
+_TEST_ROOT = os.path.dirname(__file__)
+
+__author__ = 'kensk8er'
+
+
+class CorpusTest(unittest.TestCase):
+    def setUp(self):
+        self.samples = ['In the beginning', '', 'Ünïcödé 𝄞', '起初神創造天地']
+        self.pickle_path = os.path.join(_TEST_ROOT, 'corpus_test.pkl')
+        self.corpus_path = os.path.join(_TEST_ROOT, 'corpus_test.ldc')
+        with open(self.pickle_path, 'wb') as pickle_file:
+            pickle.dump(self.samples, pickle_file)
+
+    def tearDown(self):
+        for path in [self.pickle_path, self.corpus_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_convert_corpus(self):
+        convert_corpus(self.pickle_path, self.corpus_path)
+
+        corpus = load_corpus(self.corpus_path)
+        self.assertIsInstance(corpus, MmapCorpus)
+        self.assertEqual(len(corpus), len(self.samples))
+        self.assertListEqual(list(corpus), self.samples)
+        self.assertEqual(corpus[2], self.samples[2])
+
+        # fitting an encoder on codepoints is the same as fitting it on samples
+        encoder = CharEncoder()
+        corpus.fit_encoder(encoder)
+        self.assertEqual(encoder.fingerprint, _fit(self.samples).fingerprint)
+        self.assertEqual(encoder.sample_num, len(self.samples))
+        char_ids, offsets = corpus.encode(encoder)
+        self.assertListEqual(char_ids.tolist(), encoder.encode_flat(self.samples)[0].tolist())
+
+    def test_convert_encoded_corpus(self):
+        encoder = _fit(self.samples)
+        convert_corpus(self.pickle_path, self.corpus_path, encoder)
+
+        corpus = load_corpus(self.corpus_path)
+        self.assertEqual(corpus.token_type, CHAR_IDS)
+        char_ids, offsets = corpus.encode(encoder)
+        self.assertIsInstance(char_ids, np.memmap)  # zero copy
+        self.assertListEqual(encoder.decode([corpus[3]]), [self.samples[3]])
+
+    def test_iter_encoded_chunks(self):
+        # chunks are the same whether samples are streamed, or stored as codepoints or char IDs
+        encoder = _fit(self.samples[:2])
+        expected = [encoder.encode_flat(self.samples[:3], unknown_id=-1),
+                    encoder.encode_flat(self.samples[3:], unknown_id=-1)]
+        save_corpus(self.samples, self.corpus_path)
+        for samples in (iter(self.samples), MmapCorpus(self.corpus_path)):
+            chunks = list(iter_encoded_chunks(samples, encoder, 3))
+            self.assertEqual(len(chunks), len(expected))
+            for (tokens, offsets), (expected_tokens, expected_offsets) in zip(chunks, expected):
+                self.assertListEqual(tokens.tolist(), expected_tokens.tolist())
+                self.assertListEqual(offsets.tolist(), expected_offsets.tolist())
+
+        encoder = _fit(self.samples)
+        convert_corpus(self.pickle_path, self.corpus_path, encoder)
+        chunks = list(iter_encoded_chunks(MmapCorpus(self.corpus_path), encoder, 3))
+        self.assertListEqual([offsets.tolist() for _, offsets in chunks],
+                             [[0, 16, 16, 25], [0, 7]])
+        self.assertListEqual(chunks[1][0].tolist(),
+                             encoder.encode_flat(self.samples[3:])[0].tolist())
+
+    def test_concurrent_writers(self):
+        # writers of the same corpus don't clobber the temporary files of each other
+        corpora = [[sample * (writer_id + 1) for sample in self.samples] for writer_id in range(8)]
+        threads = [threading.Thread(target=save_corpus, args=(samples, self.corpus_path))
+                   for samples in corpora]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIn(list(MmapCorpus(self.corpus_path)), corpora)
+        self.assertListEqual([file_name for file_name in os.listdir(_TEST_ROOT)
+                              if file_name.endswith('.tmp')], [])
+
+    def test_file_mode(self):
+        # corpora get the default mode of new files rather than the owner-only one of mkstemp
+        save_corpus(self.samples, self.corpus_path)
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(self.corpus_path).st_mode & 0o777, 0o666 & ~umask)
+
+
+def _fit(samples):
+    """Return an encoder fit to the samples."""
+    encoder = CharEncoder()
+    encoder.fit(samples)
+    return encoder
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for distance module.
+"""
+import csv
+import os
+import shutil
+import unittest
+
+import numpy as np
+
+from langdist.corpus import MmapCorpus, dump_corpus
+from langdist.distance import _encode_corpus, save_distance_matrix
+from langdist.encoder import CharEncoder
+
+_TEST_ROOT = os.path.dirname(__file__)
+
+__author__ = 'kensk8er'
+
+
+class DistanceTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = os.path.join(_TEST_ROOT, 'distance_cache')
+        os.makedirs(os.path.join(self.cache_dir, 'encoded'))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_encode_corpus(self):
+        encoder = CharEncoder()
+        encoder.fit(['abc'])
+        samples = ['ab', 'xa', '', 'cab', 'z']
+        for corpus_name in ('corpus.pkl', 'corpus.ldc'):
+            corpus_path = os.path.join(self.cache_dir, corpus_name)
+            dump_corpus(samples, corpus_path)
+
+            # texts with characters unknown to the encoder are excluded
+            encoded_path = _encode_corpus(corpus_path, encoder, self.cache_dir, corpus_name)
+            encoded_corpus = MmapCorpus(encoded_path)
+            self.assertEqual(encoded_corpus.encoder_fingerprint, encoder.fingerprint)
+            self.assertListEqual(encoder.decode(list(encoded_corpus)), ['ab', '', 'cab'])
+
+            # encoded corpora are reused
+            os.remove(corpus_path)
+            self.assertEqual(_encode_corpus(corpus_path, encoder, self.cache_dir, corpus_name),
+                             encoded_path)
+
+    def test_save_distance_matrix(self):
+        perplexities = np.array([[2., 3.5], [4., 1.25]])
+        model_paths = ['models/en/', 'models/fr']
+        corpus_paths = ['corpora/en.pkl', 'corpora/fr.pkl']
+
+        npy_path = os.path.join(self.cache_dir, 'matrix.npy')
+        save_distance_matrix(perplexities, model_paths, corpus_paths, npy_path)
+        np.testing.assert_array_equal(np.load(npy_path), perplexities)
+
+        csv_path = os.path.join(self.cache_dir, 'matrix.csv')
+        save_distance_matrix(perplexities, model_paths, corpus_paths, csv_path)
+        with open(csv_path, 'r', newline='') as csv_file:
+            rows = list(csv.reader(csv_file))
+        self.assertListEqual(rows[0], ['model', 'en.pkl', 'fr.pkl'])
+        self.assertListEqual(rows[1][0:1], ['en'])
+        self.assertAlmostEqual(float(rows[2][2]), 1.25)
+
+        # pairs whose texts are all out of vocabulary are nan
+        save_distance_matrix(np.array([[np.nan, 2.]]), model_paths[:1], corpus_paths, csv_path)
+        with open(csv_path, 'r', newline='') as csv_file:
+            self.assertListEqual(list(csv.reader(csv_file))[1], ['en', 'nan', '2.000000'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for distributed module.
+"""
+import multiprocessing
+import unittest
+
+import numpy as np
+
+from langdist.distributed import SharedMemoryAllreduce
+
+__author__ = 'kensk8er'
+
+_SIZE = 10
+
+
+def _run_worker(allreduce, rank, results):
+    allreduce.attach(rank)
+    summed = allreduce.allreduce(np.arange(_SIZE) * (rank + 1))
+    summed_again = allreduce.allreduce(np.full(_SIZE, rank))
+    broadcast = allreduce.broadcast(np.full(_SIZE, rank + 10), root=1)
+    # arrays shorter than the size (e.g. the variables, without the loss and the counts)
+    short_broadcast = allreduce.broadcast(np.full(_SIZE - 3, rank + 20) if rank == 0 else None)
+    results.put((rank, summed.tolist(), summed_again.tolist(), broadcast.tolist(),
+                 short_broadcast.tolist()))
+
+
+class SharedMemoryAllreduceTest(unittest.TestCase):
+    def test_allreduce(self):
+        num_workers = 3
+        context = multiprocessing.get_context('fork')
+        allreduce = SharedMemoryAllreduce(_SIZE, num_workers, context)
+        results = context.Queue()
+        processes = [context.Process(target=_run_worker, args=(allreduce, rank, results))
+                     for rank in range(num_workers)]
+        for process in processes:
+            process.start()
+        results = [results.get(timeout=30) for _ in range(num_workers)]
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        for _, summed, summed_again, broadcast, short_broadcast in results:
+            self.assertListEqual(summed, (np.arange(_SIZE) * 6).tolist())
+            self.assertListEqual(summed_again, [3.] * _SIZE)
+            self.assertListEqual(broadcast, [11.] * _SIZE)
+            self.assertListEqual(short_broadcast, [20.] * (_SIZE - 3))
+
+    def test_single_worker(self):
+        allreduce = SharedMemoryAllreduce(_SIZE, 1)
+        allreduce.attach(0)
+        np.testing.assert_array_equal(allreduce.allreduce(np.arange(_SIZE)), np.arange(_SIZE))
+        np.testing.assert_array_equal(allreduce.broadcast(np.arange(3)), np.arange(3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,7 @@ import unittest
 
 import pickle
 
-from langdist.encoder import fit_encoder
+from langdist.encoder import CharEncoder, fit_encoder
 
 _TEST_ROOT = os.path.dirname(__file__)
 
@@ -34,6 +34,52 @@ class EncoderTest(unittest.TestCase):
             if os.path.exists(encoder_path):
                 os.remove(encoder_path)
 
+    def test_encode_flat(self):
+        samples = ['abc', '', 'Ünïcödé', '𠀋𝄞a']
+        encoder = CharEncoder()
+        encoder.fit(samples)
+
+        # character IDs follow the ordering of the LabelEncoder
+        char_ids, offsets = encoder.encode_flat(samples)
+        label_encoder_ids = encoder._label_encoder.transform(list(''.join(samples))).tolist()
+        self.assertListEqual(char_ids.tolist(), label_encoder_ids)
+        self.assertListEqual(offsets.tolist(), [0, 3, 3, 10, 13])
+
+        encoded = encoder.encode(samples)
+        self.assertListEqual(encoded[3], label_encoder_ids[10:])
+        self.assertListEqual(encoder.decode(encoded), samples)
+
+        # lookup tables aren't pickled but rebuilt when necessary
+        encoder = pickle.loads(pickle.dumps(encoder))
+        self.assertListEqual(encoder.encode(samples), encoded)
+
+        with self.assertRaises(ValueError):
+            encoder.encode(['xyz'])
+
+    def test_fit_encode(self):
+        encoder = CharEncoder()
+        self.assertListEqual(encoder.fit_encode(iter(['ab', 'b'])), [[1, 2], [2]])
+        self.assertListEqual(encoder.encode([]), [])
+        self.assertListEqual(encoder.encode(['', 'a']), [[], [1]])
+
+    def test_partial_fit(self):
+        encoder = CharEncoder()
+        encoder.fit(iter(['abc', 'cb']))
+        self.assertEqual(encoder.vocab_size, 4)  # including the segment character
+        self.assertEqual(encoder.char_counts['b'], 2)
+        self.assertEqual(encoder.sample_num, 2)
+
+        encoder.partial_fit(['ad'])
+        self.assertEqual(encoder.vocab_size, 5)
+        self.assertEqual(encoder.char_counts['a'], 2)
+        self.assertEqual(encoder.sample_num, 3)
+        self.assertListEqual(encoder.decode(encoder.encode(['abcd'])), ['abcd'])
+
+        # fit() starts over
+        encoder.fit(['x'])
+        self.assertEqual(encoder.vocab_size, 2)
+        self.assertEqual(encoder.segment_char_id, 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,123 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for grid module.
+"""
+import json
+import os
+import shutil
+import time
+import unittest
+from unittest import mock
+
+from langdist.grid import _mark_finished, is_finished, load_grid, train_grid
+
+_TEST_ROOT = os.path.dirname(__file__)
+
+__author__ = 'kensk8er'
+
+
+def _run_job(job, parent_job, threads):
+    """Stand-in for the job runner that logs the job and marks it finished without training."""
+    assert parent_job is None or is_finished(parent_job['model']), 'the parent is not finished'
+    log_path = job['train']['log_path']
+    with open(log_path, 'a') as log_file:
+        log_file.write('start {}\n'.format(job['name']))
+    time.sleep(0.1)
+    with open(log_path, 'a') as log_file:
+        log_file.write('end {}\n'.format(job['name']))
+    if job['train'].get('fail'):
+        raise SystemExit(1)
+    os.makedirs(job['model'])
+    _mark_finished(job['model'])
+
+
+class GridTest(unittest.TestCase):
+    def setUp(self):
+        self.grid_path = os.path.join(_TEST_ROOT, 'grid.json')
+        self.grid_dir = os.path.join(_TEST_ROOT, 'grid')
+        os.makedirs(self.grid_dir)
+
+    def tearDown(self):
+        if os.path.exists(self.grid_path):
+            os.remove(self.grid_path)
+        shutil.rmtree(self.grid_dir)
+
+    def dump_grid(self, grid):
+        with open(self.grid_path, 'w') as grid_file:
+            json.dump(grid, grid_file)
+
+    def test_load_grid(self):
+        self.dump_grid({
+            'init': {'rnn_size': 64},
+            'train': {'batch_size': 32, 'patience': 1000},
+            'jobs': [{'name': 'en', 'corpus': 'corpora/en.pkl', 'encoder': 'encoder.pkl',
+                      'model': 'models/en', 'init': {'num_rnn_layers': 1}},
+                     {'name': 'en2fr', 'parent': 'en', 'corpus': 'corpora/fr.pkl',
+                      'model': 'models/en2fr', 'train': {'patience': 500}}]})
+        jobs = load_grid(self.grid_path)
+        self.assertEqual(jobs['en']['model'], os.path.join(_TEST_ROOT, 'models/en'))
+        self.assertDictEqual(jobs['en']['init'], {'rnn_size': 64, 'num_rnn_layers': 1})
+        self.assertDictEqual(jobs['en2fr']['train'], {'batch_size': 32, 'patience': 500})
+        self.assertEqual(jobs['en2fr']['parent'], 'en')
+        self.assertIsNone(jobs['en2fr']['encoder'])
+
+    def test_invalid_grid(self):
+        invalid_jobs = [
+            # undefined parent
+            [{'name': 'en2fr', 'parent': 'en', 'corpus': 'fr.pkl', 'model': 'en2fr'}],
+            # cyclic dependencies
+            [{'name': 'a', 'parent': 'b', 'corpus': 'a.pkl', 'model': 'a'},
+             {'name': 'b', 'parent': 'a', 'corpus': 'b.pkl', 'model': 'b'}],
+            # neither parent nor encoder
+            [{'name': 'en', 'corpus': 'en.pkl', 'model': 'en'}],
+        ]
+        for jobs in invalid_jobs:
+            self.dump_grid({'jobs': jobs})
+            with self.assertRaises(ValueError):
+                load_grid(self.grid_path)
+
+    def test_train_grid(self):
+        log_path = os.path.join(self.grid_dir, 'log.txt')
+        jobs = [{'name': 'en', 'encoder': 'encoder.pkl'},
+                {'name': 'fr', 'encoder': 'encoder.pkl'},
+                {'name': 'en2fr', 'parent': 'en'},
+                {'name': 'en2fr2de', 'parent': 'en2fr'},
+                {'name': 'de', 'encoder': 'encoder.pkl', 'train': {'fail': True}},
+                {'name': 'de2en', 'parent': 'de'},
+                {'name': 'fr2en', 'parent': 'fr'}]
+        for job in jobs:
+            job.update({'corpus': 'corpus.pkl', 'model': 'grid/{}'.format(job['name'])})
+        self.dump_grid({'train': {'log_path': log_path}, 'jobs': jobs})
+
+        # fr has finished in a previous run
+        os.makedirs(os.path.join(self.grid_dir, 'fr'))
+        _mark_finished(os.path.join(self.grid_dir, 'fr'))
+
+        # run the stand-in runner in forked processes (spawned ones don't see the mock)
+        with mock.patch('langdist.grid._run_job', _run_job), \
+                mock.patch('langdist.grid._START_METHOD', 'fork'):
+            not_finished = train_grid(self.grid_path, num_workers=2)
+
+        # the failed job and its child aren't finished, the others are
+        self.assertListEqual(not_finished, ['de', 'de2en'])
+        for name in ('en', 'fr', 'en2fr', 'en2fr2de', 'fr2en'):
+            self.assertTrue(is_finished(os.path.join(self.grid_dir, name)))
+
+        with open(log_path, 'r') as log_file:
+            events = log_file.read().split('\n')[:-1]
+        self.assertNotIn('start fr', events)  # finished jobs are skipped
+        self.assertNotIn('start de2en', events)  # children of failed jobs are skipped
+        self.assertIn('start de', events)
+        for parent, child in (('en', 'en2fr'), ('en2fr', 'en2fr2de')):
+            self.assertLess(events.index('end {}'.format(parent)),
+                            events.index('start {}'.format(child)))
+
+        # at most num_workers jobs run at once
+        running = 0
+        for event in events:
+            running += 1 if event.startswith('start') else -1
+            self.assertLessEqual(running, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
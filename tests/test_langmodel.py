@@ -8,13 +8,33 @@ import unittest
 import pickle
 import shutil
 
+import numpy as np
+
+from langdist.checkpoint import LATEST, get_checkpoint_path, has_checkpoint
 from langdist.cli import train, retrain
+from langdist.corpus import MmapCorpus, save_corpus
+from langdist.langmodel import _CELL_TYPES, CharLSTM
 
 _TEST_ROOT = os.path.dirname(__file__)
+_SAMPLES = ['In the beginning God created the heaven and the earth.',
+            'And the earth was without form, and void.',
+            'And God said, Let there be light: and there was light.',
+            'And God saw the light, that it was good.',
+            'And God called the light Day, and the darkness he called Night.'] * 4
 
 __author__ = 'kensk8er'
 
 
+def _train_model(model_path, init_args=None, **train_args):
+    """Train a small model on _SAMPLES, and return it loaded from its best checkpoint."""
+    init_args = dict({'embedding_size': 8, 'rnn_size': 16, 'num_rnn_layers': 1},
+                     **(init_args or dict()))
+    train_args = dict({'batch_size': 4, 'patience': 40, 'valid_intervals': [1, 2, 4],
+                       'valid_size': 0.2, 'prefetch': 0}, **train_args)
+    CharLSTM(**init_args).train(_SAMPLES, model_path, **train_args)
+    return CharLSTM.load(model_path)
+
+
 class LangmodelTest(unittest.TestCase):
     def test_train(self):
         corpus_path = os.path.join(_TEST_ROOT, 'corpora/en.pkl')
@@ -43,6 +63,184 @@ class LangmodelTest(unittest.TestCase):
             if os.path.exists(model_path):
                 shutil.rmtree(model_path)
 
+    def test_async_validation(self):
+        model_path = os.path.join(_TEST_ROOT, 'langmodel_async_validation')
+        try:
+            char_lstm = _train_model(model_path, async_validation=True)
+            self.assertTrue(has_checkpoint(model_path))
+            self.assertTrue(np.isfinite(char_lstm.score(_SAMPLES[:2])[0]).all())
+        finally:
+            if os.path.exists(model_path):
+                shutil.rmtree(model_path)
+
+    def test_sampled_softmax(self):
+        model_path = os.path.join(_TEST_ROOT, 'langmodel_sampled_softmax')
+        try:
+            char_lstm = _train_model(model_path, {'softmax_loss': 'sampled', 'num_sampled': 4})
+        finally:
+            if os.path.exists(model_path):
+                shutil.rmtree(model_path)
+        self.assertEqual(char_lstm._softmax_loss, 'sampled')
+        self.assertIsNot(char_lstm._nodes['train_loss'], char_lstm._nodes['loss'])
+
+        # evaluation uses the full softmax: the log probability of the empty text is the one of
+        # the segment character in the distribution over the whole target vocabulary
+        probs, _ = char_lstm._prefill(char_lstm._session, *char_lstm._encoder.encode_flat(['']))
+        self.assertAlmostEqual(float(probs.sum()), 1., places=4)
+        segment_id = char_lstm._target_vocab_ids.index(char_lstm._segment_char_id)
+        self.assertAlmostEqual(char_lstm.score([''])[0][0], np.log(probs[0, segment_id]),
+                               places=4)
+
+    def test_cell_types(self):
+        model_path = os.path.join(_TEST_ROOT, 'langmodel_cell_types')
+        texts = ['In the beginning God created the heaven and the earth.', 'a', '']
+        try:
+            for trained_cell_type in ('lstm', 'fused'):
+                char_lstm = _train_model(model_path, {'cell_type': trained_cell_type})
+                log_probs = char_lstm.score(texts)[0]
+                probs, states = char_lstm._prefill(char_lstm._session,
+                                                   *char_lstm._encoder.encode_flat(texts))
+
+                # checkpoints are interchangeable between the cell types
+                for cell_type in _CELL_TYPES:
+                    loaded = CharLSTM.load(model_path, cell_type=cell_type)
+                    self.assertEqual(loaded._cell_type, cell_type)
+                    np.testing.assert_allclose(loaded.score(texts)[0], log_probs, rtol=1e-5)
+                    loaded_probs, loaded_states = loaded._prefill(
+                        loaded._session, *loaded._encoder.encode_flat(texts))
+                    np.testing.assert_allclose(loaded_probs, probs, atol=1e-5)
+                    np.testing.assert_allclose(loaded_states, states, atol=1e-5)
+                shutil.rmtree(model_path)
+        finally:
+            if os.path.exists(model_path):
+                shutil.rmtree(model_path)
+
+
+class TrainedModelTest(unittest.TestCase):
+    """Tests of a model trained once (in the default configuration) and shared by the tests."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model_path = os.path.join(_TEST_ROOT, 'langmodel_trained')
+        cls.char_lstm = _train_model(cls.model_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(cls.model_path):
+            shutil.rmtree(cls.model_path)
+
+    def test_score(self):
+        char_lstm = self.char_lstm
+        texts = ['In the beginning God created the heaven and the earth.', 'a', '']
+        log_probs, bits_per_char, perplexity = char_lstm.score(texts, batch_size=2)
+        self.assertEqual(log_probs.shape, (3,))
+        self.assertTrue((log_probs < 0.).all())
+        self.assertAlmostEqual(bits_per_char[1], -log_probs[1] / np.log(2) / 2)
+        self.assertGreater(perplexity, 1.)
+
+        # scores don't depend on how texts are batched
+        np.testing.assert_allclose(char_lstm.score(texts[::-1], batch_size=1)[0], log_probs[::-1],
+                                   rtol=1e-5)
+
+        # texts with characters unknown to the encoder (or out of the vocabulary) are excluded
+        log_probs, _, unknown_perplexity = char_lstm.score(texts + ['\u3042', 'Z'])
+        self.assertTrue(np.isneginf(log_probs[3:]).all())
+        self.assertAlmostEqual(unknown_perplexity, perplexity, places=4)
+        self.assertTrue(np.isnan(char_lstm.score(['\u3042'])[2]))
+
+        # codepoints corpora are scored in chunks
+        corpus_path = os.path.join(_TEST_ROOT, 'langmodel_score.ldc')
+        try:
+            save_corpus(texts + ['\u3042'], corpus_path)
+            np.testing.assert_allclose(
+                [log_prob for log_prob, _ in char_lstm.iter_scores(
+                    MmapCorpus(corpus_path), batch_size=1, sort_size=2)],
+                log_probs[:4], rtol=1e-5)
+        finally:
+            os.remove(corpus_path)
+
+    def test_evaluate(self):
+        char_lstm = self.char_lstm
+        texts = ['In the beginning God created the heaven and the earth.', 'a', 'and']
+        tokens, offsets = char_lstm._encoder.encode_flat(texts)
+        log_probs, _, perplexity = char_lstm.score(texts)
+
+        # the total log probability doesn't depend on the memory budget of batches
+        for max_tokens in (1, 10, 2 ** 16):
+            log_prob, char_num = char_lstm._evaluate(
+                char_lstm._session, tokens, offsets, np.arange(len(texts)), max_tokens)
+            self.assertEqual(char_num, sum(len(text) + 1 for text in texts))
+            self.assertAlmostEqual(log_prob, log_probs.sum(), places=3)
+            self.assertAlmostEqual(np.exp(-log_prob / char_num), perplexity, places=3)
+
+    def test_prefill(self):
+        char_lstm = self.char_lstm
+        prompts = ['And God', '', 'In the beginning', 'a']
+        tokens, offsets = char_lstm._encoder.encode_flat(prompts)
+
+        # prompts of mixed lengths prefilled in a batch (or in a batch per prompt) get the same
+        # probabilities and states as feeding them into the step graph character by character
+        for max_tokens in (2 ** 16, 1):
+            probs, states = char_lstm._prefill(char_lstm._session, tokens, offsets, max_tokens)
+            for prompt_id, prompt in enumerate(prompts):
+                step_states = char_lstm.zero_states(1)
+                for char_id in [char_lstm.segment_char_id] + char_lstm.encode([prompt])[0]:
+                    step_probs, step_states = char_lstm.step(np.array([char_id], dtype=np.int32),
+                                                             step_states)
+                np.testing.assert_allclose(probs[prompt_id], step_probs[0], atol=1e-5)
+                np.testing.assert_allclose(states[:, :, prompt_id], step_states[:, :, 0],
+                                           atol=1e-5)
+
+        # the public interface prefills prompts the same way
+        public_probs, public_states = char_lstm.prefill(prompts)
+        np.testing.assert_allclose(public_probs, probs, atol=1e-5)
+        np.testing.assert_allclose(public_states, states, atol=1e-5)
+        self.assertEqual(public_probs.shape[1], len(char_lstm.target_vocab_ids))
+        self.assertListEqual(char_lstm.decode(char_lstm.encode(prompts)), prompts)
+        with self.assertRaises(ValueError):
+            char_lstm.prefill(['\u3042'])
+
+    def test_step_graph(self):
+        char_lstm = self.char_lstm
+        nodes = char_lstm._nodes
+        tokens, _ = char_lstm._encoder.encode_flat(['In the beginning'])
+        X = np.array([[char_lstm._segment_char_id] + tokens.tolist()], dtype=np.int32)
+
+        # the step graph gives the same probabilities as the full graph at every position
+        Y_prob = char_lstm._session.run(nodes['Y_prob'], feed_dict={
+            nodes['X']: X, nodes['seq_lens']: [X.shape[1]], nodes['is_train']: False})
+        states = np.zeros((1, 2, 1, 16), dtype=np.float32)
+        for position in range(X.shape[1]):
+            step_probs, states = char_lstm._run_step(char_lstm._session, X[:, position], states)
+            np.testing.assert_allclose(step_probs[0],
+                                       Y_prob[0, position, char_lstm._target_vocab_ids],
+                                       atol=1e-5)
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.model_path = os.path.join(_TEST_ROOT, 'langmodel_checkpoint')
+
+    def tearDown(self):
+        if os.path.exists(self.model_path):
+            shutil.rmtree(self.model_path)
+
+    def test_load_checkpoint(self):
+        char_lstm = _train_model(self.model_path)
+        self.assertTrue(has_checkpoint(self.model_path))
+        tokens, _ = char_lstm._encoder.encode_flat(_SAMPLES)
+        self.assertListEqual(char_lstm._target_vocab_ids, sorted(set(tokens.tolist()) | {
+            char_lstm._segment_char_id}))
+
+        self.assertTrue(np.isfinite(char_lstm.score(_SAMPLES[:2])[0]).all())
+
+        # the latest checkpoint has the vocabulary variables (and the optimizer) written as well
+        resumed = CharLSTM.load(self.model_path, resume=True)
+        self.assertListEqual(resumed._session.run(resumed._graph.get_tensor_by_name(
+            'inputs/target_vocab_ids:0')).tolist(), char_lstm._target_vocab_ids)
+        self.assertTrue(os.path.exists(os.path.join(
+            get_checkpoint_path(self.model_path, LATEST), resumed._training_state_file_name)))
+
 
 if __name__ == '__main__':
     unittest.main()
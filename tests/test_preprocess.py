@@ -6,8 +6,9 @@ import os
 import unittest
 
 import pickle
+import shutil
 
-from langdist.preprocess import preprocess_corpus
+from langdist.preprocess import preprocess_corpora, preprocess_corpus
 
 _TEST_ROOT = os.path.dirname(__file__)
 
@@ -47,6 +48,29 @@ class PreprocessTest(unittest.TestCase):
             if os.path.exists(processed_corpus_path):
                 os.remove(processed_corpus_path)
 
+    def test_preprocess_corpora(self):
+        corpus_path = os.path.join(_TEST_ROOT, 'xx_test.txt')
+        output_dir = os.path.join(_TEST_ROOT, 'preprocessed')
+
+        try:
+            with open(corpus_path, 'w', encoding='utf-8') as corpus_file:
+                for index in range(100):
+                    corpus_file.write('Paragraph {}. It has two sentences!\n'.format(index))
+
+            stats = preprocess_corpora([corpus_path], output_dir, num_workers=2, chunk_size=7)
+
+            with open(stats[corpus_path]['output_path'], 'rb') as processed_corpus_file:
+                corpus = pickle.load(processed_corpus_file)
+
+            self.assertEqual(stats[corpus_path]['lang_code'], 'xx')
+            self.assertEqual(len(corpus), 200)
+            self.assertListEqual(corpus[-2:], ['Paragraph 99.', 'It has two sentences!'])
+        finally:
+            if os.path.exists(corpus_path):
+                os.remove(corpus_path)
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for runtime module.
+"""
+from importlib.util import find_spec
+import pickle
+import time
+import unittest
+
+from langdist.runtime import SessionConfig, autotune_session_config, get_candidate_configs
+
+__author__ = 'kensk8er'
+
+
+class _SleepingSession(object):
+    """Session whose steps take longer with more inter-op threads."""
+
+    def __init__(self, session_config):
+        self.session_config = session_config
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class RuntimeTest(unittest.TestCase):
+    def test_get_candidate_configs(self):
+        candidates = get_candidate_configs(cpu_count=8)
+        self.assertEqual(len(candidates), 6)
+        self.assertSetEqual({config.intra_op_threads for config in candidates}, {8, 4, 2})
+        self.assertSetEqual({config.inter_op_threads for config in candidates}, {1, 2})
+
+        # session configs are saved along with models
+        self.assertEqual(pickle.loads(pickle.dumps(candidates[0])), candidates[0])
+        self.assertEqual(len(get_candidate_configs(cpu_count=1)), 2)
+
+    def test_session_config(self):
+        session_config = SessionConfig(intra_op_threads=4, inter_op_threads=2)
+        self.assertEqual(session_config, SessionConfig(4, 2))
+        self.assertNotEqual(session_config, SessionConfig(4, 2, xla=True))
+        self.assertEqual(repr(session_config),
+                         'SessionConfig(inter_op_threads=2, intra_op_threads=4, '
+                         'optimize_graph=True, xla=False)')
+
+    @unittest.skipUnless(find_spec('tensorflow'), 'tensorflow is not installed')
+    def test_to_config_proto(self):
+        import tensorflow as tf
+        config = SessionConfig(intra_op_threads=4, inter_op_threads=2).to_config_proto()
+        self.assertEqual(config.intra_op_parallelism_threads, 4)
+        self.assertEqual(config.inter_op_parallelism_threads, 2)
+        optimizer_options = config.graph_options.optimizer_options
+        self.assertEqual(optimizer_options.opt_level, tf.OptimizerOptions.L1)
+        self.assertEqual(optimizer_options.global_jit_level, tf.OptimizerOptions.DEFAULT)
+
+        optimizer_options = SessionConfig(xla=True, optimize_graph=False).to_config_proto() \
+            .graph_options.optimizer_options
+        self.assertEqual(optimizer_options.opt_level, tf.OptimizerOptions.L0)
+        self.assertEqual(optimizer_options.global_jit_level, tf.OptimizerOptions.ON_1)
+
+    def test_autotune_session_config(self):
+        sessions = list()
+
+        def create_session(session_config):
+            sessions.append(_SleepingSession(session_config))
+            return sessions[-1]
+
+        def run_step(session):
+            time.sleep(0.005 * session.session_config.inter_op_threads)
+
+        best_config, timings = autotune_session_config(
+            create_session, run_step, get_candidate_configs(cpu_count=2), warmup=1, repeats=3)
+        self.assertEqual(best_config.inter_op_threads, 1)
+        self.assertEqual(len(timings), 4)
+        self.assertTrue(all(session.closed for session in sessions))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for sampling module.
+"""
+import unittest
+
+import numpy as np
+
+from langdist.sampling import sample_from_probs
+
+__author__ = 'kensk8er'
+
+
+class SamplingTest(unittest.TestCase):
+    def setUp(self):
+        self.probs = np.tile([0.05, 0.5, 0.0, 0.3, 0.15], (20000, 1))
+
+    def _frequencies(self, **kwargs):
+        sampled_ids = sample_from_probs(self.probs, np.random.default_rng(0), **kwargs)
+        return np.bincount(sampled_ids, minlength=self.probs.shape[1]) / len(sampled_ids)
+
+    def test_sample_from_probs(self):
+        np.testing.assert_allclose(self._frequencies(), self.probs[0], atol=0.01)
+
+        # sampling is reproducible given a seed
+        self.assertListEqual(
+            sample_from_probs(self.probs[:50], np.random.default_rng(1)).tolist(),
+            sample_from_probs(self.probs[:50], np.random.default_rng(1)).tolist())
+
+    def test_top_k(self):
+        np.testing.assert_allclose(self._frequencies(top_k=2), [0., 0.625, 0., 0.375, 0.],
+                                   atol=0.01)
+        self.assertListEqual(self._frequencies(top_k=1).tolist(), [0., 1., 0., 0., 0.])
+
+    def test_top_p(self):
+        np.testing.assert_allclose(self._frequencies(top_p=0.7), [0., 0.625, 0., 0.375, 0.],
+                                   atol=0.01)
+        self.assertListEqual(self._frequencies(top_p=0.1).tolist(), [0., 1., 0., 0., 0.])
+
+    def test_temperature(self):
+        frequencies = self._frequencies(temperature=0.1)
+        self.assertGreater(frequencies[1], 0.99)
+        self.assertEqual(frequencies[2], 0.)
+
+        # low temperatures don't underflow, and 0 picks the most probable IDs
+        self.assertListEqual(self._frequencies(temperature=0.001).tolist(), [0., 1., 0., 0., 0.])
+        self.assertListEqual(self._frequencies(temperature=0.).tolist(), [0., 1., 0., 0., 0.])
+        with self.assertRaises(ValueError):
+            sample_from_probs(self.probs, np.random.default_rng(0), temperature=-1.)
+
+
+if __name__ == '__main__':
+    unittest.main()
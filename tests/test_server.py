@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for server module.
+"""
+from http.server import ThreadingHTTPServer
+import json
+import threading
+import unittest
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import numpy as np
+
+from langdist.encoder import CharEncoder
+from langdist.server import GenerationServer, _GenerationRequestHandler
+
+__author__ = 'kensk8er'
+
+
+class _NextCharModel(object):
+    """
+    Minimal stand-in for a trained CharLSTM (which requires tensorflow) that always predicts the
+    character following the input character in the vocabulary, and counts the steps in the states.
+    """
+
+    def __init__(self, chars):
+        self._encoder = CharEncoder()
+        self._encoder.fit([chars])
+        self.segment_char_id = self._encoder.segment_char_id
+        self.target_vocab_ids = list(range(self._encoder.vocab_size))
+        self.batch_sizes = list()
+
+    def encode(self, texts):
+        return self._encoder.encode(texts)
+
+    def decode(self, char_ids):
+        return self._encoder.decode(char_ids)
+
+    def zero_states(self, batch_size):
+        return np.zeros((1, 2, batch_size, 1), dtype=np.float32)
+
+    def step(self, X, states):
+        assert states.shape[2] == len(X), 'states and X have different batch sizes'
+        self.batch_sizes.append(len(X))
+        probs = np.zeros((len(X), len(self.target_vocab_ids)), dtype=np.float32)
+        probs[np.arange(len(X)), (X + 1) % len(self.target_vocab_ids)] = 1.
+        return probs, states + 1
+
+
+class ServerTest(unittest.TestCase):
+    def test_generate(self):
+        model = _NextCharModel('abcd')
+        with GenerationServer(model, max_batch_size=2, pick_top_k=1) as server:
+            requests = [server.submit('b'), server.submit(), server.submit('ab', max_char_len=3),
+                        server.submit('c')]
+            texts = [request.result(timeout=10) for request in requests]
+
+            metrics = server.metrics()
+            self.assertEqual(metrics['total_requests'], 4)
+            self.assertEqual(metrics['queue_depth'], 0)
+
+            # characters unknown to the encoder and negative lengths are reported right away
+            with self.assertRaises(ValueError):
+                server.submit('xyz')
+            with self.assertRaises(ValueError):
+                server.submit('a', max_char_len=-1)
+
+            # prompts which are already long enough are returned unchanged
+            self.assertEqual(server.generate('abc', max_char_len=2, timeout=10), 'abc')
+            self.assertEqual(server.generate(max_char_len=0, timeout=10), '')
+
+        self.assertListEqual(texts, ['bcd', 'abcd', 'abc', 'cd'])
+        self.assertLessEqual(max(model.batch_sizes), 2)
+
+        # requests joined the running batch as soon as others left
+        self.assertLess(len(model.batch_sizes), 5 + 5 + 3 + 3)
+
+    def test_stop(self):
+        server = GenerationServer(_NextCharModel('abcd'))
+        server.start()
+        server.stop()
+        with self.assertRaises(RuntimeError):
+            server.submit('a')
+
+    def test_stop_while_submitting(self):
+        # every request submitted concurrently with stop() is either rejected or completed
+        for _ in range(20):
+            server = GenerationServer(_NextCharModel('abcd'), pick_top_k=1)
+            server.start()
+            requests = list()
+
+            def submit():
+                for _ in range(50):
+                    try:
+                        requests.append(server.submit('a'))
+                    except RuntimeError:
+                        return
+
+            thread = threading.Thread(target=submit)
+            thread.start()
+            server.stop()
+            thread.join()
+            for request in requests:
+                try:
+                    request.result(timeout=10)
+                except RuntimeError:
+                    pass
+
+    def test_http(self):
+        handler = type('GenerationRequestHandler', (_GenerationRequestHandler,), {})
+        with GenerationServer(_NextCharModel('abcd'), pick_top_k=1) as server:
+            handler.generation_server = server
+            http_server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+            thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+            thread.start()
+            url = 'http://127.0.0.1:{}/generate'.format(http_server.server_address[1])
+
+            def post(body):
+                try:
+                    with urlopen(url, body.encode('utf-8'), timeout=10) as response:
+                        return response.status, json.loads(response.read().decode('utf-8'))
+                except HTTPError as error:
+                    return error.code, json.loads(error.read().decode('utf-8'))
+
+            try:
+                self.assertEqual(post('{"prompt": "b"}'), (200, {'text': 'bcd'}))
+                for body in ('{"prompt": 5}', '["b"]', '{"max_char_len": [1]}', '{"prompt": "x"}',
+                             '{"max_char_len": "a"}', '{"max_char_len": -1}', 'not json'):
+                    self.assertEqual(post(body)[0], 400, body)
+            finally:
+                http_server.shutdown()
+                http_server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
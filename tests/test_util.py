@@ -0,0 +1,77 @@
+# -*- coding: UTF-8 -*-
+"""
+Unit tests for util module.
+"""
+import gzip
+import math
+import os
+import unittest
+
+from langdist.util import CorpusParser, compute_perplexity
+
+_TEST_ROOT = os.path.dirname(__file__)
+_CORPUS = """<?xml version="1.0" encoding="utf-8"?>
+<cesDoc version="4">
+  <cesHeader version="4">
+    <profileDesc>
+      <langUsage>
+        <language id="en" iso639="en">English</language>
+      </langUsage>
+    </profileDesc>
+  </cesHeader>
+  <text>
+    <body id="Bible">
+      <div id="b.GEN" type="book">
+        <div id="b.GEN.1" type="chapter">
+          <seg id="b.GEN.1.1" type="verse">In the beginning God created the heaven and the earth.</seg>
+          <seg id="b.GEN.1.2" type="verse"></seg>
+          <seg id="b.GEN.1.3" type="verse">And God said, Let there be light: and there was light.</seg>
+        </div>
+      </div>
+    </body>
+  </text>
+</cesDoc>
+"""
+
+__author__ = 'kensk8er'
+
+
+class CorpusParserTest(unittest.TestCase):
+    def _test_corpus_parser(self, corpus_path):
+        parser = CorpusParser(corpus_path)
+        self.assertEqual(parser.lang_code, 'en')
+        self.assertListEqual(list(parser.gen_paragraphs()),
+                             ['In the beginning God created the heaven and the earth.',
+                              'And God said, Let there be light: and there was light.'])
+
+    def test_corpus_parser(self):
+        corpus_path = os.path.join(_TEST_ROOT, 'en_test.xml')
+        try:
+            with open(corpus_path, 'w', encoding='utf-8') as corpus_file:
+                corpus_file.write(_CORPUS)
+            self._test_corpus_parser(corpus_path)
+        finally:
+            if os.path.exists(corpus_path):
+                os.remove(corpus_path)
+
+    def test_gzip_corpus_parser(self):
+        corpus_path = os.path.join(_TEST_ROOT, 'en_test.xml.gz')
+        try:
+            with gzip.open(corpus_path, 'wt', encoding='utf-8') as corpus_file:
+                corpus_file.write(_CORPUS)
+            self._test_corpus_parser(corpus_path)
+        finally:
+            if os.path.exists(corpus_path):
+                os.remove(corpus_path)
+
+
+class ComputePerplexityTest(unittest.TestCase):
+    def test_compute_perplexity(self):
+        self.assertAlmostEqual(compute_perplexity(-2. * math.log(4.), 2), 4.)
+
+        # no character is scored (e.g. all the texts are out of vocabulary)
+        self.assertTrue(math.isnan(compute_perplexity(0., 0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
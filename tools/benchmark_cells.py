@@ -0,0 +1,63 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark the LSTM cell types of CharLSTM (lstm, block and fused) on synthetic batches, and print
+training and inference steps per second of each.
+
+Usage:
+    benchmark_cells.py [--rnn-size=<int>] [--num-layers=<int>] [--vocab-size=<int>]
+        [--batch-size=<int>] [--seq-len=<int>] [--steps=<int>] [--threads=<int>]
+
+Options:
+    --rnn-size=<int>  The number of dimensions of the RNN layers [default: 256]
+    --num-layers=<int>  The number of RNN layers [default: 2]
+    --vocab-size=<int>  The number of characters in the vocabulary [default: 200]
+    --batch-size=<int>  The number of samples per batch [default: 128]
+    --seq-len=<int>  The number of characters per sample in a training batch [default: 100]
+    --steps=<int>  The number of steps measured per cell type [default: 20]
+    --threads=<int>  If specified, the number of intra-op threads (tensorflow decides in default)
+"""
+from docopt import docopt
+
+from langdist.encoder import CharEncoder
+from langdist.langmodel import _CELL_TYPES, CharLSTM
+from langdist.runtime import SessionConfig, autotune_session_config
+
+__author__ = 'kensk8er'
+
+
+def benchmark(cell_type, encoder, rnn_size, num_layers, batch_size, seq_len, steps,
+              session_config):
+    """Return seconds per training step and per inference step of the cell type."""
+    char_lstm = CharLSTM(rnn_size=rnn_size, num_rnn_layers=num_layers,
+                         rnn_dropouts=[1.0] * num_layers, encoder=encoder, cell_type=cell_type)
+    char_lstm._build_graph()
+
+    seconds = list()
+    for mode in ('train', 'generate'):
+        fetch, feed_dict = char_lstm._get_benchmark_step(mode, batch_size, seq_len)
+        _, timings = autotune_session_config(
+            char_lstm._create_benchmark_session, lambda session: session.run(fetch, feed_dict),
+            candidates=[session_config], repeats=steps)
+        seconds.append(timings[0][1])
+    return seconds
+
+
+def main():
+    args = docopt(__doc__)
+    vocab_size = int(args['--vocab-size'])
+    encoder = CharEncoder()
+    encoder.fit([''.join(chr(codepoint) for codepoint in range(0x20, 0x20 + vocab_size - 1))])
+    session_config = SessionConfig(intra_op_threads=int(args['--threads'] or 0))
+
+    print('{:<8}{:>18}{:>22}'.format('cell', 'train steps/sec', 'inference steps/sec'))
+    for cell_type in _CELL_TYPES:
+        train_seconds, generate_seconds = benchmark(
+            cell_type, encoder, int(args['--rnn-size']), int(args['--num-layers']),
+            int(args['--batch-size']), int(args['--seq-len']), int(args['--steps']),
+            session_config)
+        print('{:<8}{:>18.2f}{:>22.2f}'.format(cell_type, 1. / train_seconds,
+                                               1. / generate_seconds))
+
+
+if __name__ == '__main__':
+    main()
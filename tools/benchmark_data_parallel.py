@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark the scaling efficiency of data-parallel training (langdist.distributed) on a synthetic
+corpus, and print the throughput of 1 to --max-workers worker processes.
+
+The batch size per worker is fixed (i.e. the effective batch size grows with the workers), and the
+efficiency is the throughput divided by the number of workers times the throughput of 1 worker.
+
+Usage:
+    benchmark_data_parallel.py [--max-workers=<int>] [--threads=<int>] [--rnn-size=<int>]
+        [--num-layers=<int>] [--batch-size=<int>] [--steps=<int>] [--sample-num=<int>]
+
+Options:
+    --max-workers=<int>  The maximum number of workers (powers of 2 up to this are measured)
+                         [default: 8]
+    --threads=<int>  The number of threads per worker [default: 1]
+    --rnn-size=<int>  The number of dimensions of the RNN layers [default: 256]
+    --num-layers=<int>  The number of RNN layers [default: 2]
+    --batch-size=<int>  The number of samples per batch of a worker [default: 32]
+    --steps=<int>  The number of training steps measured [default: 50]
+    --sample-num=<int>  The number of samples in the synthetic corpus [default: 20000]
+"""
+import os
+import pickle
+import tempfile
+
+import numpy as np
+from docopt import docopt
+
+from langdist.distributed import train_data_parallel
+from langdist.encoder import CharEncoder
+
+__author__ = 'kensk8er'
+
+_CHARS = 'abcdefghijklmnopqrstuvwxyz '
+
+
+def create_corpus(corpus_path, sample_num, random_state=0):
+    """Save a corpus of random texts of 20 to 200 characters."""
+    random_state = np.random.RandomState(random_state)
+    samples = [''.join(random_state.choice(list(_CHARS), random_state.randint(20, 200)))
+               for _ in range(sample_num)]
+    with open(corpus_path, 'wb') as corpus_file:
+        pickle.dump(samples, corpus_file)
+    return samples
+
+
+def main():
+    args = docopt(__doc__)
+    max_workers = int(args['--max-workers'])
+    batch_size = int(args['--batch-size'])
+    steps = int(args['--steps'])
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        corpus_path = os.path.join(temp_dir, 'corpus.pkl')
+        encoder = CharEncoder()
+        encoder.fit(create_corpus(corpus_path, int(args['--sample-num'])))
+        init_args = {'encoder': encoder, 'rnn_size': int(args['--rnn-size']),
+                     'num_rnn_layers': int(args['--num-layers'])}
+
+        print('{:>8}{:>16}{:>10}{:>12}'.format('workers', 'samples/sec', 'speedup', 'efficiency'))
+        base_throughput = None
+        num_workers = 1
+        while num_workers <= max_workers:
+            stats = train_data_parallel(
+                corpus_path, os.path.join(temp_dir, 'model_{}'.format(num_workers)), num_workers,
+                init_args, threads_per_worker=int(args['--threads']),
+                batch_size=batch_size * num_workers, patience=steps * batch_size * num_workers,
+                valid_size=0.01, valid_intervals=[steps + 1])
+            throughput = stats['samples_per_second']
+            base_throughput = base_throughput or throughput
+            speedup = throughput / base_throughput
+            print('{:>8}{:>16.1f}{:>10.2f}{:>12.2f}'.format(num_workers, throughput, speedup,
+                                                            speedup / num_workers))
+            num_workers *= 2
+
+
+if __name__ == '__main__':
+    main()